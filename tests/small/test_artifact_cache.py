@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the persistent artifact cache"""
+
+import os
+import shutil
+import tempfile
+import time
+from ..tools import change_xdg_path, LoggedTestCase
+from umake.network.artifact_cache import ArtifactCache
+from umake.network.download_center import DownloadItem
+from umake.network.partial_download import PartialDownload
+from umake.tools import Checksum, ChecksumType
+
+
+class TestArtifactCache(LoggedTestCase):
+    """This will test the artifact cache in a temporary XDG cache directory"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        self.cache = ArtifactCache()
+        self.cache.max_size = 100
+
+    def tearDown(self):
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def create_artifact(self, key, size, last_used):
+        """Add an artifact of size bytes to the cache, last used at that timestamp"""
+        path = os.path.join(self.cache_dir, key)
+        with open(path, 'wb') as f:
+            f.write(b'A' * size)
+        self.cache.add(key, path, "http://foo/{}".format(key))
+        os.remove(path)
+        os.utime(os.path.join(self.cache.path, key), (last_used, last_used))
+
+    def create_partial_download(self, url, size, last_modified):
+        """Leave a partial download of size bytes for url, last written at that timestamp"""
+        part = PartialDownload(url, None)
+        part.reset({}, [(0, 2 * size - 1)], resumable=True)
+        with part.open_segment(0) as f:
+            f.write(b'A' * size)
+        part.save(force=True)
+        for path in (part.part_path, part.state_path):
+            os.utime(path, (last_modified, last_modified))
+        return part
+
+    def test_key_for_checksum(self):
+        """The key is the checksum, whatever the url"""
+        checksum = Checksum(ChecksumType.md5, "ABCD")
+        self.assertEqual(ArtifactCache.key_for(DownloadItem("http://foo", checksum)), "md5-abcd")
+        self.assertEqual(ArtifactCache.key_for(DownloadItem("http://bar", checksum), "etag"), "md5-abcd")
+
+    def test_key_for_etag(self):
+        """Without checksum, the key depends on the url and etag"""
+        key = ArtifactCache.key_for(DownloadItem("http://foo"), "etag1")
+        self.assertTrue(key.startswith("url-"))
+        self.assertNotEqual(key, ArtifactCache.key_for(DownloadItem("http://foo"), "etag2"))
+        self.assertNotEqual(key, ArtifactCache.key_for(DownloadItem("http://bar"), "etag1"))
+
+    def test_no_key_without_checksum_and_etag(self):
+        """We can't cache anything if we can't identify the content"""
+        self.assertIsNone(ArtifactCache.key_for(DownloadItem("http://foo")))
+
+    def test_add_and_get(self):
+        """We get a file with the cached content, which can be removed without removing the cache entry"""
+        self.create_artifact("md5-abcd", 10, 1000)
+        with self.cache.get("md5-abcd", suffix=".tgz") as f:
+            self.assertEqual(f.read(), b'A' * 10)
+            self.assertTrue(f.name.endswith(".tgz"))
+        self.assertFalse(os.path.exists(f.name))
+        self.assertIsNotNone(self.cache.get("md5-abcd"))
+
+    def test_get_updates_last_used(self):
+        """Getting an artifact marks it as most recently used"""
+        self.create_artifact("md5-abcd", 10, 1000)
+        self.create_artifact("md5-efgh", 10, 2000)
+        self.cache.get("md5-abcd").close()
+        self.assertEqual([entry.key for entry in self.cache.entries()], ["md5-abcd", "md5-efgh"])
+
+    def test_get_missing(self):
+        """Not cached artifacts return None"""
+        self.assertIsNone(self.cache.get("md5-abcd"))
+
+    def test_entries(self):
+        """We list artifacts with their url and size, most recently used first"""
+        self.create_artifact("md5-abcd", 10, 1000)
+        self.create_artifact("md5-efgh", 20, 2000)
+        entries = self.cache.entries()
+        self.assertEqual([(entry.key, entry.url, entry.size) for entry in entries],
+                         [("md5-efgh", "http://foo/md5-efgh", 20), ("md5-abcd", "http://foo/md5-abcd", 10)])
+
+    def test_add_evicts_least_recently_used(self):
+        """Going over the size limit evicts least recently used artifacts"""
+        self.create_artifact("md5-0001", 40, 1000)
+        self.create_artifact("md5-0002", 40, 2000)
+        self.create_artifact("md5-0003", 40, 3000)
+        self.assertEqual([entry.key for entry in self.cache.entries()], ["md5-0003", "md5-0002"])
+
+    def test_too_big_artifact_not_cached(self):
+        """An artifact bigger than the cache isn't cached"""
+        self.create_artifact("md5-0001", 40, 1000)
+        path = os.path.join(self.cache_dir, "big")
+        with open(path, 'wb') as f:
+            f.write(b'A' * 101)
+        self.cache.add("md5-0002", path, "http://foo")
+        self.assertEqual([entry.key for entry in self.cache.entries()], ["md5-0001"])
+
+    def test_prune(self):
+        """We can prune to a specific size"""
+        self.create_artifact("md5-0001", 40, 1000)
+        self.create_artifact("md5-0002", 40, 2000)
+        removed = self.cache.prune(50)
+        self.assertEqual([entry.key for entry in removed], ["md5-0001"])
+        self.assertEqual([entry.key for entry in self.cache.entries()], ["md5-0002"])
+        self.cache.prune(0)
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_disabled_cache(self):
+        """A cache limited to 0 doesn't store nor deliver anything"""
+        self.create_artifact("md5-0001", 40, 1000)
+        self.cache.max_size = 0
+        self.assertIsNone(self.cache.get("md5-0001"))
+
+    def test_prune_old_partial_downloads(self):
+        """Partial downloads not continued for long are removed, even under the size limit"""
+        self.cache.max_size = 1024 * 1024
+        old_part = self.create_partial_download("http://foo/old", 10, time.time() - 8 * 24 * 60 * 60)
+        recent_part = self.create_partial_download("http://foo/recent", 10, time.time())
+        removed = self.cache.prune()
+        self.assertEqual([entry.path for entry in removed], [old_part.path])
+        self.assertFalse(os.path.exists(old_part.part_path))
+        self.assertFalse(os.path.exists(old_part.state_path))
+        self.assertTrue(os.path.exists(recent_part.part_path))
+
+    def test_partial_downloads_count_in_size_limit(self):
+        """Partial downloads are evicted with artifacts, least recently used first"""
+        self.create_artifact("md5-0001", 40, time.time() - 30)
+        part = self.create_partial_download("http://foo/bar", 40, time.time() - 20)
+        self.create_artifact("md5-0002", 40, time.time() - 10)
+        self.assertEqual([entry.key for entry in self.cache.entries()], ["md5-0002"])
+        self.assertFalse(os.path.exists(part.part_path))
+        self.assertFalse(os.path.exists(part.state_path))
+
+    def test_partial_download_being_downloaded_not_pruned(self):
+        """We don't remove a partial download someone is continuing"""
+        part = self.create_partial_download("http://foo/bar", 10, time.time() - 8 * 24 * 60 * 60)
+        part.lock()
+        try:
+            self.assertEqual(self.cache.prune(0), [])
+        finally:
+            part.unlock()
+        self.assertTrue(os.path.exists(part.part_path))
+        self.assertEqual([entry.path for entry in self.cache.prune(0)], [part.path])
+        self.assertEqual(os.listdir(os.path.dirname(part.path)), [])
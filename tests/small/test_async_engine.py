@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the download center asyncio engine using a local server"""
+
+from os.path import join
+from requests.structures import CaseInsensitiveDict
+import shutil
+import socket
+import tempfile
+from time import sleep, time
+from unittest.mock import Mock, patch
+from ..tools import get_data_dir, change_xdg_path, LoggedTestCase, patchelem
+from ..tools.local_server import LocalHttp, RequestHandler
+from umake.network.async_engine import AsyncDownloadEngine
+from umake.network.download_center import DownloadCenter, DownloadItem
+from umake.network.download_scheduler import DownloadScheduler
+from umake.network.page_cache import PageCache
+from umake.network.request_coalescer import RequestCoalescer
+from umake.network.retry import RetryPolicy, RetryStats
+from umake.tools import ChecksumType, Checksum, Singleton
+
+
+class TestAsyncDownloadEngine(LoggedTestCase):
+    """This will test in memory downloads of a download center configured with the asyncio engine"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = join(get_data_dir(), "server-content")
+        cls.server = LocalHttp(cls.server_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.fd_to_close = []
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        Singleton._instances.pop(RequestCoalescer, None)
+        Singleton._instances.pop(RetryStats, None)
+        self.settings = {"engine": "asyncio"}
+        patcher = patch("umake.network.download_center.get_network_setting",
+                        side_effect=lambda name, default=None: self.settings.get(name, default))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for fd in self.fd_to_close:
+            fd.close()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def build_server_address(self, path):
+        return "{}/{}".format(self.server.get_address(), path)
+
+    def content_of(self, filename):
+        with open(join(self.server_dir, filename), 'rb') as f:
+            return f.read()
+
+    def download(self, download_items, **kwargs):
+        """Download those items in memory and return the results"""
+        callback = Mock()
+        DownloadCenter(download_items, callback, download=False, **kwargs)
+        timeout = time() + 5
+        while not callback.called:
+            if time() > timeout:
+                raise(BaseException("Function not called within 5 seconds"))
+        results = callback.call_args[0][0]
+        self.fd_to_close.extend([result.buffer for result in results.values() if result.buffer])
+        return results
+
+    def silent_server(self):
+        """Return the address of a server accepting connections but never answering"""
+        sock = socket.socket()
+        sock.bind(("localhost", 0))
+        sock.listen(5)
+        self.addCleanup(sock.close)
+        return "http://localhost:{}".format(sock.getsockname()[1])
+
+    def test_in_memory_download(self):
+        """In memory downloads are done on the event loop, following redirections"""
+        url = self.build_server_address("simplefile-redirect")
+        with patch.object(DownloadScheduler, "submit") as submit:
+            result = self.download([DownloadItem(url)])[url]
+        self.assertFalse(submit.called)
+        self.assertIsNone(result.error)
+        self.assertEqual(result.buffer.read(), self.content_of("simplefile"))
+        self.assertEqual(result.final_url, self.build_server_address("simplefile"))
+
+    def test_downloads_to_file_use_threads(self):
+        """Downloads to file stay on the DownloadScheduler"""
+        url = self.build_server_address("simplefile")
+        callback = Mock()
+        with patch.object(DownloadScheduler, "submit", wraps=DownloadScheduler().submit) as submit:
+            DownloadCenter([DownloadItem(url)], callback)
+            timeout = time() + 5
+            while not callback.called:
+                if time() > timeout:
+                    raise(BaseException("Function not called within 5 seconds"))
+        result = callback.call_args[0][0][url]
+        self.fd_to_close.append(result.fd)
+        self.assertIsNone(result.error)
+        self.assertTrue(submit.called)
+
+    def test_many_downloads(self):
+        """Many concurrent downloads all complete"""
+        urls = [self.build_server_address("simplefile?{}".format(i)) for i in range(20)]
+        results = self.download([DownloadItem(url) for url in urls])
+        content = self.content_of("simplefile")
+        for url in urls:
+            self.assertIsNone(results[url].error)
+            self.assertEqual(results[url].buffer.read(), content)
+
+    def test_cookies(self):
+        """Cookies are sent and the ones the server sets are returned"""
+        url = self.build_server_address("simplefile")
+        result = self.download([DownloadItem(url, cookies={'int': '5'})])[url]
+        self.assertIsNone(result.error)
+        self.assertEqual('6', result.cookies['int'])
+
+    def test_content_encoding(self):
+        """Content is decoded, unless asked not to"""
+        filename = "www.eclipse.org/technology/epp/downloads/release/luna/R/eclipse-standard-luna-R-linux-gtk.tar.gz"
+        url = self.build_server_address(filename + '-setheaders?content-encoding=gzip')
+        self.assertEqual(len(self.download([DownloadItem(url)])[url].buffer.getvalue()), 10240)
+        Singleton._instances.pop(RequestCoalescer, None)
+        self.assertEqual(len(self.download([DownloadItem(url, ignore_encoding=True)])[url].buffer.getvalue()), 266)
+
+    def test_accepted_encodings(self):
+        """We only ask for content encodings we can decode"""
+        url = self.build_server_address("simplefile-headers?accept-encoding=gzip%2C+deflate")
+        with patch("umake.network.async_engine.requests.utils.default_headers",
+                   return_value=CaseInsensitiveDict({"Accept-Encoding": "gzip, deflate, br"})):
+            result = self.download([DownloadItem(url)])[url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.buffer.read(), self.content_of("simplefile"))
+
+    def test_ca_bundle_from_environment(self):
+        """Certificates are verified with the CA bundle from the environment, like requests does"""
+        ca_bundle = join(get_data_dir(), "localhost.pem")
+        with patch.dict("os.environ", {"REQUESTS_CA_BUNDLE": ca_bundle}), \
+                patch("umake.network.async_engine.ssl.create_default_context") as create_default_context:
+            AsyncDownloadEngine()._ssl_context()
+        create_default_context.assert_called_once_with(cafile=ca_bundle)
+
+    def test_checksum(self):
+        """In memory downloads are checked against their checksum"""
+        url = self.build_server_address("simplefile")
+        result = self.download([DownloadItem(url, Checksum(ChecksumType.md5, "0" * 32))])[url]
+        self.assertIn("checksum", result.error)
+        self.expect_warn_error = True
+
+    def test_404_url(self):
+        """Client errors are reported and not retried"""
+        url = self.build_server_address("does_not_exist")
+        with patch.object(RetryPolicy, "before_retry") as before_retry:
+            result = self.download([DownloadItem(url)])[url]
+        self.assertIn("404", result.error)
+        self.assertFalse(before_retry.called)
+        self.expect_warn_error = True
+
+    def test_scraped_download_stops_early(self):
+        """We stop reading a page once its scraper is done with it"""
+        url = self.build_server_address("biggerfile")
+        scraper = Mock()
+        scraper.done = True
+        with patchelem(RequestHandler, "send_validators", False):
+            result = self.download([DownloadItem(url)], scrapers={url: scraper})[url]
+        self.assertIsNone(result.error)
+        self.assertEqual(scraper.write.call_count, 1)
+        self.assertTrue(scraper.close.called)
+        self.assertIsNone(PageCache().get(DownloadItem(url)))
+
+    def test_scraped_download_cached_whole(self):
+        """We get a scraped page whole if we can cache it"""
+        url = self.build_server_address("biggerfile")
+        scraper = Mock()
+        scraper.done = True
+        result = self.download([DownloadItem(url)], scrapers={url: scraper})[url]
+        self.assertIsNone(result.error)
+        self.assertEqual(scraper.write.call_count, 1)
+        self.assertEqual(result.buffer.getvalue(), self.content_of("biggerfile"))
+        self.assertEqual(PageCache().get(DownloadItem(url)).content, self.content_of("biggerfile"))
+
+    def test_read_timeout(self):
+        """A server not answering in time is an error"""
+        self.settings.update({"read_timeout": 0.2, "retries": 0})
+        url = "{}/page".format(self.silent_server())
+        with patch("umake.network.get_network_setting",
+                   side_effect=lambda name, default=None: self.settings.get(name, default)):
+            result = self.download([DownloadItem(url)])[url]
+        self.assertIn("timed out", result.error)
+        self.expect_warn_error = True
+
+    def test_cancel_waiting_download(self):
+        """Cancelling interrupts downloads waiting for the server right away"""
+        url = "{}/page".format(self.silent_server())
+        callback = Mock()
+        download_center = DownloadCenter([DownloadItem(url)], callback, download=False)
+        # let it connect and wait for an answer
+        sleep(0.2)
+        download_center.cancel()
+        timeout = time() + 5
+        while not callback.called:
+            if time() > timeout:
+                raise(BaseException("Function not called within 5 seconds"))
+        self.assertIn("cancelled", callback.call_args[0][0][url].error)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Tests for download bandwidth limits"""
+
+import os
+from unittest.mock import patch
+from ..tools import LoggedTestCase
+from umake.network.bandwidth import BandwidthLimiter, parse_rate, TokenBucket
+from umake.settings import UMAKE_LIMIT_RATE_ENVIRON_VARIABLE
+from umake.tools import Singleton
+
+
+class TestBandwidth(LoggedTestCase):
+    """This will test rates parsing and the token buckets"""
+
+    def setUp(self):
+        super().setUp()
+        Singleton._instances.pop(BandwidthLimiter, None)
+
+    def tearDown(self):
+        Singleton._instances.pop(BandwidthLimiter, None)
+        os.environ.pop(UMAKE_LIMIT_RATE_ENVIRON_VARIABLE, None)
+        super().tearDown()
+
+    def test_parse_rate(self):
+        """We parse rates in bytes per second with optional units"""
+        self.assertEqual(parse_rate("1000"), 1000)
+        self.assertEqual(parse_rate(1000), 1000)
+        self.assertEqual(parse_rate("500K"), 500 * 1024)
+        self.assertEqual(parse_rate("1.5m"), int(1.5 * 1024 * 1024))
+        self.assertEqual(parse_rate("2G"), 2 * 1024 ** 3)
+        self.assertEqual(parse_rate("0"), 0)
+        self.assertRaises(ValueError, parse_rate, "fast")
+        self.assertRaises(ValueError, parse_rate, "-1")
+
+    def test_bucket_burst_then_rate(self):
+        """We let one second of traffic through right away, then wait for the rate"""
+        bucket = TokenBucket(1000)
+        with patch("umake.network.bandwidth.time.sleep") as sleep:
+            self.assertEqual(bucket.consume(1000), 0)
+            self.assertAlmostEqual(bucket.consume(500), 0.5, places=1)
+            self.assertAlmostEqual(sleep.call_args[0][0], 0.5, places=1)
+
+    def test_bucket_shared_debt(self):
+        """Consumers sharing a bucket wait for each other debt"""
+        bucket = TokenBucket(1000)
+        with patch("umake.network.bandwidth.time.sleep"):
+            bucket.consume(1000)
+            first_wait = bucket.consume(1000)
+            second_wait = bucket.consume(1000)
+        self.assertAlmostEqual(first_wait, 1, places=1)
+        self.assertAlmostEqual(second_wait, 2, places=1)
+
+    def test_unlimited_by_default(self):
+        """We don't throttle anything without limits"""
+        with patch("umake.network.bandwidth.time.sleep") as sleep:
+            BandwidthLimiter().throttle().consume(10 ** 9)
+        self.assertFalse(sleep.called)
+        self.assertEqual(BandwidthLimiter().rate, 0)
+
+    def test_rate_from_environment(self):
+        """We take the global rate from the environment"""
+        os.environ[UMAKE_LIMIT_RATE_ENVIRON_VARIABLE] = "2K"
+        self.assertEqual(BandwidthLimiter().rate, 2048)
+
+    def test_invalid_rate_ignored(self):
+        """We warn about invalid rates and don't limit the bandwidth"""
+        self.expect_warn_error = True
+        os.environ[UMAKE_LIMIT_RATE_ENVIRON_VARIABLE] = "fast"
+        self.assertEqual(BandwidthLimiter().rate, 0)
+
+    def test_global_and_per_download_rates(self):
+        """Each download waits for both the global and its own limit"""
+        limiter = BandwidthLimiter()
+        limiter.set_rate(1000)
+        limiter.per_download_rate = 500
+        with patch("umake.network.bandwidth.time.sleep"):
+            throttle = limiter.throttle()
+            throttle.consume(500)
+            self.assertAlmostEqual(throttle.consume(500), 1, places=1)
+            # an other download only waits for the global limit
+            self.assertAlmostEqual(limiter.throttle().consume(500), 0.5, places=1)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for offline install bundles, exported from a local server"""
+
+import hashlib
+import os
+from os.path import join
+import shutil
+import tarfile
+import tempfile
+from time import time
+from unittest.mock import Mock
+from ..tools import get_data_dir, change_xdg_path, LoggedTestCase
+from ..tools.local_server import LocalHttp
+from umake.network.bundle import Bundle
+from umake.network.download_center import DownloadCenter, DownloadItem
+from umake.network.mirrors import MirrorSelector
+from umake.network.request_coalescer import RequestCoalescer
+from umake.tools import ChecksumType, Checksum, Singleton
+
+
+class TestBundle(LoggedTestCase):
+    """This will test exporting downloads to a bundle, then downloading from it"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = join(get_data_dir(), "server-content")
+        cls.server = LocalHttp(cls.server_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        self.bundle_path = join(self.cache_dir, "bundle.tar")
+        Singleton._instances.pop(MirrorSelector, None)
+        self.new_bundle()
+        self.fd_to_close = []
+
+    def tearDown(self):
+        for fd in self.fd_to_close:
+            fd.close()
+        Singleton._instances.pop(Bundle, None)
+        Singleton._instances.pop(RequestCoalescer, None)
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def new_bundle(self):
+        """Start a new process-like bundle state"""
+        Singleton._instances.pop(Bundle, None)
+        # memoized responses wouldn't go through the bundle
+        Singleton._instances.pop(RequestCoalescer, None)
+        return Bundle()
+
+    def build_server_address(self, path):
+        return "{}/{}".format(self.server.get_address(), path)
+
+    def download(self, download_items, download=True):
+        """Download those items and return the results"""
+        callback = Mock()
+        DownloadCenter(download_items, callback, download=download)
+        timeout = time() + 5
+        while not callback.called:
+            if time() > timeout:
+                raise(BaseException("Function not called within 5 seconds"))
+        results = callback.call_args[0][0]
+        for result in results.values():
+            if result.fd:
+                self.fd_to_close.append(result.fd)
+            if result.buffer:
+                self.fd_to_close.append(result.buffer)
+        return results
+
+    def export(self, download_items, download=True):
+        """Export those items to the bundle, for the category framework"""
+        Bundle().export_to(self.bundle_path)
+        results = self.download(download_items, download)
+        Bundle().write("category", "framework")
+        return results
+
+    def test_export_and_install_from_bundle(self):
+        """What we exported is downloaded from the bundle afterwards"""
+        with open(join(self.server_dir, "simplefile"), 'rb') as f:
+            content = f.read()
+        with open(join(self.server_dir, "biggerfile"), 'rb') as f:
+            artifact_content = f.read()
+        page_url = self.build_server_address("simplefile-redirect")
+        artifact_url = self.build_server_address("biggerfile")
+        checksum = Checksum(ChecksumType.md5, hashlib.md5(artifact_content).hexdigest())
+        Bundle().export_to(self.bundle_path)
+        self.download([DownloadItem(page_url)], download=False)
+        self.download([DownloadItem(artifact_url, checksum)])
+        Bundle().write("category", "framework")
+        self.assertEqual(Bundle.frameworks_in(self.bundle_path), [("category", "framework")])
+
+        self.new_bundle().import_from(self.bundle_path)
+        page = self.download([DownloadItem(page_url)], download=False)[page_url]
+        self.assertIsNone(page.error)
+        self.assertEqual(page.buffer.read(), content)
+        self.assertEqual(page.final_url, self.build_server_address("simplefile"))
+        artifact = self.download([DownloadItem(artifact_url, checksum)])[artifact_url]
+        self.assertIsNone(artifact.error)
+        self.assertEqual(artifact.fd.read(), artifact_content)
+        # the bundled file is kept after use
+        artifact.fd.close()
+        self.assertTrue(os.path.exists(artifact.fd.name))
+
+    def test_no_network_from_bundle(self):
+        """Urls which aren't in the bundle are errors, they aren't downloaded"""
+        self.export([DownloadItem(self.build_server_address("simplefile"))])
+
+        self.new_bundle().import_from(self.bundle_path)
+        url = self.build_server_address("biggerfile")
+        self.assertIn("isn't in the bundle", self.download([DownloadItem(url)])[url].error)
+        self.expect_warn_error = True
+
+    def test_wrong_checksum_from_bundle(self):
+        """A bundled artifact is checked against its checksum"""
+        url = self.build_server_address("simplefile")
+        self.export([DownloadItem(url)])
+
+        self.new_bundle().import_from(self.bundle_path)
+        result = self.download([DownloadItem(url, Checksum(ChecksumType.md5, "0" * 32))])[url]
+        self.assertIn("checksum", result.error)
+        self.expect_warn_error = True
+
+    def test_export_appends(self):
+        """Exporting other frameworks appends them to the bundle"""
+        self.export([DownloadItem(self.build_server_address("simplefile"))])
+        bundle = self.new_bundle()
+        bundle.export_to(self.bundle_path)
+        self.download([DownloadItem(self.build_server_address("biggerfile"))])
+        bundle.write("category", "other-framework")
+
+        self.assertEqual(Bundle.frameworks_in(self.bundle_path), [("category", "framework"),
+                                                                  ("category", "other-framework")])
+        self.new_bundle().import_from(self.bundle_path)
+        for filename in ("simplefile", "biggerfile"):
+            url = self.build_server_address(filename)
+            self.assertIsNone(self.download([DownloadItem(url)])[url].error)
+
+    def test_export_frameworks_in_same_process(self):
+        """Each framework exported by the same process only gets what it downloaded"""
+        self.export([DownloadItem(self.build_server_address("simplefile"))])
+        url = self.build_server_address("biggerfile")
+        bundle = Bundle()
+        bundle.export_to(self.bundle_path)
+        self.download([DownloadItem(url)])
+        bundle.write("category", "other-framework")
+
+        bundle = self.new_bundle()
+        bundle.import_from(self.bundle_path)
+        self.assertEqual(list(bundle._manifests[("category", "other-framework")]["downloads"]), [url])
+
+    def test_export_debs(self):
+        """Package archives downloaded to the debs dir are exported with the framework"""
+        bundle = Bundle()
+        bundle.export_to(self.bundle_path)
+        os.makedirs(bundle.debs_dir)
+        with open(join(bundle.debs_dir, "foo_1.0_amd64.deb"), 'wb') as f:
+            f.write(b"deb content")
+        bundle.write("category", "framework")
+
+        bundle = self.new_bundle()
+        bundle.import_from(self.bundle_path)
+        debs = bundle.debs_for("category", "framework")
+        self.assertEqual([os.path.basename(deb) for deb in debs], ["foo_1.0_amd64.deb"])
+        with open(debs[0], 'rb') as f:
+            self.assertEqual(f.read(), b"deb content")
+        self.assertEqual(bundle.debs_for("category", "unknown"), [])
+
+    def test_import_invalid_bundle(self):
+        """We raise on a bundle which isn't a tar archive"""
+        with open(self.bundle_path, 'w') as f:
+            f.write("foo")
+        with self.assertRaises(tarfile.TarError):
+            Bundle().import_from(self.bundle_path)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the artifact cache server, between a local http server and download centers"""
+
+from concurrent import futures
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+from os.path import join
+import requests
+import shutil
+from socketserver import ThreadingMixIn
+import tempfile
+from threading import Thread
+from time import sleep, time
+from unittest.mock import Mock, patch
+from ..tools import change_xdg_path, LoggedTestCase
+from ..tools.local_server import LocalHttp
+from umake.network import cache_server_url
+from umake.network.cache_server import CacheServer, _CacheRequestHandler
+from umake.network.download_center import DownloadCenter, DownloadItem
+from umake.network.mirrors import MirrorSelector
+from umake.network.request_coalescer import RequestCoalescer
+from umake.network.retry import RetryStats
+from umake.tools import ChecksumType, Checksum, Singleton
+
+
+class TestCacheServer(LoggedTestCase):
+    """This will test the cache server serving what an upstream local server has"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = tempfile.mkdtemp()
+        cls.server = LocalHttp(cls.server_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+        shutil.rmtree(cls.server_dir)
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        Singleton._instances.pop(MirrorSelector, None)
+        Singleton._instances.pop(RequestCoalescer, None)
+        Singleton._instances.pop(RetryStats, None)
+        # the upstream servers of the tests are local ones
+        self.cache_server = CacheServer(port=0, address="localhost", allow_local_urls=True)
+        self.cache_server.start()
+        self.cache_server_address = "http://localhost:{}".format(self.cache_server.port)
+        self.content = os.urandom(300 * 1024)
+        with open(join(self.server_dir, "artifact"), 'wb') as f:
+            f.write(self.content)
+        self.checksum = Checksum(ChecksumType.sha256, hashlib.sha256(self.content).hexdigest())
+        self.fd_to_close = []
+
+    def tearDown(self):
+        for fd in self.fd_to_close:
+            fd.close()
+        self.cache_server.stop()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def artifact_url(self, checksum=None, filename="artifact"):
+        """Return the cache server url of filename on the upstream server"""
+        download_item = DownloadItem("{}/{}".format(self.server.get_address(), filename), checksum)
+        return cache_server_url(self.cache_server_address, download_item)
+
+    def slow_server(self, content, pieces, delay):
+        """Return the address of a server sending content in pieces, waiting delay seconds before each of them, and
+        the list of paths it was asked for"""
+        requested_paths = []
+
+        class SlowRequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                requested_paths.append(self.path)
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                piece_size = -(-len(content) // pieces)
+                for offset in range(0, len(content), piece_size):
+                    sleep(delay)
+                    self.wfile.write(content[offset:offset + piece_size])
+                    self.wfile.flush()
+
+            def log_message(self, fmt, *args):
+                pass
+
+        class ThreadingServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        server = ThreadingServer(("localhost", 0), SlowRequestHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return "http://localhost:{}".format(server.server_address[1]), requested_paths
+
+    def wait_for_callback(self, callback):
+        """wait for the callback to be called until a timeout, and return the results it got"""
+        timeout = time() + 5
+        while not callback.called:
+            if time() > timeout:
+                raise(BaseException("Function not called within 5 seconds"))
+        results = callback.call_args[0][0]
+        self.fd_to_close.extend([result.fd for result in results.values() if result.fd])
+        return results
+
+    def test_serve_miss_then_from_cache(self):
+        """We stream an artifact we don't have while downloading it, then serve it from cache"""
+        r = requests.get(self.artifact_url(self.checksum))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, self.content)
+        self.assertEqual(r.headers["transfer-encoding"], "chunked")
+
+        os.remove(join(self.server_dir, "artifact"))
+        r = requests.get(self.artifact_url(self.checksum))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, self.content)
+        self.assertEqual(r.headers["content-length"], str(len(self.content)))
+        self.assertEqual(r.headers["accept-ranges"], "bytes")
+        self.assertIn("etag", r.headers)
+
+    def test_serve_range_from_cache(self):
+        """We serve ranges of cached artifacts"""
+        requests.get(self.artifact_url(self.checksum))
+        r = requests.get(self.artifact_url(self.checksum), headers={"Range": "bytes=1000-1999"})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.headers["content-range"], "bytes 1000-1999/{}".format(len(self.content)))
+        self.assertEqual(r.content, self.content[1000:2000])
+
+    def test_concurrent_misses_coalesced(self):
+        """Clients asking for the same artifact at the same time share one download"""
+        with patch("umake.network.cache_server.DownloadCenter", wraps=DownloadCenter) as download_center:
+            with futures.ThreadPoolExecutor(max_workers=5) as executor:
+                responses = list(executor.map(lambda i: requests.get(self.artifact_url(self.checksum)), range(5)))
+        for r in responses:
+            self.assertEqual(r.content, self.content)
+        self.assertEqual(download_center.call_count, 1)
+
+    def test_serve_without_checksum(self):
+        """Artifacts without checksum are downloaded for the client"""
+        r = requests.get(self.artifact_url())
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, self.content)
+
+    def test_upstream_error(self):
+        """We report that we couldn't download the artifact"""
+        r = requests.get(self.artifact_url(filename="does_not_exist"))
+        self.assertEqual(r.status_code, 502)
+        self.expect_warn_error = True
+
+    def test_wrong_checksum(self):
+        """We don't send anything of an artifact whose checksum doesn't match"""
+        r = requests.get(self.artifact_url(Checksum(ChecksumType.sha256, "0" * 64)))
+        self.assertEqual(r.status_code, 502)
+        self.assertNotIn(self.content[:1024], r.content)
+        self.expect_warn_error = True
+
+    def test_local_files_not_served(self):
+        """We don't give access to the files of the machine running the server"""
+        r = requests.get(cache_server_url(self.cache_server_address, DownloadItem("file:///etc/passwd")))
+        self.assertEqual(r.status_code, 400)
+
+    def test_local_mirrors_not_served(self):
+        """We refuse to download from mirrors which aren't remote urls"""
+        download_item = DownloadItem("{}/artifact".format(self.server.get_address()), self.checksum,
+                                     mirrors=["file:///etc/passwd"])
+        r = requests.get(cache_server_url(self.cache_server_address, download_item))
+        self.assertEqual(r.status_code, 400)
+
+    def test_local_hosts_not_served(self):
+        """We refuse to download from hosts only reachable from the machine running the server"""
+        self.cache_server.allow_local_urls = False
+        for url in ("http://localhost:1/artifact", "http://127.0.0.2/artifact", "http://[::1]/artifact",
+                    "http://[::ffff:127.0.0.1]/artifact", "http://169.254.169.254/latest/meta-data/",
+                    "http://0.0.0.0/artifact"):
+            r = requests.get(cache_server_url(self.cache_server_address, DownloadItem(url)))
+            self.assertEqual(r.status_code, 400, url)
+        download_item = DownloadItem("http://192.0.2.1/artifact", self.checksum,
+                                     mirrors=["http://localhost:1/artifact"])
+        r = requests.get(cache_server_url(self.cache_server_address, download_item))
+        self.assertEqual(r.status_code, 400)
+
+    def test_redirection_to_local_hosts_not_followed(self):
+        """We refuse to follow a redirection to a host only reachable from the machine running the server"""
+        self.cache_server.allow_local_urls = False
+        with patch.object(CacheServer, "is_local_url", side_effect=lambda url: url.endswith("/artifact")):
+            r = requests.get(self.artifact_url(filename="artifact-redirect"))
+        self.assertEqual(r.status_code, 502)
+        self.assertNotIn(self.content[:1024], r.content)
+        self.expect_warn_error = True
+
+    def test_is_local_url(self):
+        """Loopback and link-local hosts are local, others aren't"""
+        self.assertTrue(CacheServer.is_local_url("http://localhost/foo"))
+        self.assertTrue(CacheServer.is_local_url("https://[fe80::1]/foo"))
+        self.assertFalse(CacheServer.is_local_url("http://192.0.2.1/foo"))
+        self.assertFalse(CacheServer.is_local_url("http://10.0.0.1/foo"))
+
+    def test_download_center_through_cache_server(self):
+        """A DownloadCenter configured with a cache server downloads through it"""
+        url = "{}/artifact".format(self.server.get_address())
+        callback = Mock()
+        with patch("umake.network.download_center.get_network_setting",
+                   side_effect=lambda name, default=None:
+                   self.cache_server_address if name == "cache_server" else default),\
+                patch("umake.network.cache_server.DownloadCenter", wraps=DownloadCenter) as download_center:
+            DownloadCenter([DownloadItem(url, self.checksum)], callback)
+            result = self.wait_for_callback(callback)[url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), self.content)
+        self.assertEqual(download_center.call_count, 1)
+
+    def test_download_center_falls_back_to_internet(self):
+        """A DownloadCenter downloads from the internet if its cache server is down"""
+        url = "{}/artifact".format(self.server.get_address())
+        callback = Mock()
+        with patch("umake.network.download_center.get_network_setting",
+                   side_effect=lambda name, default=None:
+                   "http://localhost:1" if name == "cache_server" else default),\
+                patch("umake.network.retry.time.sleep"):
+            DownloadCenter([DownloadItem(url, self.checksum)], callback)
+            result = self.wait_for_callback(callback)[url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), self.content)
+
+    def test_download_center_through_cache_server_slower_than_timeout(self):
+        """Clients keep waiting for a checked artifact whose download takes longer than their read timeout"""
+        address, requested_paths = self.slow_server(self.content, pieces=10, delay=0.15)
+        url = "{}/artifact".format(address)
+        settings = {"cache_server": self.cache_server_address, "read_timeout": 0.5, "retries": 0}
+        callback = Mock()
+        fetch_from_cache_server = DownloadCenter._fetch_from_cache_server
+        cache_server_results = []
+
+        def record_cache_server_result(*args):
+            cache_server_results.append(fetch_from_cache_server(*args))
+            return cache_server_results[-1]
+        with patch("umake.network.get_network_setting",
+                   side_effect=lambda name, default=None: settings.get(name, default)),\
+                patch("umake.network.download_center.get_network_setting",
+                      side_effect=lambda name, default=None: settings.get(name, default)),\
+                patch.object(DownloadCenter, "_fetch_from_cache_server", autospec=True,
+                             side_effect=record_cache_server_result),\
+                patch.object(_CacheRequestHandler, "KEEP_ALIVE_INTERVAL", 0.1):
+            DownloadCenter([DownloadItem(url, self.checksum)], callback)
+            result = self.wait_for_callback(callback)[url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), self.content)
+        # we didn't fall back to downloading it directly
+        self.assertEqual(len(cache_server_results), 1)
+        self.assertIsNotNone(cache_server_results[0])
+        self.assertEqual(requested_paths, ["/artifact"])
@@ -102,6 +102,11 @@ class TestCLIFromFrameworks(LoggedTestCase):
         self.assertEqual(mangle_args_for_default_framework(["-v", "--debug", "category-a", "framework-a"]),
                          ["-v", "--debug", "category-a", "framework-a"])
 
+    def test_mangle_args_for_default_framework_with_global_option_value(self):
+        """Global options values aren't taken for a category, completing with default framework"""
+        self.assertEqual(mangle_args_for_default_framework(["--limit-rate", "500K", "category-a"]),
+                         ["--limit-rate", "500K", "category-a", "framework-a"])
+
     def test_mangle_args_for_framework_with_global_and_framework_options(self):
         """Global options and framework options are preserved"""
         self.assertEqual(mangle_args_for_default_framework(["-v", "category-a", "framework-a", "--bar",
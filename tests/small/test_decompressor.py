@@ -19,14 +19,16 @@
 
 """Tests for the decompressor module"""
 
+from io import BytesIO
 import os
 from time import time
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import shutil
 import stat
+import tarfile
 import tempfile
 from ..tools import get_data_dir, LoggedTestCase
-from umake.decompressor import Decompressor
+from umake.decompressor import Decompressor, StreamingDecompressor
 
 
 class TestDecompressor(LoggedTestCase):
@@ -196,3 +198,100 @@ class TestDecompressor(LoggedTestCase):
         self.assertEqual(len(results), 1, str(results))
         for fd in results:
             self.assertIsNotNone(results[fd].error)
+
+    def stream_to(self, streamed, filepath):
+        """Write filepath content to streamed in small chunks, like a download"""
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024), b''):
+                streamed.write(chunk)
+
+    def test_decompress_streamed(self):
+        """We use the content extracted while downloading, moving the selected subdir content"""
+        filepath = os.path.join(self.compressfiles_dir, "valid.tgz")
+        dest = os.path.join(self.tempdir, "dest")
+        streamed = StreamingDecompressor(dest)
+        self.stream_to(streamed, filepath)
+        fd = open(filepath, 'rb')
+        Decompressor({fd: Decompressor.DecompressOrder(dest=dest, dir='server-content')}, self.on_done,
+                     streamed={fd: streamed})
+        self.wait_for_callback(self.on_done)
+        # the archive wasn't extracted again from the file
+        self.assertEqual(fd.tell(), 0)
+
+        results = self.on_done.call_args[0][0]
+        for fd in results:
+            self.assertIsNone(results[fd].error)
+        self.assertTrue(os.path.isfile(os.path.join(dest, 'simplefile')))
+        self.assertTrue(os.path.isfile(os.path.join(dest, 'subdir', 'otherfile')))
+        self.assertFalse(os.path.exists(streamed.staging_dir))
+
+    def test_streamed_commit(self):
+        """A complete stream is extracted while written, without needing the file afterwards"""
+        dest = os.path.join(self.tempdir, "dest")
+        streamed = StreamingDecompressor(dest)
+        self.stream_to(streamed, os.path.join(self.compressfiles_dir, "valid.tgz"))
+
+        self.assertTrue(streamed.commit(dest))
+        self.assertTrue(os.path.isfile(os.path.join(dest, 'server-content', 'simplefile')))
+        self.assertFalse(os.path.exists(streamed.staging_dir))
+
+    def unsafe_archive(self, member):
+        """Return the path of a tar archive with an innocent file, then member"""
+        path = os.path.join(self.tempdir, "unsafe.tar")
+        with tarfile.open(path, 'w') as tar:
+            info = tarfile.TarInfo("innocent")
+            info.size = 3
+            tar.addfile(info, BytesIO(b"foo"))
+            tar.addfile(member, BytesIO(b"bar") if member.isfile() else None)
+        return path
+
+    def test_streamed_unsafe_archives(self):
+        """Nothing of an archive not checked yet is written outside of the staging directory"""
+        for with_filters in (True, False):
+            for name, linktype, linkname in (("../outside", tarfile.REGTYPE, ""),
+                                             ("{root}/absolute", tarfile.REGTYPE, ""),
+                                             ("link", tarfile.SYMTYPE, "../outside"),
+                                             ("link", tarfile.SYMTYPE, "/etc/passwd"),
+                                             ("link", tarfile.LNKTYPE, "../outside")):
+                root = tempfile.mkdtemp(dir=self.tempdir)
+                member = tarfile.TarInfo(name.format(root=root))
+                member.type, member.linkname = linktype, linkname
+                member.size = 3 if member.isfile() else 0
+                archive = self.unsafe_archive(member)
+                with patch("umake.decompressor.tarfile.data_filter", create=True):
+                    if not with_filters:
+                        del tarfile.data_filter
+                    dest = os.path.join(root, "dest")
+                    streamed = StreamingDecompressor(dest)
+                    self.stream_to(streamed, archive)
+                    # the extraction filter may strip an unsafe path rather than refuse it
+                    if streamed.commit(dest):
+                        shutil.rmtree(dest)
+                self.assertEqual(os.listdir(root), [], member.name)
+
+    def test_decompress_streamed_fallback(self):
+        """We fallback to decompressing the file if streamed extraction failed"""
+        filepath = os.path.join(self.compressfiles_dir, "valid.tgz")
+        dest = os.path.join(self.tempdir, "dest")
+        streamed = StreamingDecompressor(dest)
+        self.stream_to(streamed, os.path.join(self.compressfiles_dir, "invalid.tgz"))
+        fd = open(filepath, 'rb')
+        Decompressor({fd: Decompressor.DecompressOrder(dest=dest, dir=None)}, self.on_done, streamed={fd: streamed})
+        self.wait_for_callback(self.on_done)
+
+        results = self.on_done.call_args[0][0]
+        for fd in results:
+            self.assertIsNone(results[fd].error)
+        self.assertTrue(os.path.isfile(os.path.join(dest, 'server-content', 'simplefile')))
+        self.assertFalse(os.path.exists(streamed.staging_dir))
+
+    def test_streamed_discard(self):
+        """A discarded streamed extraction is never used and cleans up after itself"""
+        dest = os.path.join(self.tempdir, "dest")
+        streamed = StreamingDecompressor(dest)
+        self.stream_to(streamed, os.path.join(self.compressfiles_dir, "valid.tgz"))
+        streamed.discard()
+
+        self.assertFalse(streamed.commit(dest))
+        self.assertFalse(os.path.exists(dest))
+        self.assertFalse(os.path.exists(streamed.staging_dir))
@@ -19,15 +19,34 @@
 
 """Tests for the download center module using a local server"""
 
+from concurrent import futures
+from contextlib import closing
 from enum import Enum
+import hashlib
+from io import BytesIO
 import os
 from os.path import join, getsize
+import requests
+import shutil
+import tempfile
+from threading import Event
 from time import time
-from unittest.mock import Mock, call
-from ..tools import get_data_dir, CopyingMock, LoggedTestCase
-from ..tools.local_server import LocalHttp
-from umake.network.download_center import DownloadCenter, DownloadItem
-from umake.tools import ChecksumType, Checksum
+from unittest.mock import Mock, call, patch
+from ..tools import get_data_dir, change_xdg_path, CopyingMock, LoggedTestCase, patchelem
+from ..tools.local_server import LocalHttp, RequestHandler
+from umake.network.artifact_cache import ArtifactCache
+from umake.network.bandwidth import BandwidthLimiter, Throttle, TokenBucket
+from umake.network.download_center import DownloadCancelled, DownloadCenter, DownloadItem
+from umake.network.download_scheduler import DownloadScheduler
+from umake.network.mirrors import MirrorSelector
+from umake.network.page_cache import PageCache
+from umake.network.partial_download import PartialDownload
+from umake.network.request_coalescer import RequestCoalescer
+from umake.network.retry import DownloadStalled, RetryPolicy, RetryStats, StallDetector
+from umake.network.session_pool import SessionPool
+from umake.network.spooled_buffer import SpooledBuffer
+from umake.settings import DEFAULT_CONNECTION_POOL_SIZE
+from umake.tools import ChecksumType, Checksum, Singleton
 
 
 class TestDownloadCenter(LoggedTestCase):
@@ -50,11 +69,19 @@ class TestDownloadCenter(LoggedTestCase):
         super().setUp()
         self.callback = Mock()
         self.fd_to_close = []
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        Singleton._instances.pop(MirrorSelector, None)
+        Singleton._instances.pop(RequestCoalescer, None)
+        Singleton._instances.pop(RetryStats, None)
+        Singleton._instances.pop(BandwidthLimiter, None)
 
     def tearDown(self):
         super().tearDown()
         for fd in self.fd_to_close:
             fd.close()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
 
     def build_server_address(self, path, localhost=False):
         """build server address to path to get requested"""
@@ -147,6 +174,71 @@ class TestDownloadCenter(LoggedTestCase):
         self.assertEqual(self.callback.call_count, 1)
         self.assertEqual('6', result.cookies['int'])
 
+    def test_cookies_not_shared_between_requests(self):
+        """Cookies of one request don't leak into the pooled session used by the next ones"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        DownloadCenter([DownloadItem(url, None, cookies={'int': '5'})], self.callback)
+        self.wait_for_callback(self.callback)
+        self.callback = Mock()
+
+        DownloadCenter([DownloadItem(url, None)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertNotIn('int', result.cookies)
+
+    def test_session_shared_per_host(self):
+        """Every request to the same host uses the same pooled session"""
+        session = SessionPool().get(self.build_server_address("simplefile"))
+        self.assertIs(session, SessionPool().get(self.build_server_address("biggerfile")))
+        self.assertIsNot(session, SessionPool().get(self.build_server_address("simplefile").replace("http", "ftp")))
+
+    def test_only_file_sessions_read_local_files(self):
+        """Sessions for remote hosts can't be redirected to local files"""
+        with self.assertRaises(requests.exceptions.InvalidSchema):
+            SessionPool().get(self.build_server_address("simplefile")).get_adapter("file:///etc/passwd")
+        self.assertIsNotNone(SessionPool().get("file:///etc/passwd").get_adapter("file:///etc/passwd"))
+
+    def test_warm_up_connections(self):
+        """Warming up sends a HEAD request to each host through its pooled session"""
+        Singleton._instances.pop(SessionPool, None)
+        url = self.build_server_address("simplefile")
+        with patch.object(requests.Session, "head", autospec=True) as head:
+            futures.wait(SessionPool().warm_up([url, self.build_server_address("biggerfile"), None,
+                                                "file:///etc/passwd"]))
+
+        self.assertEqual(head.call_count, 1)
+        session, head_url = head.call_args[0]
+        self.assertIs(session, SessionPool().get(url))
+        self.assertEqual(head_url, url)
+        self.assertEqual(head.call_args[1]["timeout"], SessionPool().connect_timeout)
+        SessionPool().close()
+
+    def test_invalid_pool_size(self):
+        """An invalid pool size in the configuration falls back to the default one"""
+        Singleton._instances.pop(SessionPool, None)
+        with patch("umake.network.get_network_setting",
+                   side_effect=lambda name, default=None: "foo" if name == "pool_size" else default):
+            self.assertEqual(SessionPool().pool_size, DEFAULT_CONNECTION_POOL_SIZE)
+        Singleton._instances.pop(SessionPool, None)
+        self.expect_warn_error = True
+
+    def test_warm_up_connections_failure(self):
+        """Failing to connect while warming up isn't an error"""
+        Singleton._instances.pop(SessionPool, None)
+        url = "http://localhost:1/simplefile"
+        for future in futures.wait(SessionPool().warm_up([url]))[0]:
+            self.assertIsNone(future.exception())
+
+    def test_warm_up_connections_disabled(self):
+        """No connection is made when warm up is disabled"""
+        Singleton._instances.pop(SessionPool, None)
+        with patch("umake.network.session_pool.get_network_setting",
+                   side_effect=lambda name, default: False if name == "warm_up_connections" else default):
+            self.assertEqual(SessionPool().warm_up([self.build_server_address("simplefile")]), [])
+        Singleton._instances.pop(SessionPool, None)
+
     def test_content_encoding(self):
         """Ensure we perform (or don't) content decoding properly."""
 
@@ -291,6 +383,42 @@ class TestDownloadCenter(LoggedTestCase):
                                                                       'current': dl_center.BLOCK_SIZE}}),
                           call({self.build_server_address(filename): {'size': filesize, 'current': filesize}})])
 
+    def test_chunks_grow_on_fast_connections(self):
+        """we read bigger chunks, up to a limit, when the connection is fast"""
+        content = os.urandom(DownloadCenter.MAX_BLOCK_SIZE * 3)
+        r = Mock()
+        r.raw = BytesIO(content)
+        chunk_sizes = []
+        result = BytesIO()
+        for chunk in DownloadCenter([], Mock())._read_chunks(r, decode_content=True, throttle=Throttle([])):
+            chunk_sizes.append(len(chunk))
+            result.write(chunk)
+
+        self.assertEqual(result.getvalue(), content)
+        self.assertEqual(chunk_sizes[0], DownloadCenter.BLOCK_SIZE)
+        self.assertEqual(max(chunk_sizes), DownloadCenter.MAX_BLOCK_SIZE)
+        self.assertEqual(chunk_sizes[:-1], sorted(chunk_sizes[:-1]))
+
+    def test_throttled_chunks_capped(self):
+        """we read chunks of what a throttled download may receive in TARGET_READ_TIME"""
+        content = os.urandom(DownloadCenter.BLOCK_SIZE * 4)
+        r = Mock()
+        r.raw = BytesIO(content)
+        throttle = Throttle([TokenBucket(20480)])
+        with patch("umake.network.bandwidth.time.sleep"):
+            chunks = DownloadCenter([], Mock())._read_chunks(r, decode_content=True, throttle=throttle)
+            chunk_sizes = [len(chunk) for chunk in chunks]
+        self.assertEqual(max(chunk_sizes), 2048)
+
+    def test_one_throttle_per_download(self):
+        """all the transfers of a download share the same bandwidth limits"""
+        BandwidthLimiter().per_download_rate = 1024
+        download_center = DownloadCenter([], Mock())
+        item = DownloadItem("http://foo/bar")
+        self.assertIs(download_center._throttle_for(item), download_center._throttle_for(DownloadItem(item.url)))
+        self.assertIsNot(download_center._throttle_for(item),
+                         download_center._throttle_for(DownloadItem("http://foo/baz")))
+
     def test_multiple_downloads(self):
         """we deliver more than on download in parallel"""
         requests = [DownloadItem(self.build_server_address("biggerfile"), None),
@@ -330,6 +458,342 @@ class TestDownloadCenter(LoggedTestCase):
                                                                 'current': file_size}
         self.assertEqual(report.call_args, call(result_dict))
 
+    def test_segmented_download(self):
+        """we download big files in multiple ranges when the server supports it"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        url = self.build_server_address(filename)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            content = file_on_disk.read()
+        report = CopyingMock()
+        with patchelem(DownloadCenter, "SEGMENTED_DOWNLOAD_MIN_SIZE", 1024), \
+                patchelem(DownloadCenter, "SEGMENT_MIN_SIZE", 2048):
+            DownloadCenter([DownloadItem(url, Checksum(ChecksumType.md5, hashlib.md5(content).hexdigest()))],
+                           self.callback, report=report)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), content)
+        self.assertEqual(report.call_args, call({url: {'size': filesize, 'current': filesize}}))
+
+    def test_segmented_download_fallback(self):
+        """we fallback to a single stream if the server doesn't honor ranges it advertises"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        with patchelem(DownloadCenter, "SEGMENTED_DOWNLOAD_MIN_SIZE", 1024), \
+                patchelem(DownloadCenter, "SEGMENT_MIN_SIZE", 2048), \
+                patchelem(RequestHandler, "honor_ranges", False):
+            DownloadCenter([DownloadItem(url, None)], self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+
+    def test_download_to_consumer(self):
+        """we forward the downloaded content in order to its consumer"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        consumer = BytesIO()
+        consumer.discard = Mock()
+        DownloadCenter([DownloadItem(url, None)], self.callback, consumers={url: consumer})
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(consumer.getvalue(), result.fd.read())
+        self.assertFalse(consumer.discard.called)
+
+    def test_segmented_download_to_consumer(self):
+        """we forward the content of segmented downloads in order to its consumer"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            content = file_on_disk.read()
+        consumer = BytesIO()
+        consumer.discard = Mock()
+        with patchelem(DownloadCenter, "SEGMENTED_DOWNLOAD_MIN_SIZE", 1024), \
+                patchelem(DownloadCenter, "SEGMENT_MIN_SIZE", 2048):
+            DownloadCenter([DownloadItem(url, None)], self.callback, consumers={url: consumer})
+            self.wait_for_callback(self.callback)
+
+        self.assertIsNone(self.callback.call_args[0][0][url].error)
+        self.assertEqual(consumer.getvalue(), content)
+
+    def test_identical_requests_coalesced(self):
+        """we do only one transfer for identical concurrent requests, each caller getting its own file"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        other_callback = Mock()
+        all_submitted = Event()
+        fetch_content = DownloadCenter._fetch
+
+        def fetch_once_all_submitted(*args):
+            all_submitted.wait(5)
+            return fetch_content(*args)
+
+        with patch.object(DownloadCenter, "_fetch", side_effect=fetch_once_all_submitted, autospec=True) as fetch:
+            DownloadCenter([DownloadItem(url, None)], self.callback)
+            DownloadCenter([DownloadItem(url, None)], other_callback)
+            all_submitted.set()
+            self.wait_for_callback(self.callback)
+            self.wait_for_callback(other_callback)
+
+        self.assertEqual(fetch.call_count, 1)
+        result = self.callback.call_args[0][0][url]
+        other_result = other_callback.call_args[0][0][url]
+        self.assertNotEqual(result.fd.name, other_result.fd.name)
+        result.fd.close()
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), other_result.fd.read())
+
+    def test_in_memory_response_memoized(self):
+        """we reuse in memory responses for the rest of the process, with independent read cursors"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        DownloadCenter([DownloadItem(url, None)], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+        other_callback = Mock()
+        with patch.object(SessionPool, "get") as session_get:
+            DownloadCenter([DownloadItem(url, None)], other_callback, download=False)
+            self.wait_for_callback(other_callback)
+
+        self.assertFalse(session_get.called)
+        result = self.callback.call_args[0][0][url]
+        other_result = other_callback.call_args[0][0][url]
+        self.assertEqual(result.buffer.read(), other_result.buffer.read())
+        self.assertEqual(other_result.final_url, url)
+        other_result.buffer.seek(0)
+        self.assertEqual(result.buffer.read(), b"")
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), other_result.buffer.read())
+
+    def test_different_requests_not_coalesced(self):
+        """we don't share responses between requests with different headers"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        DownloadCenter([DownloadItem(url, None)], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+        other_callback = Mock()
+        with patch.object(DownloadCenter, "_fetch", side_effect=DownloadCenter._fetch, autospec=True) as fetch:
+            DownloadCenter([DownloadItem(url, None, headers={"Foo": "bar"})], other_callback, download=False)
+            self.wait_for_callback(other_callback)
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertIsNone(other_callback.call_args[0][0][url].error)
+
+    def test_failed_request_not_memoized(self):
+        """we retry requests which failed"""
+        self.expect_warn_error = True
+        url = self.build_server_address("does_not_exist")
+        DownloadCenter([DownloadItem(url, None)], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+        other_callback = Mock()
+        with patch.object(DownloadCenter, "_fetch", side_effect=DownloadCenter._fetch, autospec=True) as fetch:
+            DownloadCenter([DownloadItem(url, None)], other_callback, download=False)
+            self.wait_for_callback(other_callback)
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertIsNotNone(other_callback.call_args[0][0][url].error)
+
+    def test_in_memory_download_spilled_to_disk(self):
+        """we move big in memory downloads to disk, keeping the buffer API"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        spooled_buffer_init = SpooledBuffer.__init__
+        with patch.object(SpooledBuffer, "__init__", autospec=True,
+                          side_effect=lambda buffer, max_size=None: spooled_buffer_init(buffer, 1024)):
+            DownloadCenter([DownloadItem(url, None)], self.callback, download=False)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertFalse(result.buffer.in_memory)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            content = file_on_disk.read()
+        self.assertEqual(result.buffer.getvalue(), content)
+        self.assertEqual(result.buffer.read(), content)
+        self.assertIsNone(PageCache().get(DownloadItem(url, None)))
+
+    def test_scraped_in_memory_download(self):
+        """we feed the in memory download content to its scraper"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        scraper = BytesIO()
+        scraper.done = False
+        scraper.close = Mock()
+        DownloadCenter([DownloadItem(url, None)], self.callback, download=False, scrapers={url: scraper})
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(scraper.getvalue(), result.buffer.getvalue())
+        self.assertTrue(scraper.close.called)
+
+    def test_scraped_in_memory_download_stops_early(self):
+        """we stop downloading a page once its scraper has everything it needs, and don't cache it"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            content = file_on_disk.read()
+        scraper = Mock()
+        scraper.done = True
+        with patchelem(RequestHandler, "send_validators", False):
+            DownloadCenter([DownloadItem(url, None)], self.callback, download=False, scrapers={url: scraper})
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(scraper.write.call_count, 1)
+        self.assertTrue(scraper.close.called)
+        self.assertLess(len(result.buffer.getvalue()), len(content))
+        self.assertTrue(content.startswith(result.buffer.getvalue()))
+        self.assertIsNone(PageCache().get(DownloadItem(url, None)))
+
+    def test_scraped_in_memory_download_cached_then_revalidated(self):
+        """we get a scraped page whole to cache it, then only revalidate it"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            content = file_on_disk.read()
+        scraper = Mock()
+        scraper.done = True
+        DownloadCenter([DownloadItem(url, None)], self.callback, download=False, scrapers={url: scraper})
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(scraper.write.call_count, 1)
+        self.assertEqual(result.buffer.getvalue(), content)
+        self.assertEqual(PageCache().get(DownloadItem(url, None)).content, content)
+
+        other_callback = Mock()
+        other_scraper = Mock()
+        other_scraper.done = False
+        with patch.object(DownloadCenter, "_write_cached_page", side_effect=DownloadCenter._write_cached_page) \
+                as write_cached_page:
+            DownloadCenter([DownloadItem(url, None)], other_callback, download=False, scrapers={url: other_scraper})
+            self.wait_for_callback(other_callback)
+
+        result = other_callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertTrue(write_cached_page.called)
+        other_scraper.write.assert_called_once_with(content)
+        self.assertEqual(result.buffer.getvalue(), content)
+
+    def test_in_memory_download_retried(self):
+        """we retry in memory downloads failing on network errors"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        session_get = requests.Session.get
+        calls = []
+
+        def fail_once(session, *args, **kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                raise requests.exceptions.ConnectionError("Connection reset")
+            return session_get(session, *args, **kwargs)
+
+        with patch.object(requests.Session, "get", autospec=True, side_effect=fail_once), \
+                patch.object(RetryPolicy, "delay", return_value=0):
+            DownloadCenter([DownloadItem(url, None)], self.callback, download=False)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.buffer.read())
+        self.assertEqual(len(calls), 2)
+        self.assertIsNotNone(calls[0]["timeout"])
+        self.assertEqual(RetryStats().per_host(), {"localhost:9876": 1})
+
+    def test_stalled_download_resumed(self):
+        """we abort a stalled download and resume it from the last byte written"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            content = file_on_disk.read()
+        stall_detector_update = StallDetector.update
+        updates = []
+
+        def stall_once(detector, size, throttled=0):
+            updates.append(size)
+            if len(updates) == 2:
+                raise DownloadStalled("Transfer stalled")
+            stall_detector_update(detector, size, throttled)
+
+        with patch.object(StallDetector, "update", autospec=True, side_effect=stall_once), \
+                patch.object(RetryPolicy, "delay", return_value=0), \
+                patch.object(PartialDownload, "reset", autospec=True, side_effect=PartialDownload.reset) as reset:
+            DownloadCenter([DownloadItem(url, Checksum(ChecksumType.md5, hashlib.md5(content).hexdigest()))],
+                           self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), content)
+        # we only started from scratch once
+        self.assertEqual(reset.call_count, 1)
+        self.assertEqual(updates[2], len(content) - updates[0])
+
+    def test_client_error_not_retried(self):
+        """we don't retry requests the server refused"""
+        self.expect_warn_error = True
+        url = self.build_server_address("does_not_exist")
+        with patch.object(RetryPolicy, "wait_before_retry") as wait_before_retry:
+            DownloadCenter([DownloadItem(url, None)], self.callback)
+            self.wait_for_callback(self.callback)
+
+        self.assertIsNotNone(self.callback.call_args[0][0][url].error)
+        self.assertFalse(wait_before_retry.called)
+
+    def test_download_with_limited_rate(self):
+        """we slow down downloads to the bandwidth limit"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        BandwidthLimiter().set_rate(4096)
+        with patch("umake.network.bandwidth.time.sleep") as sleep:
+            DownloadCenter([DownloadItem(url, None)], self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+        # we got 9000 bytes with a burst of 4096 at 4096 bytes/s. The last chunk waits for all the previous debt
+        self.assertAlmostEqual(sleep.call_args[0][0], (9000 - 4096) / 4096, places=1)
+
+    def test_cancel_download(self):
+        """we stop and discard cancelled downloads"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        stall_detector_update = StallDetector.update
+        download_center = None
+
+        def cancel_on_first_chunk(detector, size, throttled=0):
+            download_center.cancel()
+            stall_detector_update(detector, size, throttled)
+
+        with patch.object(StallDetector, "update", autospec=True, side_effect=cancel_on_first_chunk):
+            download_center = DownloadCenter([DownloadItem(url, None)], self.callback)
+            self.wait_for_callback(self.callback)
+
+        self.assertIn("cancelled", self.callback.call_args[0][0][url].error)
+        partial = PartialDownload(url, None)
+        self.assertFalse(os.path.exists(partial.part_path))
+        self.assertFalse(os.path.exists(partial.state_path))
+
+    def test_cancel_pending_download(self):
+        """we don't start downloads cancelled before they are scheduled"""
+        url = self.build_server_address("simplefile")
+        with patch.object(DownloadScheduler, "submit", return_value=futures.Future()) as submit:
+            download_center = DownloadCenter([DownloadItem(url, None)], self.callback)
+        download_center.cancel()
+        fetch = submit.call_args[0][2]
+        self.assertRaises(DownloadCancelled, fetch, *submit.call_args[0][3:])
+
     def test_404_url(self):
         """we return an error for a request including a 404 url"""
         request = DownloadItem(self.build_server_address("does_not_exist"), None)
@@ -431,7 +895,7 @@ class TestDownloadCenter(LoggedTestCase):
         self.expect_warn_error = True
 
     def test_download_with_no_size(self):
-        """we deliver one successful download, even if size isn't provided. Progress returns -1 though"""
+        """we deliver one successful download, even if size isn't provided. Progress size returns -1 though"""
         filename = "simplefile-with-no-content-length"
         url = self.build_server_address(filename)
         request = DownloadItem(url, None)
@@ -450,7 +914,9 @@ class TestDownloadCenter(LoggedTestCase):
         self.assertEqual(report.call_count, 2)
         self.assertEqual(report.call_args_list,
                          [call({self.build_server_address(filename): {'size': -1, 'current': 0}}),
-                          call({self.build_server_address(filename): {'size': -1, 'current': 8192}})])
+                          call({self.build_server_address(filename): {'size': -1,
+                                                                      'current': getsize(join(self.server_dir,
+                                                                                              filename))}})])
 
     def test_download_with_wrong_checksumtype(self):
         """we raise an error if we don't have a support checksum type"""
@@ -468,6 +934,237 @@ class TestDownloadCenter(LoggedTestCase):
         self.assertIsNone(result.fd)
         self.expect_warn_error = True
 
+    def test_download_is_resumed(self):
+        """we only fetch what's missing from a previously interrupted download"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        with open(join(self.server_dir, filename), 'rb') as f:
+            content = f.read()
+        checksum = Checksum(ChecksumType.md5, hashlib.md5(content).hexdigest())
+
+        # simulate a previous run interrupted in the middle of the download
+        with closing(requests.get(url)) as r:
+            headers = r.headers
+        partial = PartialDownload(url, checksum)
+        partial.reset(headers, [(0, len(content) - 1)], resumable=True)
+        with partial.open_segment(0) as f:
+            f.write(content[:len(content) // 2])
+
+        report = CopyingMock()
+        with patchelem(RequestHandler, "honor_ranges", True):
+            DownloadCenter([DownloadItem(url, checksum)], self.callback, report=report)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), content)
+        # first report already takes what was downloaded into account
+        self.assertEqual(report.call_args_list[0][0][0][url]["current"], len(content) // 2)
+        self.assertFalse(os.path.exists(partial.part_path))
+        self.assertFalse(os.path.exists(partial.state_path))
+
+    def test_download_restarted_if_content_changed(self):
+        """we restart from scratch a previous download if the file changed on the server"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        with open(join(self.server_dir, filename), 'rb') as f:
+            content = f.read()
+
+        with closing(requests.get(url)) as r:
+            headers = dict(r.headers)
+        headers["last-modified"] = "Thu, 01 Jan 1970 00:00:00 GMT"
+        partial = PartialDownload(url, None)
+        partial.reset(headers, [(0, len(content) - 1)], resumable=True)
+        with partial.open_segment(0) as f:
+            f.write(b"A" * (len(content) // 2))
+
+        DownloadCenter([DownloadItem(url, None)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), content)
+
+    def test_corrupted_download_is_not_kept(self):
+        """a corrupted download is removed, so that we don't resume it"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        checksum = Checksum(ChecksumType.md5, 'AAAAA')
+        DownloadCenter([DownloadItem(url, checksum)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        self.assertIn("Corrupted download", self.callback.call_args[0][0][url].error)
+        partial = PartialDownload(url, checksum)
+        self.assertFalse(os.path.exists(partial.part_path))
+        self.assertFalse(os.path.exists(partial.state_path))
+        self.expect_warn_error = True
+
+    def test_download_from_cache(self):
+        """we don't hit the network if the file with that checksum is in cache"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        with open(join(self.server_dir, filename), 'rb') as f:
+            content = f.read()
+        checksum = Checksum(ChecksumType.md5, hashlib.md5(content).hexdigest())
+        DownloadCenter([DownloadItem(url, checksum)], self.callback)
+        self.wait_for_callback(self.callback)
+        self.assertIsNone(self.callback.call_args[0][0][url].error)
+
+        callback = Mock()
+        request = DownloadItem(self.build_server_address("does_not_exist"), checksum)
+        DownloadCenter([request], callback)
+        self.wait_for_callback(callback)
+
+        result = callback.call_args[0][0][request.url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), content)
+
+    def test_forget_download(self):
+        """we leave nothing in the cache for downloads we forget"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        with open(join(self.server_dir, filename), 'rb') as f:
+            checksum = Checksum(ChecksumType.md5, hashlib.md5(f.read()).hexdigest())
+        download_center = DownloadCenter([DownloadItem(url, checksum)], self.callback)
+        self.wait_for_callback(self.callback)
+        self.callback.call_args[0][0][url].fd.close()
+        self.assertTrue(ArtifactCache().entries())
+
+        download_center.forget()
+        self.assertEqual([files for (root, dirs, files) in os.walk(self.cache_dir) if files], [])
+
+    def test_download_by_other_process(self):
+        """we wait for another process downloading the same file and reuse it from the cache"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        with open(join(self.server_dir, filename), 'rb') as f:
+            content = f.read()
+        checksum = Checksum(ChecksumType.md5, hashlib.md5(content).hexdigest())
+        other_download = PartialDownload(url, checksum)
+        other_download.lock()
+
+        with patchelem(PartialDownload, "LOCK_POLL_INTERVAL", 0.01), patch.object(SessionPool, "get") as session_get:
+            DownloadCenter([DownloadItem(url, checksum)], self.callback)
+            cached_path = join(self.cache_dir, "other-download")
+            shutil.copyfile(join(self.server_dir, filename), cached_path)
+            ArtifactCache().add(ArtifactCache.key_for(DownloadItem(url, checksum)), cached_path, url)
+            other_download.unlock()
+            self.wait_for_callback(self.callback)
+
+        self.assertFalse(session_get.called)
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), content)
+
+    def test_cancel_while_waiting_for_other_process(self):
+        """we stop waiting for another process downloading the same file once cancelled, without touching its state"""
+        url = self.build_server_address("simplefile")
+        other_download = PartialDownload(url, None)
+        other_download.lock()
+        other_download.reset({}, [(0, None)], resumable=False)
+
+        download_centers = []
+
+        def cancel_on_report(progress):
+            if download_centers:
+                download_centers[0].cancel()
+
+        with patchelem(PartialDownload, "LOCK_POLL_INTERVAL", 0.01):
+            # cancel once we report the progress of the download we wait for
+            download_centers.append(DownloadCenter([DownloadItem(url, None)], self.callback, report=cancel_on_report))
+            self.wait_for_callback(self.callback)
+
+        self.assertIn("cancelled", self.callback.call_args[0][0][url].error)
+        self.assertTrue(os.path.exists(other_download.part_path))
+        self.assertTrue(os.path.exists(other_download.lock_path))
+        other_download.unlock()
+
+    def test_download_from_cache_by_etag(self):
+        """we use the cached file if the server sends the same etag"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        request = DownloadItem(url + "-setheaders?ETag=1234")
+        with open(join(self.server_dir, filename), 'rb') as f:
+            content = f.read()
+        DownloadCenter([request], self.callback)
+        self.wait_for_callback(self.callback)
+
+        with patch.object(DownloadCenter, "_stream_to") as stream_to:
+            callback = Mock()
+            DownloadCenter([request], callback)
+            self.wait_for_callback(callback)
+            self.assertFalse(stream_to.called)
+
+        result = callback.call_args[0][0][request.url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), content)
+
+    def test_in_memory_download_revalidated(self):
+        """we reuse the previous page content if the server tells us it didn't change"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        request = DownloadItem(url, None)
+        DownloadCenter([request], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+
+        with patch.object(DownloadCenter, "_stream_to") as stream_to:
+            callback = Mock()
+            DownloadCenter([request], callback, download=False)
+            self.wait_for_callback(callback)
+            self.assertFalse(stream_to.called)
+
+        result = callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.buffer.read())
+
+    def test_in_memory_download_not_cached_without_validators(self):
+        """we don't keep pages we won't be able to revalidate"""
+        request = DownloadItem(self.build_server_address("simplefile"), None)
+        PageCache().store(request, {}, b"content")
+        self.assertIsNone(PageCache().get(request))
+        PageCache().store(request, {"etag": "1234"}, b"content")
+        self.assertEqual(PageCache().get(request).content, b"content")
+
+    def test_download_from_mirror(self):
+        """we download from the next mirror if one fails"""
+        filename = "simplefile"
+        url = self.build_server_address("does_not_exist")
+        with open(join(self.server_dir, filename), 'rb') as f:
+            content = f.read()
+        checksum = Checksum(ChecksumType.md5, hashlib.md5(content).hexdigest())
+        DownloadCenter([DownloadItem(url, checksum, mirrors=[self.build_server_address(filename)])], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), content)
+
+    def test_download_from_mirror_records_latency(self):
+        """A successful download records a new latency for its host"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        with open(join(self.server_dir, filename), 'rb') as f:
+            content = f.read()
+        checksum = Checksum(ChecksumType.md5, hashlib.md5(content).hexdigest())
+        host = MirrorSelector._host(url)
+        MirrorSelector().record(url, latency=MirrorSelector.FAILURE_LATENCY)
+        MirrorSelector().record("http://mirror.invalid/", latency=MirrorSelector.FAILURE_LATENCY * 2)
+        DownloadCenter([DownloadItem(url, checksum, mirrors=["http://mirror.invalid/" + filename])], self.callback)
+        self.wait_for_callback(self.callback)
+
+        self.assertIsNone(self.callback.call_args[0][0][url].error)
+        self.assertLess(MirrorSelector()._stats[host]["latency"], MirrorSelector.FAILURE_LATENCY)
+
+    def test_no_mirror_without_checksum(self):
+        """we can't trust mirrors without checksum"""
+        url = self.build_server_address("does_not_exist")
+        DownloadCenter([DownloadItem(url, None, mirrors=[self.build_server_address("simplefile")])], self.callback)
+        self.wait_for_callback(self.callback)
+
+        self.assertIn("404", self.callback.call_args[0][0][url].error)
+        self.expect_warn_error = True
+
 
 class TestDownloadCenterSecure(LoggedTestCase):
     """This will test the download center in secure mode by sending one or more download requests"""
@@ -489,11 +1186,19 @@ class TestDownloadCenterSecure(LoggedTestCase):
         super().setUp()
         self.callback = Mock()
         self.fd_to_close = []
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        Singleton._instances.pop(MirrorSelector, None)
+        Singleton._instances.pop(RequestCoalescer, None)
+        Singleton._instances.pop(RetryStats, None)
+        Singleton._instances.pop(BandwidthLimiter, None)
 
     def tearDown(self):
         super().tearDown()
         for fd in self.fd_to_close:
             fd.close()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
 
     def test_download(self):
         """we deliver one successful download under ssl with known cert"""
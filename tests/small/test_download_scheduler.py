@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the process wide download scheduler"""
+
+from concurrent import futures
+from threading import Event, Lock
+from ..tools import LoggedTestCase
+from umake.network.download_scheduler import DownloadScheduler
+from umake.tools import Singleton
+
+
+class TestDownloadScheduler(LoggedTestCase):
+    """This will test scheduling of tasks with limits and priorities"""
+
+    def setUp(self):
+        super().setUp()
+        Singleton._instances.pop(DownloadScheduler, None)
+        self.scheduler = DownloadScheduler()
+        self.scheduler.max_connections = 2
+        self.scheduler.max_connections_per_host = 1
+        self.running = []
+        self.max_running = 0
+        self.started = []
+        self.lock = Lock()
+        self.release = Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.scheduler.shutdown()
+        Singleton._instances.pop(DownloadScheduler, None)
+        super().tearDown()
+
+    def task(self, name):
+        """Record that name started, and block until we release tasks"""
+        with self.lock:
+            self.started.append(name)
+            self.running.append(name)
+            self.max_running = max(self.max_running, len(self.running))
+        self.release.wait(5)
+        with self.lock:
+            self.running.remove(name)
+        return name
+
+    def test_result(self):
+        """We get the function result in the future"""
+        future = self.scheduler.submit("http://foo/bar", DownloadScheduler.PRIORITY_BULK, lambda x: x * 2, 21)
+        self.assertEqual(future.result(5), 42)
+
+    def test_exception(self):
+        """We get the function exception in the future"""
+        def raise_exception():
+            raise BaseException("foo")
+        future = self.scheduler.submit("http://foo/bar", DownloadScheduler.PRIORITY_BULK, raise_exception)
+        self.assertEqual(str(future.exception(5)), "foo")
+
+    def test_per_host_limit(self):
+        """We don't run more tasks than the per host limit against the same host"""
+        tasks = [self.scheduler.submit("http://foo/{}".format(i), DownloadScheduler.PRIORITY_BULK, self.task, i)
+                 for i in range(3)]
+        tasks.append(self.scheduler.submit("http://bar/", DownloadScheduler.PRIORITY_BULK, self.task, "bar"))
+        futures.wait(tasks, timeout=0.5)
+        self.assertEqual(sorted(self.running, key=str), [0, "bar"])
+
+        self.release.set()
+        futures.wait(tasks, timeout=5)
+        self.assertEqual([task.result() for task in tasks], [0, 1, 2, "bar"])
+
+    def test_global_limit(self):
+        """We don't run more tasks than the global limit"""
+        self.scheduler.max_connections_per_host = 10
+        tasks = [self.scheduler.submit("http://foo/{}".format(i), DownloadScheduler.PRIORITY_BULK, self.task, i)
+                 for i in range(5)]
+        futures.wait(tasks, timeout=0.5)
+        self.assertEqual(len(self.running), 2)
+
+        self.release.set()
+        futures.wait(tasks, timeout=5)
+        self.assertEqual(self.max_running, 2)
+        self.assertEqual(sorted(self.started), [0, 1, 2, 3, 4])
+
+    def test_burst_with_idle_worker(self):
+        """A burst of tasks starts enough workers even if one is idle"""
+        self.scheduler.max_connections = 3
+        self.scheduler.max_connections_per_host = 3
+        # leave one idle worker
+        self.scheduler.submit("http://foo/", DownloadScheduler.PRIORITY_BULK, lambda: None).result(5)
+        tasks = [self.scheduler.submit("http://foo/{}".format(i), DownloadScheduler.PRIORITY_BULK, self.task, i)
+                 for i in range(3)]
+        futures.wait(tasks, timeout=0.5)
+        self.assertEqual(sorted(self.running), [0, 1, 2])
+
+    def test_subtasks_of_task_at_limits(self):
+        """Tasks submitted by a running task can run while it waits for them, even with it at the limits"""
+        self.scheduler.max_connections = 1
+
+        def parent():
+            with self.scheduler.waiting_for_subtasks():
+                subtasks = [self.scheduler.submit("http://foo/", DownloadScheduler.PRIORITY_BULK, lambda x: x, i)
+                            for i in range(2)]
+                return [subtask.result(5) for subtask in subtasks]
+
+        future = self.scheduler.submit("http://foo/", DownloadScheduler.PRIORITY_BULK, parent)
+        self.assertEqual(future.result(5), [0, 1])
+
+    def test_priority(self):
+        """Pending tasks with a lower priority value are run first"""
+        self.scheduler.max_connections = 1
+        tasks = [self.scheduler.submit("http://foo/", DownloadScheduler.PRIORITY_BULK, self.task, "first")]
+        futures.wait(tasks, timeout=0.2)
+        tasks.append(self.scheduler.submit("http://foo/", DownloadScheduler.PRIORITY_BULK, self.task, "bulk"))
+        tasks.append(self.scheduler.submit("http://foo/", DownloadScheduler.PRIORITY_METADATA, self.task, "page"))
+
+        self.release.set()
+        futures.wait(tasks, timeout=5)
+        self.assertEqual(self.started, ["first", "page", "bulk"])
+
+    def test_shutdown_cancels_pending_tasks(self):
+        """Pending tasks are cancelled on shutdown and we can't submit new ones"""
+        self.scheduler.max_connections = 1
+        running = self.scheduler.submit("http://foo/", DownloadScheduler.PRIORITY_BULK, self.task, "running")
+        futures.wait([running], timeout=0.2)
+        pending = self.scheduler.submit("http://foo/", DownloadScheduler.PRIORITY_BULK, self.task, "pending")
+        self.scheduler.shutdown()
+        self.release.set()
+
+        self.assertEqual(running.result(5), "running")
+        self.assertTrue(pending.cancelled())
+        with self.assertRaises(RuntimeError):
+            self.scheduler.submit("http://foo/", DownloadScheduler.PRIORITY_BULK, self.task, "new")
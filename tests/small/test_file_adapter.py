@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Tests for the file adapter"""
+
+import errno
+import hashlib
+import os
+from os.path import join
+import requests
+import shutil
+import tempfile
+from time import time
+from unittest.mock import Mock, patch
+from ..tools import change_xdg_path, CopyingMock, LoggedTestCase, patchelem
+from umake.network.bandwidth import BandwidthLimiter
+from umake.network.download_center import DownloadCenter, DownloadItem
+from umake.network.file_adapter import FileAdapter
+from umake.network.mirrors import MirrorSelector
+from umake.network.request_coalescer import RequestCoalescer
+from umake.network.retry import RetryStats
+from umake.tools import ChecksumType, Checksum, Singleton
+
+
+class TestFileAdapter(LoggedTestCase):
+    """This will test the file adapter by requesting local files"""
+
+    def setUp(self):
+        super().setUp()
+        self.session = requests.Session()
+        self.session.mount('file://', FileAdapter())
+        self.server_dir = tempfile.mkdtemp()
+        self.content = os.urandom(9000)
+        self.path = join(self.server_dir, "some file")
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+        self.url = "file://" + self.path.replace(" ", "%20")
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.server_dir)
+        super().tearDown()
+
+    def get(self, url, headers=None):
+        r = self.session.get(url, stream=True, headers=headers)
+        self.addCleanup(r.close)
+        return r
+
+    def test_download(self):
+        """We read a whole file, advertising ranges support, its size and modification time"""
+        r = self.get(self.url)
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, self.content)
+        self.assertEqual(r.headers['content-length'], str(len(self.content)))
+        self.assertEqual(r.headers['accept-ranges'], 'bytes')
+        self.assertIn('GMT', r.headers['last-modified'])
+
+    def test_download_not_streamed(self):
+        """We read a whole file without streaming it"""
+        self.assertEqual(self.session.get(self.url).content, self.content)
+
+    def test_localhost(self):
+        """We read files from localhost"""
+        self.assertEqual(self.get(self.url.replace("file://", "file://localhost")).content, self.content)
+
+    def test_remote_host(self):
+        """We refuse files on other hosts"""
+        self.assertRaises(requests.exceptions.InvalidURL, self.get, self.url.replace("file://", "file://otherhost"))
+
+    def test_readinto(self):
+        """The raw stream reads into our buffers"""
+        r = self.get(self.url)
+        buffer = bytearray(len(self.content) + 10)
+        size = 0
+        while True:
+            read_size = r.raw.readinto(memoryview(buffer)[size:size + 1000])
+            if not read_size:
+                break
+            size += read_size
+
+        self.assertEqual(buffer[:size], self.content)
+        self.assertTrue(r.raw.closed)
+
+    def test_404(self):
+        """A missing file returns a 404"""
+        r = self.get(self.url + "-missing")
+
+        self.assertEqual(r.status_code, 404)
+        self.assertRaises(requests.exceptions.HTTPError, r.raise_for_status)
+
+    def test_directory(self):
+        """A directory returns a 404"""
+        self.assertEqual(self.get("file://" + self.server_dir).status_code, 404)
+
+    def test_range(self):
+        """A requested range is read from its offset"""
+        r = self.get(self.url, headers={"Range": "bytes=1000-1999"})
+
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.headers['content-range'], "bytes 1000-1999/{}".format(len(self.content)))
+        self.assertEqual(r.headers['content-length'], "1000")
+        self.assertEqual(r.content, self.content[1000:2000])
+
+    def test_open_range(self):
+        """A range without end is read up to the end of the file"""
+        r = self.get(self.url, headers={"Range": "bytes=8000-"})
+
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, self.content[8000:])
+
+    def test_unsatisfiable_range(self):
+        """A range starting after the end of the file returns a 416"""
+        self.assertEqual(self.get(self.url, headers={"Range": "bytes=10000-"}).status_code, 416)
+
+    def test_truncated_file(self):
+        """A file truncated while we read it is a connection error"""
+        r = self.get(self.url)
+        os.truncate(self.path, 1000)
+
+        self.assertEqual(r.raw.read(), self.content[:1000])
+        self.assertRaises(requests.exceptions.ConnectionError, r.raw.read)
+
+
+class TestFileDownloadCenter(LoggedTestCase):
+    """This will test the download center with local files"""
+
+    def setUp(self):
+        super().setUp()
+        self.callback = Mock()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        Singleton._instances.pop(MirrorSelector, None)
+        Singleton._instances.pop(RequestCoalescer, None)
+        Singleton._instances.pop(RetryStats, None)
+        Singleton._instances.pop(BandwidthLimiter, None)
+        self.server_dir = tempfile.mkdtemp()
+        self.content = os.urandom(9000)
+        path = join(self.server_dir, "archive.bin")
+        with open(path, 'wb') as f:
+            f.write(self.content)
+        self.url = "file://" + path
+        self.checksum = Checksum(ChecksumType.sha256, hashlib.sha256(self.content).hexdigest())
+
+    def tearDown(self):
+        super().tearDown()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.server_dir)
+
+    def wait_for_callback(self, mock_function_to_be_called):
+        """wait for the callback to be called until a timeout, and return the result for our url"""
+        timeout = time() + 5
+        while not mock_function_to_be_called.called:
+            if time() > timeout:
+                raise(BaseException("Function not called within 5 seconds"))
+        result = mock_function_to_be_called.call_args[0][0][self.url]
+        for f in (result.fd, result.buffer):
+            if f:
+                self.addCleanup(f.close)
+        return result
+
+    def test_download(self):
+        """We download a local file, copied in the kernel, with progress reports and checksum check"""
+        report = CopyingMock()
+        with patch("os.copy_file_range", wraps=os.copy_file_range) as copy_file_range:
+            DownloadCenter([DownloadItem(self.url, self.checksum)], self.callback, report=report)
+            result = self.wait_for_callback(self.callback)
+
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), self.content)
+        self.assertTrue(copy_file_range.called)
+        self.assertEqual(report.call_args[0][0], {self.url: {'size': 9000, 'current': 9000}})
+
+    def test_download_wrong_checksum(self):
+        """We check the checksum of local files"""
+        DownloadCenter([DownloadItem(self.url, Checksum(ChecksumType.sha256, "AAAAA"))], self.callback)
+        result = self.wait_for_callback(self.callback)
+
+        self.assertIn("Corrupted download", result.error)
+        self.expect_warn_error = True
+
+    def test_download_with_sendfile(self):
+        """We fall back to sendfile when the kernel can't copy between those files"""
+        with patch("os.copy_file_range", side_effect=OSError(errno.EXDEV, "Cross-device link")), \
+                patch("os.sendfile", wraps=os.sendfile) as sendfile:
+            DownloadCenter([DownloadItem(self.url, self.checksum)], self.callback)
+            result = self.wait_for_callback(self.callback)
+
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), self.content)
+        self.assertTrue(sendfile.called)
+
+    def test_download_with_read_write(self):
+        """We fall back to copying through user space when the kernel can't copy at all"""
+        with patch("os.copy_file_range", side_effect=OSError(errno.ENOSYS, "Not implemented")), \
+                patch("os.sendfile", side_effect=OSError(errno.EINVAL, "Invalid argument")):
+            DownloadCenter([DownloadItem(self.url, self.checksum)], self.callback)
+            result = self.wait_for_callback(self.callback)
+
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), self.content)
+
+    def test_segmented_download(self):
+        """We copy big local files in multiple ranges"""
+        with patchelem(DownloadCenter, "SEGMENTED_DOWNLOAD_MIN_SIZE", 1024), \
+                patchelem(DownloadCenter, "SEGMENT_MIN_SIZE", 2048), \
+                patchelem(DownloadCenter, "COPY_BLOCK_SIZE", 1000):
+            DownloadCenter([DownloadItem(self.url, self.checksum)], self.callback)
+            result = self.wait_for_callback(self.callback)
+
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), self.content)
+
+    def test_in_memory_download(self):
+        """We read local files in memory"""
+        DownloadCenter([DownloadItem(self.url)], self.callback, download=False)
+        result = self.wait_for_callback(self.callback)
+
+        self.assertIsNone(result.error)
+        self.assertEqual(result.buffer.read(), self.content)
+
+    def test_missing_file(self):
+        """A missing local file is a download error"""
+        self.url += "-missing"
+        DownloadCenter([DownloadItem(self.url)], self.callback)
+        result = self.wait_for_callback(self.callback)
+
+        self.assertIn("404", result.error)
+        self.expect_warn_error = True
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Tests for the ftp adapter using a local ftp server"""
+
+import hashlib
+from os.path import join, getsize
+import requests
+import shutil
+import tempfile
+from time import time
+from unittest.mock import Mock, patch
+from ..tools import get_data_dir, change_xdg_path, LoggedTestCase, patchelem
+from ..tools.local_ftp_server import LocalFtp
+from umake.network.bandwidth import BandwidthLimiter
+from umake.network.download_center import DownloadCenter, DownloadItem
+from umake.network.ftp_adapter import FTPAdapter, _FTPTransfer
+from umake.network.mirrors import MirrorSelector
+from umake.network.partial_download import PartialDownload
+from umake.network.request_coalescer import RequestCoalescer
+from umake.network.retry import RetryPolicy, RetryStats
+from umake.tools import ChecksumType, Checksum, Singleton
+
+
+class TestFTPAdapter(LoggedTestCase):
+    """This will test the ftp adapter by sending requests to a local ftp server"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = join(get_data_dir(), "server-content")
+        cls.server = LocalFtp(cls.server_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.adapter = FTPAdapter()
+        self.session = requests.Session()
+        self.session.mount('ftp://', self.adapter)
+        with open(join(self.server_dir, "biggerfile"), 'rb') as f:
+            self.content = f.read()
+        self.url = self.build_server_address("biggerfile")
+
+    def tearDown(self):
+        self.session.close()
+        super().tearDown()
+
+    def build_server_address(self, path):
+        """build server address to path to get requested"""
+        return "{}/{}".format(self.server.get_address(), path)
+
+    def get(self, url, headers=None):
+        r = self.session.get(url, stream=True, headers=headers, timeout=(5, 5))
+        self.addCleanup(r.close)
+        return r
+
+    def test_download(self):
+        """We download a whole file, advertising ranges support and its size and modification time"""
+        r = self.get(self.url)
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, self.content)
+        self.assertEqual(r.headers['content-length'], str(len(self.content)))
+        self.assertEqual(r.headers['accept-ranges'], 'bytes')
+        self.assertIn('GMT', r.headers['last-modified'])
+
+    def test_download_readinto(self):
+        """The raw stream reads directly into our buffers"""
+        r = self.get(self.url)
+        buffer = bytearray(len(self.content) + 10)
+        size = 0
+        while True:
+            read_size = r.raw.readinto(memoryview(buffer)[size:size + 1000])
+            if not read_size:
+                break
+            self.assertLessEqual(read_size, 1000)
+            size += read_size
+
+        self.assertEqual(buffer[:size], self.content)
+
+    def test_download_stream_chunks(self):
+        """Streamed chunks have the requested size, except the last one"""
+        r = self.get(self.url)
+        chunks = list(r.raw.stream(1000))
+
+        self.assertEqual(b"".join(chunks), self.content)
+        self.assertEqual([len(chunk) for chunk in chunks[:-1]], [1000] * (len(chunks) - 1))
+
+    def test_404(self):
+        """A missing file returns a 404"""
+        r = self.get(self.build_server_address("does_not_exist"))
+
+        self.assertEqual(r.status_code, 404)
+        self.assertRaises(requests.exceptions.HTTPError, r.raise_for_status)
+
+    def test_range(self):
+        """A requested range is sent from its offset"""
+        r = self.get(self.url, headers={"Range": "bytes=1000-1999"})
+
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.headers['content-range'], "bytes 1000-1999/{}".format(len(self.content)))
+        self.assertEqual(r.headers['content-length'], "1000")
+        self.assertEqual(r.content, self.content[1000:2000])
+
+    def test_open_range(self):
+        """A range without end is sent up to the end of the file"""
+        r = self.get(self.url, headers={"Range": "bytes=8000-"})
+
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, self.content[8000:])
+
+    def test_unsatisfiable_range(self):
+        """A range starting after the end of the file returns a 416"""
+        r = self.get(self.url, headers={"Range": "bytes=10000-"})
+
+        self.assertEqual(r.status_code, 416)
+
+    def test_range_without_rest_support(self):
+        """We send the whole file if the server doesn't support REST"""
+        server = LocalFtp(self.server_dir, port=9878, support_rest=False)
+        self.addCleanup(server.stop)
+        r = self.get("{}/biggerfile".format(server.get_address()), headers={"Range": "bytes=1000-"})
+
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn('content-range', r.headers)
+        self.assertEqual(r.content, self.content)
+
+    def test_reuse_connection(self):
+        """Control connections are reused once their transfer went to the end"""
+        connections = self.server.connections
+        self.assertEqual(self.get(self.url).content, self.content)
+        self.assertEqual(self.get(self.url, headers={"Range": "bytes=8000-"}).content, self.content[8000:])
+        self.assertEqual(self.get(self.build_server_address("simplefile")).status_code, 200)
+
+        self.assertEqual(self.server.connections, connections + 1)
+
+    def test_dont_reuse_interrupted_connection(self):
+        """Control connections with a transfer stopped before the end of the file are closed"""
+        connections = self.server.connections
+        self.assertEqual(self.get(self.url, headers={"Range": "bytes=0-999"}).content, self.content[:1000])
+        self.assertEqual(self.get(self.url).content, self.content)
+
+        self.assertEqual(self.server.connections, connections + 2)
+
+    def test_dead_idle_connection(self):
+        """We reconnect if an idle connection was closed meanwhile"""
+        self.get(self.url).content
+        for connections in self.adapter._idle_connections.values():
+            for conn in connections:
+                conn.sock.close()
+
+        self.assertEqual(self.get(self.url).content, self.content)
+
+    def test_close(self):
+        """Closing the adapter closes idle connections"""
+        self.get(self.url).content
+        self.adapter.close()
+
+        self.assertEqual(self.adapter._idle_connections, {})
+
+    def test_connection_refused(self):
+        """We raise a requests ConnectionError if we can't connect"""
+        self.assertRaises(requests.exceptions.ConnectionError, self.get, "ftp://localhost:1/biggerfile")
+
+
+class TestFTPDownloadCenter(LoggedTestCase):
+    """This will test the download center with a local ftp server"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = join(get_data_dir(), "server-content")
+        cls.server = LocalFtp(cls.server_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.callback = Mock()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        Singleton._instances.pop(MirrorSelector, None)
+        Singleton._instances.pop(RequestCoalescer, None)
+        Singleton._instances.pop(RetryStats, None)
+        Singleton._instances.pop(BandwidthLimiter, None)
+        with open(join(self.server_dir, "biggerfile"), 'rb') as f:
+            self.content = f.read()
+        self.url = "{}/biggerfile".format(self.server.get_address())
+        self.checksum = Checksum(ChecksumType.md5, hashlib.md5(self.content).hexdigest())
+
+    def tearDown(self):
+        super().tearDown()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+
+    def wait_for_callback(self, mock_function_to_be_called):
+        """wait for the callback to be called until a timeout."""
+        timeout = time() + 5
+        while not mock_function_to_be_called.called:
+            if time() > timeout:
+                raise(BaseException("Function not called within 5 seconds"))
+        result = mock_function_to_be_called.call_args[0][0][self.url]
+        if result.fd:
+            self.addCleanup(result.fd.close)
+        return result
+
+    def test_download(self):
+        """We download a file over ftp"""
+        DownloadCenter([DownloadItem(self.url, self.checksum)], self.callback)
+        result = self.wait_for_callback(self.callback)
+
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), self.content)
+
+    def test_segmented_download(self):
+        """We download big files over ftp in multiple ranges"""
+        send = FTPAdapter.send
+        ranges = []
+
+        def record_ranges(adapter, request, **kwargs):
+            ranges.append(request.headers.get("Range"))
+            return send(adapter, request, **kwargs)
+
+        with patchelem(DownloadCenter, "SEGMENTED_DOWNLOAD_MIN_SIZE", 1024), \
+                patchelem(DownloadCenter, "SEGMENT_MIN_SIZE", 2048), \
+                patch.object(FTPAdapter, "send", autospec=True, side_effect=record_ranges):
+            DownloadCenter([DownloadItem(self.url, self.checksum)], self.callback)
+            result = self.wait_for_callback(self.callback)
+
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), self.content)
+        self.assertEqual(ranges[0], None)
+        self.assertEqual(len(ranges), DownloadCenter([], Mock()).segments + 1)
+        self.assertIn("bytes=0-2249", ranges)
+
+    def test_resume_download(self):
+        """We resume an interrupted ftp download from where it stopped"""
+        readinto = _FTPTransfer.readinto
+        reads = []
+
+        def fail_once(transfer, b):
+            reads.append(len(b))
+            if len(reads) == 2:
+                raise requests.exceptions.ConnectionError("Connection lost")
+            return readinto(transfer, b)
+
+        with patch.object(_FTPTransfer, "readinto", autospec=True, side_effect=fail_once), \
+                patch.object(RetryPolicy, "delay", return_value=0), \
+                patch.object(PartialDownload, "reset", autospec=True, side_effect=PartialDownload.reset) as reset:
+            DownloadCenter([DownloadItem(self.url, self.checksum)], self.callback)
+            result = self.wait_for_callback(self.callback)
+
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), self.content)
+        # we only started from scratch once
+        self.assertEqual(reset.call_count, 1)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the mirror selection"""
+
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+from ..tools import change_xdg_path, LoggedTestCase
+from umake.network.download_center import DownloadItem
+from umake.network.mirrors import MirrorSelector
+from umake.tools import Checksum, ChecksumType, Singleton
+
+
+class TestMirrorSelector(LoggedTestCase):
+    """This will test mirror candidates and their ordering"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        Singleton._instances.pop(MirrorSelector, None)
+        self.checksum = Checksum(ChecksumType.md5, "abcd")
+
+    def tearDown(self):
+        Singleton._instances.pop(MirrorSelector, None)
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def test_candidates(self):
+        """Candidates are the url, then item mirrors, then configured ones, without duplicates"""
+        selector = MirrorSelector()
+        selector.mirror_map = {"http://origin/": ["http://mirror1/foo/", "http://mirror2/"],
+                               "http://other/": ["http://mirror3/"]}
+        item = DownloadItem("http://origin/bar.tgz", self.checksum,
+                            mirrors=["http://mirror0/bar.tgz", "http://mirror2/bar.tgz"])
+        self.assertEqual(selector.candidates(item), ["http://origin/bar.tgz", "http://mirror0/bar.tgz",
+                                                     "http://mirror2/bar.tgz", "http://mirror1/foo/bar.tgz"])
+
+    def test_local_mirrors_ignored(self):
+        """Item mirrors which aren't remote urls are ignored"""
+        selector = MirrorSelector()
+        item = DownloadItem("http://origin/bar.tgz", self.checksum,
+                            mirrors=["file:///etc/passwd", "https://mirror0/bar.tgz"])
+        self.assertEqual(selector.candidates(item), ["http://origin/bar.tgz", "https://mirror0/bar.tgz"])
+        self.expect_warn_error = True
+
+    def test_probe_first_byte(self):
+        """Probing only asks for the first byte of the artifact"""
+        selector = MirrorSelector()
+        with patch("umake.network.mirrors.SessionPool") as session_pool:
+            selector._probe("http://mirror/foo")
+        get = session_pool.return_value.get.return_value.get
+        self.assertEqual(get.call_args[1]["headers"], {"Range": "bytes=0-0"})
+        self.assertIn("mirror", selector._stats)
+
+    def test_no_candidates_without_checksum(self):
+        """We only use the item url without checksum"""
+        selector = MirrorSelector()
+        selector.mirror_map = {"http://origin/": ["http://mirror1/"]}
+        item = DownloadItem("http://origin/bar.tgz", None, mirrors=["http://mirror0/bar.tgz"])
+        self.assertEqual(selector.candidates(item), ["http://origin/bar.tgz"])
+
+    def test_sorted_by_statistics(self):
+        """Faster hosts come first, and statistics are kept across runs"""
+        selector = MirrorSelector()
+        selector.record("http://slow/", latency=0.1, size=1024 * 1024, duration=1)
+        selector.record("http://fast/", latency=0.2, size=10 * 1024 * 1024, duration=1)
+        selector.record("http://far/", latency=30, size=10 * 1024 * 1024, duration=1)
+
+        Singleton._instances.pop(MirrorSelector, None)
+        item = DownloadItem("http://slow/foo", self.checksum, mirrors=["http://far/foo", "http://fast/foo"])
+        with patch.object(MirrorSelector, "_probe") as probe:
+            self.assertEqual(MirrorSelector().sorted_urls(item), ["http://fast/foo", "http://slow/foo",
+                                                                  "http://far/foo"])
+            self.assertFalse(probe.called)
+
+    def test_unknown_hosts_probed(self):
+        """We probe hosts we don't have statistics for, failing ones coming last"""
+        selector = MirrorSelector()
+        item = DownloadItem("http://failing/foo", self.checksum, mirrors=["http://working/foo"])
+
+        def probe(url):
+            if "failing" in url:
+                selector.record_failure(url)
+            else:
+                selector.record(url, latency=0.1)
+        with patch.object(selector, "_probe", side_effect=probe):
+            self.assertEqual(selector.sorted_urls(item), ["http://working/foo", "http://failing/foo"])
+
+    def test_failure_penalizes_host(self):
+        """A failure makes the host slower than others"""
+        selector = MirrorSelector()
+        selector.record("http://a/", latency=0.1)
+        selector.record("http://b/", latency=0.2)
+        selector.record_failure("http://a/")
+        item = DownloadItem("http://a/foo", self.checksum, mirrors=["http://b/foo"])
+        self.assertEqual(selector.sorted_urls(item), ["http://b/foo", "http://a/foo"])
+        self.assertTrue(os.path.isfile(selector.stats_path))
+
+    def test_stale_penalty_probed_again(self):
+        """A host penalized long ago is probed again, the fresh measure replacing the penalty"""
+        selector = MirrorSelector()
+        selector.record("http://a/", latency=0.1)
+        selector.record("http://b/", latency=0.2)
+        selector.record_failure("http://a/")
+        selector._stats["a"]["updated"] -= MirrorSelector.STALE_STATS_AGE + 1
+        item = DownloadItem("http://a/foo", self.checksum, mirrors=["http://b/foo"])
+
+        def probe(url):
+            selector.record(url, latency=0.1)
+        with patch.object(selector, "_probe", side_effect=probe) as mock_probe:
+            self.assertEqual(selector.sorted_urls(item), ["http://a/foo", "http://b/foo"])
+        mock_probe.assert_called_once_with("http://a/foo")
+        self.assertEqual(selector._stats["a"]["latency"], 0.1)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for resumable downloads and their inline checksum"""
+
+from concurrent import futures
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from unittest.mock import Mock, patch
+from ..tools import change_xdg_path, LoggedTestCase, patchelem
+from umake.network.partial_download import PartialDownload, SequentialChecksum
+
+
+class TestPartialDownload(LoggedTestCase):
+    """This will test partial downloads in a temporary XDG cache directory"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        self.content = os.urandom(3 * 1000 + 10)
+        self.headers = {"accept-ranges": "bytes", "content-length": str(len(self.content)), "etag": "1234"}
+
+    def tearDown(self):
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def write(self, partial, index, start, end):
+        with partial.open_segment(index) as f:
+            f.write(self.content[start:end])
+
+    def test_segments_written_in_order(self):
+        """Content written sequentially is hashed inline, without reading it back"""
+        partial = PartialDownload("http://foo", None)
+        partial.start_checksum(hashlib.sha256)
+        partial.reset(self.headers, [(0, len(self.content) - 1)], resumable=True)
+        with patch.object(SequentialChecksum, "_catch_up") as catch_up:
+            self.write(partial, 0, 0, 1000)
+            self.write(partial, 0, 1000, len(self.content))
+            self.assertFalse(catch_up.called)
+        self.assertEqual(partial.checksum.hexdigest(), hashlib.sha256(self.content).hexdigest())
+
+    def test_segments_written_out_of_order(self):
+        """Segments written ahead are hashed once previous ones are done"""
+        partial = PartialDownload("http://foo", None)
+        partial.start_checksum(hashlib.md5)
+        partial.reset(self.headers, [(0, 999), (1000, 1999), (2000, len(self.content) - 1)], resumable=True)
+        self.write(partial, 2, 2000, 2500)
+        self.write(partial, 1, 1000, 2000)
+        self.write(partial, 0, 0, 1000)
+        self.write(partial, 2, 2500, len(self.content))
+        self.assertEqual(partial.checksum.offset, len(self.content))
+        self.assertEqual(partial.checksum.hexdigest(), hashlib.md5(self.content).hexdigest())
+
+    def test_resumed_download(self):
+        """A download resumed from a previous run hashes the content written previously"""
+        partial = PartialDownload("http://foo", None)
+        partial.reset(self.headers, [(0, 1499), (1500, len(self.content) - 1)], resumable=True)
+        self.write(partial, 0, 0, 700)
+        self.write(partial, 1, 1500, 2000)
+
+        partial = PartialDownload("http://foo", None)
+        self.assertTrue(partial.can_resume(self.headers, False))
+        self.assertEqual(partial.remaining, [(0, (700, 1499)), (1, (2000, len(self.content) - 1))])
+        partial.start_checksum(hashlib.sha1)
+        self.write(partial, 1, 2000, len(self.content))
+        self.write(partial, 0, 700, 1500)
+        self.assertEqual(partial.checksum.hexdigest(), hashlib.sha1(self.content).hexdigest())
+
+    def test_can_not_resume_changed_content(self):
+        """We don't resume if the content changed on the server"""
+        partial = PartialDownload("http://foo", None)
+        partial.reset(self.headers, [(0, len(self.content) - 1)], resumable=True)
+        self.write(partial, 0, 0, 700)
+        self.headers["etag"] = "5678"
+        self.assertFalse(PartialDownload("http://foo", None).can_resume(self.headers, False))
+
+    def test_can_not_resume_without_validators(self):
+        """We need a validator or a checksum to resume"""
+        del self.headers["etag"]
+        partial = PartialDownload("http://foo", None)
+        partial.reset(self.headers, [(0, len(self.content) - 1)], resumable=True)
+        self.write(partial, 0, 0, 700)
+        self.assertFalse(PartialDownload("http://foo", None).can_resume(self.headers, False))
+        self.assertTrue(PartialDownload("http://foo", None).can_resume(self.headers, True))
+
+    def test_complete(self):
+        """A completed download is moved out of the .part file"""
+        partial = PartialDownload("http://foo.tgz", None, suffix=".tgz")
+        partial.reset(self.headers, [(0, len(self.content) - 1)], resumable=True)
+        self.write(partial, 0, 0, len(self.content))
+        with partial.complete() as f:
+            self.assertEqual(f.read(), self.content)
+            self.assertTrue(f.name.endswith(".tgz"))
+        self.assertFalse(os.path.exists(f.name))
+        self.assertFalse(os.path.exists(partial.part_path))
+        self.assertFalse(os.path.exists(partial.state_path))
+
+    def test_lock_waits_for_other_download(self):
+        """We wait for another download of the same content, reporting its progress and continuing its state"""
+        holder = PartialDownload("http://foo", None)
+        self.assertFalse(holder.lock())
+        holder.reset(self.headers, [(0, len(self.content) - 1)], resumable=True)
+        self.write(holder, 0, 0, 1000)
+
+        on_wait = Mock()
+        waiter = PartialDownload("http://foo", None)
+        with patchelem(PartialDownload, "LOCK_POLL_INTERVAL", 0.01):
+            with futures.ThreadPoolExecutor(max_workers=1) as executor:
+                waited = executor.submit(waiter.lock, on_wait)
+                while not on_wait.called:
+                    time.sleep(0.01)
+                self.write(holder, 0, 1000, 2000)
+                holder.unlock()
+                self.assertTrue(waited.result(timeout=5))
+
+        on_wait.assert_any_call(1000, len(self.content))
+        self.assertEqual(waiter.segments, [[0, len(self.content) - 1, 2000]])
+        waiter.unlock()
+        self.assertFalse(holder.lock())
+        holder.unlock()
+        self.assertFalse(os.path.exists(holder.lock_path))
+
+    def test_lock_wait_cancelled(self):
+        """We stop waiting for another download when check_cancelled raises, leaving its lock alone"""
+        holder = PartialDownload("http://foo", None)
+        holder.lock()
+        waiter = PartialDownload("http://foo", None)
+        check_cancelled = Mock(side_effect=[None, None, InterruptedError()])
+        with patchelem(PartialDownload, "LOCK_POLL_INTERVAL", 0.01):
+            self.assertRaises(InterruptedError, waiter.lock, check_cancelled=check_cancelled)
+        self.assertFalse(waiter.locked)
+        self.assertTrue(os.path.exists(holder.lock_path))
+        self.assertTrue(holder.locked)
+        holder.unlock()
+        self.assertFalse(os.path.exists(holder.lock_path))
@@ -315,6 +315,114 @@ class TestRequirementsHandler(LoggedTestCase):
         self.assertTrue(self.handler.is_bucket_installed(["testpackage"]))
         self.assertFalse(progress_second_callback.called)
 
+    def wait_for_executor(self):
+        """Wait for every pending job of the handler to be processed"""
+        self.handler.executor.submit(lambda: None).result(timeout=10)
+
+    def archives(self):
+        """Return the archives in the apt archive cache"""
+        return os.listdir(apt.apt_pkg.config.find_dir("Dir::Cache::Archives"))
+
+    def test_prefetch(self):
+        """Prefetching a bucket fetches its archives, without installing nor keeping anything marked"""
+        self.handler.prefetch_bucket(["testpackage", "testpackage0"])
+        self.wait_for_executor()
+
+        self.assertIn("testpackage_0.0.1_all.deb", self.archives())
+        self.assertFalse(self.handler.is_bucket_installed(["testpackage"]))
+        self.assertFalse(self.handler.is_bucket_installed(["testpackage0"]))
+        self.assertEqual(self.handler.cache.get_changes(), [])
+        # fetched as root in a child process: we never switched to root ourself
+        self.assertNotIn(call(0), os.seteuid.call_args_list)
+
+    def test_prefetch_then_install(self):
+        """Installing a prefetched bucket installs it"""
+        self.handler.prefetch_bucket(["testpackage"])
+        self.handler.install_bucket(["testpackage"], lambda x: "", self.done_callback)
+        self.wait_for_callback(self.done_callback)
+
+        self.assertIsNone(self.done_callback.call_args[0][0].error)
+        self.assertTrue(self.handler.is_bucket_installed(["testpackage"]))
+
+    def test_prefetch_uptodate_bucket(self):
+        """Nothing is fetched for an up to date bucket"""
+        self.handler.install_bucket(["testpackage"], lambda x: "", self.done_callback)
+        self.wait_for_callback(self.done_callback)
+
+        with patch.object(self.handler.cache, "fetch_archives") as fetch:
+            self.handler.prefetch_bucket(["testpackage"])
+            self.wait_for_executor()
+
+            self.assertFalse(fetch.called)
+
+    def test_prefetch_skip_unavailable_packages(self):
+        """Packages we can't mark for install are skipped, the others are still fetched"""
+        self.handler.prefetch_bucket(["testpackage", "testpackagefoo:foo"])
+        self.wait_for_executor()
+
+        self.assertIn("testpackage_0.0.1_all.deb", self.archives())
+
+    def test_prefetch_fails(self):
+        """A failing prefetch doesn't prevent installing the bucket later on, nor is reported as an error"""
+        with patch.object(self.handler.cache, "fetch_archives", side_effect=SystemError("Failed to fetch")):
+            self.handler.prefetch_bucket(["testpackage"])
+            self.wait_for_executor()
+        self.handler.install_bucket(["testpackage"], lambda x: "", self.done_callback)
+        self.wait_for_callback(self.done_callback)
+
+        self.assertIsNone(self.done_callback.call_args[0][0].error)
+        self.assertTrue(self.handler.is_bucket_installed(["testpackage"]))
+
+    def test_download_bucket(self):
+        """Downloading a bucket downloads the archives of its packages and dependencies, without installing them"""
+        dest_dir = os.path.join(self.chroot_path, "debs")
+        self.handler.download_bucket(["testpackage1"], dest_dir, self.done_callback)
+        self.wait_for_callback(self.done_callback)
+
+        self.assertIsNone(self.done_callback.call_args[0][0].error)
+        self.assertEqual(sorted(os.listdir(dest_dir)), ["testpackage1_0.0.1_all.deb", "testpackage_0.0.1_all.deb"])
+        self.assertFalse(self.handler.is_bucket_installed(["testpackage1"]))
+        self.assertEqual(self.handler.cache.get_changes(), [])
+
+    def test_download_installed_bucket(self):
+        """The archives of bucket packages are downloaded even if they are installed on this machine"""
+        self.handler.install_bucket(["testpackage"], lambda x: "", self.done_callback)
+        self.wait_for_callback(self.done_callback)
+        self.done_callback.reset_mock()
+
+        dest_dir = os.path.join(self.chroot_path, "debs")
+        self.handler.download_bucket(["testpackage"], dest_dir, self.done_callback)
+        self.wait_for_callback(self.done_callback)
+
+        self.assertEqual(os.listdir(dest_dir), ["testpackage_0.0.1_all.deb"])
+
+    def test_download_unavailable_bucket(self):
+        """We report an error if we can't download the bucket"""
+        self.handler.download_bucket(["doesntexist"], os.path.join(self.chroot_path, "debs"), self.done_callback)
+        self.wait_for_callback(self.done_callback)
+
+        self.assertIsNotNone(self.done_callback.call_args[0][0].error)
+        self.expect_warn_error = True
+
+    def test_add_archives_then_install(self):
+        """Archives are added as root to the apt archive cache, then used to install the bucket"""
+        dest_dir = os.path.join(self.chroot_path, "debs")
+        self.handler.download_bucket(["testpackage"], dest_dir, self.done_callback)
+        self.wait_for_callback(self.done_callback)
+        self.done_callback.reset_mock()
+        os.seteuid.reset_mock()
+
+        self.handler.add_archives([os.path.join(dest_dir, "testpackage_0.0.1_all.deb")])
+        self.wait_for_executor()
+        self.assertIn("testpackage_0.0.1_all.deb", self.archives())
+        # copied as root in a child process
+        self.assertNotIn(call(0), os.seteuid.call_args_list)
+
+        self.handler.install_bucket(["testpackage"], lambda x: "", self.done_callback)
+        self.wait_for_callback(self.done_callback)
+        self.assertIsNone(self.done_callback.call_args[0][0].error)
+        self.assertTrue(self.handler.is_bucket_installed(["testpackage"]))
+
     def test_deps(self):
         """Installing one package, ensure the dep (even with auto_fix=False) is installed"""
         self.handler.install_bucket(["testpackage1"], lambda x: "", self.done_callback)
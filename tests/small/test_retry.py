@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Tests for download retries and stall detection"""
+
+import requests
+from unittest.mock import patch
+from ..tools import LoggedTestCase
+from umake.network.retry import DownloadStalled, RetryPolicy, RetryStats, StallDetector
+from umake.tools import Singleton
+
+
+class TestRetryPolicy(LoggedTestCase):
+    """This will test which failures we retry and how long we wait"""
+
+    def setUp(self):
+        super().setUp()
+        Singleton._instances.pop(RetryStats, None)
+
+    def tearDown(self):
+        Singleton._instances.pop(RetryStats, None)
+        super().tearDown()
+
+    def http_error(self, status_code):
+        response = requests.Response()
+        response.status_code = status_code
+        return requests.exceptions.HTTPError(response=response)
+
+    def test_retryable_errors(self):
+        """We retry network errors, stalls and server errors, not client errors"""
+        self.assertTrue(RetryPolicy.is_retryable(requests.exceptions.ConnectionError()))
+        self.assertTrue(RetryPolicy.is_retryable(requests.exceptions.ReadTimeout()))
+        self.assertTrue(RetryPolicy.is_retryable(requests.exceptions.ChunkedEncodingError()))
+        self.assertTrue(RetryPolicy.is_retryable(DownloadStalled()))
+        self.assertTrue(RetryPolicy.is_retryable(self.http_error(503)))
+        self.assertTrue(RetryPolicy.is_retryable(self.http_error(429)))
+        self.assertFalse(RetryPolicy.is_retryable(self.http_error(404)))
+        self.assertFalse(RetryPolicy.is_retryable(BaseException("Corrupted download")))
+
+    def test_exponential_backoff_with_jitter(self):
+        """We wait a random delay, up to a doubling then capped backoff"""
+        policy = RetryPolicy()
+        policy.backoff = 1
+        policy.backoff_max = 5
+        with patch("umake.network.retry.random.uniform", side_effect=lambda low, high: high):
+            self.assertEqual([policy.delay(attempt) for attempt in range(1, 6)], [1, 2, 4, 5, 5])
+        for attempt in range(1, 6):
+            self.assertLessEqual(policy.delay(attempt), 5)
+
+    def test_retries_recorded_per_host(self):
+        """We count retries per host"""
+        policy = RetryPolicy()
+        with patch.object(RetryPolicy, "delay", return_value=0):
+            policy.wait_before_retry("http://foo.com/bar", 1, DownloadStalled())
+            policy.wait_before_retry("http://FOO.com/baz", 2, DownloadStalled())
+            policy.wait_before_retry("https://other.com/", 1, DownloadStalled())
+        self.assertEqual(RetryStats().per_host(), {"foo.com": 2, "other.com": 1})
+
+
+class TestStallDetector(LoggedTestCase):
+    """This will test the detection of stalled transfers"""
+
+    def test_stalled(self):
+        """We raise once the speed stays under the floor for the whole window"""
+        detector = StallDetector(min_speed=1000, window=10)
+        detector.update(1)
+        # 10 seconds later
+        detector._window_start -= 10
+        with self.assertRaises(DownloadStalled):
+            detector.update(1)
+
+    def test_not_stalled_within_window(self):
+        """We don't judge a transfer before a whole window elapsed"""
+        detector = StallDetector(min_speed=1000, window=3600)
+        detector.update(1)
+
+    def test_disabled(self):
+        """A floor of 0 disables stall detection"""
+        detector = StallDetector(min_speed=0, window=10)
+        detector._window_start -= 10
+        detector.update(0)
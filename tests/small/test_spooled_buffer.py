@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Tests for in memory download buffers spilling to disk"""
+
+from ..tools import LoggedTestCase
+from umake.network.spooled_buffer import SpooledBuffer
+
+
+class TestSpooledBuffer(LoggedTestCase):
+    """This will test buffers below and above their memory limit"""
+
+    def setUp(self):
+        super().setUp()
+        self.content = b"".join([b"line " + str(i).encode() + b"\n" for i in range(200)])
+
+    def test_small_content_in_memory(self):
+        """We keep content below the limit in memory, with the BytesIO API"""
+        with SpooledBuffer(len(self.content) + 1) as buffer:
+            buffer.write(self.content)
+            buffer.seek(0)
+            self.assertTrue(buffer.in_memory)
+            self.assertEqual(buffer.getvalue(), self.content)
+            self.assertEqual(b"".join(buffer), self.content)
+
+    def test_big_content_spilled(self):
+        """We move content above the limit to disk, keeping the same API"""
+        with SpooledBuffer(100) as buffer:
+            buffer.write(self.content)
+            buffer.seek(10)
+            self.assertFalse(buffer.in_memory)
+            self.assertEqual(buffer.getvalue(), self.content)
+            self.assertEqual(buffer.read(), self.content[10:])
+            buffer.seek(0)
+            self.assertEqual(list(buffer), self.content.splitlines(keepends=True))
+
+    def test_duplicate(self):
+        """Duplicates have the same content and their own position"""
+        for max_size in (100, len(self.content) + 1):
+            with SpooledBuffer(max_size) as buffer:
+                buffer.write(self.content)
+                buffer.seek(0)
+                copy = buffer.duplicate()
+                self.assertEqual(copy.in_memory, buffer.in_memory)
+                self.assertEqual(copy.read(), self.content)
+                self.assertEqual(buffer.read(5), self.content[:5])
+                copy.close()
+                self.assertEqual(buffer.read(), self.content[5:])
@@ -35,7 +35,7 @@ from ..tools import change_xdg_path, get_data_dir, LoggedTestCase, INSTALL_DIR
 from umake import settings, tools
 from umake.tools import ConfigHandler, Singleton, get_current_arch, get_foreign_archs, get_current_ubuntu_version,\
     create_launcher, launcher_exists_and_is_pinned, launcher_exists, get_icon_path, get_launcher_path, copy_icon
-from unittest.mock import patch
+from unittest.mock import Mock, call as call_args, patch
 
 
 class TestConfigHandler(LoggedTestCase):
@@ -365,6 +365,73 @@ class TestToolsThreads(LoggedTestCase):
         self.expect_warn_error = True
 
 
+class TestCoalescedCall(LoggedTestCase):
+    """Test rate limited calls to the main loop"""
+
+    def setUp(self):
+        super().setUp()
+        self.function = Mock()
+        self.scheduled = []
+        glib_patcher = patch("umake.tools.GLib")
+        self.glib = glib_patcher.start()
+        self.glib.timeout_add.side_effect = lambda delay, function: self.scheduled.append((delay, function))
+        self.addCleanup(glib_patcher.stop)
+
+    def run_scheduled(self):
+        """Run the first scheduled call, returning its delay"""
+        delay, function = self.scheduled.pop(0)
+        function()
+        return delay
+
+    def test_first_call_delivered_immediately(self):
+        """A first call is delivered on next main loop iteration"""
+        call = tools.CoalescedCall(self.function)
+        call(1, 2)
+        self.assertEqual(self.run_scheduled(), 0)
+        self.function.assert_called_once_with(1, 2)
+
+    def test_calls_coalesced(self):
+        """Calls happening before delivery are only delivered once, with latest arguments"""
+        call = tools.CoalescedCall(self.function)
+        call(1)
+        call(2)
+        call(3)
+        self.assertEqual(len(self.scheduled), 1)
+        self.run_scheduled()
+        self.function.assert_called_once_with(3)
+
+    def test_calls_merged(self):
+        """Pending arguments can be merged with new ones"""
+        call = tools.CoalescedCall(self.function, merge=lambda pending, new: (pending[0] + new[0],))
+        call(1)
+        call(2)
+        call(3)
+        self.run_scheduled()
+        self.function.assert_called_once_with(6)
+
+    def test_calls_rate_limited(self):
+        """A call right after a delivery is delayed to respect the rate"""
+        call = tools.CoalescedCall(self.function, rate=10)
+        call(1)
+        self.run_scheduled()
+        call(2)
+        self.assertGreater(self.run_scheduled(), 50)
+        self.assertEqual(self.function.call_args_list, [call_args(1), call_args(2)])
+
+    def test_unhandled_exception_quits(self):
+        """We quit the process in error for any unhandled exception, logging it"""
+        self.function.side_effect = BaseException("foo bar")
+        call = tools.CoalescedCall(self.function)
+        call()
+        had_mainloop = tools.MainLoop in Singleton._instances
+        self.run_scheduled()
+        self.assertEqual(self.glib.idle_add.call_args[0][1:], (1, False))
+        # don't keep a main loop instance created on mocked GLib
+        if not had_mainloop:
+            Singleton._instances.pop(tools.MainLoop, None)
+        self.expect_warn_error = True
+
+
 class TestLauncherIcons(LoggedTestCase):
     """Test module for launcher icons handling"""
 
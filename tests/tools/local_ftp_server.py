@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Class enabling having a local ftp server"""
+
+from concurrent import futures
+import logging
+import os
+import posixpath
+import socket
+import socketserver
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LocalFtp:
+    """Local threaded anonymous ftp server, serving path content in passive mode"""
+
+    def __init__(self, path, port=9877, support_rest=True):
+        """path is the local path to serve
+        set support_rest to False to refuse the REST command"""
+        self.port = port
+        self.path = path
+        self.support_rest = support_rest
+        # number of control connections opened by clients
+        self.connections = 0
+        self.server = _FtpServer(("", self.port), FtpRequestHandler)
+        self.server.local_ftp = self
+
+        executor = futures.ThreadPoolExecutor(max_workers=1)
+        self.future = executor.submit(self._serve)
+
+    def _serve(self):
+        logger.info("Serving ftp locally from {} on {}".format(self.path, self.get_address()))
+        self.server.serve_forever()
+
+    def get_address(self):
+        """Get public address"""
+        return "ftp://localhost:{}".format(self.port)
+
+    def stop(self):
+        """Stop local server"""
+        logger.info("Stopping serving ftp on {}".format(self.port))
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _FtpServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class FtpRequestHandler(socketserver.StreamRequestHandler):
+    """Handle one ftp control connection"""
+
+    def reply(self, message):
+        self.wfile.write("{}\r\n".format(message).encode("utf-8"))
+
+    def handle(self):
+        ftp = self.server.local_ftp
+        ftp.connections += 1
+        self.passive_socket = None
+        self.rest = 0
+        self.reply("220 Local ftp server ready")
+        for line in self.rfile:
+            command, _, arg = line.decode("utf-8").strip().partition(" ")
+            command = command.upper()
+            if command == "QUIT":
+                self.reply("221 Bye")
+                return
+            handler = getattr(self, "ftp_" + command.lower(), None)
+            if handler is None:
+                self.reply("502 Command not implemented")
+            else:
+                handler(ftp, arg)
+
+    def _path(self, ftp, arg):
+        return os.path.join(ftp.path, posixpath.normpath("/" + arg)[1:])
+
+    def ftp_user(self, ftp, arg):
+        self.reply("331 Send any password")
+
+    def ftp_pass(self, ftp, arg):
+        self.reply("230 Logged in")
+
+    def ftp_type(self, ftp, arg):
+        self.reply("200 Type set")
+
+    def ftp_noop(self, ftp, arg):
+        self.reply("200 OK")
+
+    def ftp_size(self, ftp, arg):
+        path = self._path(ftp, arg)
+        if not os.path.isfile(path):
+            self.reply("550 No such file")
+            return
+        self.reply("213 {}".format(os.path.getsize(path)))
+
+    def ftp_mdtm(self, ftp, arg):
+        path = self._path(ftp, arg)
+        if not os.path.isfile(path):
+            self.reply("550 No such file")
+            return
+        self.reply("213 {}".format(time.strftime("%Y%m%d%H%M%S", time.gmtime(os.path.getmtime(path)))))
+
+    def ftp_pasv(self, ftp, arg):
+        self.passive_socket = socket.socket()
+        self.passive_socket.bind(("127.0.0.1", 0))
+        self.passive_socket.listen(1)
+        port = self.passive_socket.getsockname()[1]
+        self.reply("227 Entering Passive Mode (127,0,0,1,{},{})".format(port >> 8, port & 0xff))
+
+    def ftp_rest(self, ftp, arg):
+        if not ftp.support_rest:
+            self.reply("502 REST not implemented")
+            return
+        self.rest = int(arg)
+        self.reply("350 Restarting at {}".format(self.rest))
+
+    def ftp_retr(self, ftp, arg):
+        path = self._path(ftp, arg)
+        rest, self.rest = self.rest, 0
+        if not os.path.isfile(path):
+            self.reply("550 No such file")
+            return
+        self.reply("150 Opening data connection")
+        data_socket, address = self.passive_socket.accept()
+        self.passive_socket.close()
+        try:
+            with open(path, 'rb') as f:
+                f.seek(rest)
+                data_socket.sendall(f.read())
+        except OSError:
+            self.reply("426 Transfer aborted")
+            return
+        finally:
+            data_socket.close()
+        self.reply("226 Transfer complete")
@@ -22,9 +22,11 @@
 from concurrent import futures
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 import http.cookies
+from io import BytesIO
 import logging
 import os
 import posixpath
+import re
 import ssl
 from . import get_data_dir
 import urllib
@@ -105,6 +107,10 @@ class LocalHttp:
 class RequestHandler(SimpleHTTPRequestHandler):
 
     root_path = os.getcwd()
+    # set to False to advertise ranges support while always sending back the whole file
+    honor_ranges = True
+    # set to False to not send the Last-Modified header
+    send_validators = True
 
     def __init__(self, request, client_address, server):
         self.headers_to_send = []
@@ -116,6 +122,9 @@ class RequestHandler(SimpleHTTPRequestHandler):
             for current_header in self._headers_buffer:
                 if current_header.decode("UTF-8").startswith("Content-Length"):
                     self._headers_buffer.remove(current_header)
+        if not RequestHandler.send_validators:
+            self._headers_buffer = [header for header in self._headers_buffer
+                                    if not header.decode("UTF-8").startswith("Last-Modified")]
         for key, value in self.headers_to_send:
             self.send_header(key, value)
         super().end_headers()
@@ -161,6 +170,35 @@ class RequestHandler(SimpleHTTPRequestHandler):
             path += '/'
         return path
 
+    def send_head(self):
+        """Advertise and serve a single byte range of existing files"""
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+        self.headers_to_send.append(('Accept-Ranges', 'bytes'))
+        match = re.match(r'bytes=(\d*)-(\d*)$', (self.headers['Range'] or "").strip())
+        if not match or not RequestHandler.honor_ranges:
+            return super().send_head()
+
+        size = os.path.getsize(path)
+        start, end = match.groups()
+        if not start:
+            start, end = size - int(end), size - 1
+        else:
+            start, end = int(start), min(int(end) if end else size - 1, size - 1)
+        if start > end:
+            self.send_error(416)
+            return None
+        with open(path, 'rb') as f:
+            f.seek(start)
+            content = f.read(end - start + 1)
+        self.send_response(206)
+        self.send_header("Content-type", self.guess_type(path))
+        self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        return BytesIO(content)
+
     def do_GET(self):
         """Override this to enable redirecting paths that end in -redirect or rewrite in presence of ?file="""
         cookies = http.cookies.SimpleCookie(self.headers['Cookie'])
@@ -25,6 +25,7 @@ import logging.config
 import os
 import sys
 from umake.frameworks import BaseCategory, load_frameworks
+from umake.network.bandwidth import parse_rate
 from umake.tools import MainLoop
 from .ui import cli
 import yaml
@@ -102,6 +103,16 @@ def main():
     parser.add_argument("-v", "--verbose", action="count", default=0, help=_("Increase output verbosity (2 levels)"))
 
     parser.add_argument('-r', '--remove', action="store_true", help=_("Remove specified framework if installed"))
+    parser.add_argument('--limit-rate', type=parse_rate, metavar="RATE",
+                        help=_("Limit the download bandwidth to RATE bytes per second, with an optional K, M or G "
+                               "suffix"))
+    bundle_group = parser.add_mutually_exclusive_group()
+    bundle_group.add_argument('--export-bundle', metavar="BUNDLE",
+                              help=_("Download what the framework needs to be installed and add it to the BUNDLE "
+                                     "offline install archive, instead of installing it"))
+    bundle_group.add_argument('--from-bundle', metavar="BUNDLE",
+                              help=_("Install the framework from the BUNDLE offline install archive, without network "
+                                     "access"))
 
     # set logging ignoring unknown options
     set_logging_from_args(sys.argv, parser)
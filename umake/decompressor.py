@@ -26,6 +26,8 @@ import shutil
 import stat
 import subprocess
 import tarfile
+import tempfile
+from threading import Thread
 import zipfile
 
 
@@ -47,9 +49,12 @@ class Decompressor:
             os.chmod(targetpath, mode)
             return targetpath
 
-    def __init__(self, orders, on_done):
+    def __init__(self, orders, on_done, streamed=None):
         """Decompress all fds in threads and send on_done callback once finished
 
+        streamed is an optional dict of fd: StreamingDecompressor which was already extracting fd content while it
+        was downloaded. We then use its result, only falling back to decompressing fd if streaming extraction failed.
+
 
         order is:
         {
@@ -68,19 +73,26 @@ class Decompressor:
         self._orders = orders
         self._decompressed = {}
         self._done_callback = on_done
+        streamed = streamed or {}
 
         executor = futures.ThreadPoolExecutor(max_workers=3)
         for fd in orders:
             logger.info("Requesting decompression to {}".format(orders[fd].dest))
-            future = executor.submit(self._decompress, fd, orders[fd].dir, orders[fd].dest)
+            future = executor.submit(self._decompress, fd, orders[fd].dir, orders[fd].dest, streamed.get(fd))
             future.tag_fd = fd
             future.tag_dest = orders[fd].dest
             future.add_done_callback(self._one_done)
+        # let the worker threads exit once every decompression is done
+        executor.shutdown(wait=False)
 
-    def _decompress(self, fd, dir, dest):
+    def _decompress(self, fd, dir, dest, streamed=None):
         """decompress one entry
 
         dir can be a regexp"""
+        if streamed is not None and streamed.commit(dest):
+            logger.debug("Extracted to {} while downloading".format(dest))
+            self._move_dir_to_root(dir, dest)
+            return
         logger.debug("Extracting to {}".format(dest))
         # We don't use shutil to automatically select the right codec as we need to ensure that zipfile
         # will keep the original perms.
@@ -107,7 +119,11 @@ class Decompressor:
             logger.debug("executable file")
             os.remove(name)
 
-        # we want the content of dir to be the root of dest, rename and move content
+        self._move_dir_to_root(dir, dest)
+
+    @staticmethod
+    def _move_dir_to_root(dir, dest):
+        """we want the content of dir to be the root of dest, rename and move content"""
         if dir is not None:
             try:
                 dir_path = glob(os.path.join(dest, dir))[0]
@@ -143,3 +159,102 @@ class Decompressor:
         """
         logger.info("All pending decompression done to {} done.".format([self._orders[fd].dest for fd in self._orders]))
         self._done_callback(self._decompressed)
+
+
+class StreamingDecompressor:
+    """Extract a tar stream while it's being downloaded, in a staging directory next to dest.
+
+    The content is written to it in order (it's a DownloadCenter consumer). The staging directory is only moved to
+    dest by commit(), once the download is complete and checked."""
+
+    BLOCK_SIZE = 1024 * 64
+
+    def __init__(self, dest):
+        parent_dir = os.path.dirname(os.path.abspath(dest))
+        os.makedirs(parent_dir, exist_ok=True)
+        self.staging_dir = tempfile.mkdtemp(prefix=".{}-".format(os.path.basename(dest)), dir=parent_dir)
+        read_fd, write_fd = os.pipe()
+        self._reader = os.fdopen(read_fd, 'rb')
+        self._writer = os.fdopen(write_fd, 'wb')
+        self._failed = False
+        # daemon: a download never completing nor aborted mustn't keep the process alive
+        self._thread = Thread(target=self._extract, daemon=True)
+        self._thread.start()
+
+    def _extract(self):
+        try:
+            with tarfile.open(fileobj=self._reader, mode='r|*') as archive:
+                # the content isn't checked yet: nothing can be written outside of the staging directory
+                if hasattr(tarfile, "data_filter"):
+                    archive.extractall(self.staging_dir, filter="data")
+                else:
+                    archive.extractall(self.staging_dir, members=self._checked_members(archive))
+            # drain the end of the stream (record padding) so that the writer never blocks
+            while self._reader.read(self.BLOCK_SIZE):
+                pass
+        except BaseException as e:
+            logger.debug("Streaming extraction to {} failed: {}".format(self.staging_dir, e))
+            self._failed = True
+        finally:
+            # unblock and fail any pending or further write
+            self._reader.close()
+
+    def _checked_members(self, archive):
+        """Yield archive members, raising on the ones which would be written or link outside of the staging directory
+
+        For python versions without tar extraction filters."""
+        staging_dir = os.path.realpath(self.staging_dir)
+
+        def check(path, member):
+            path = os.path.realpath(path)
+            if path != staging_dir and not path.startswith(staging_dir + os.sep):
+                raise tarfile.TarError("{} points outside of the archive".format(member.name))
+        for member in archive:
+            if os.path.isabs(member.name):
+                raise tarfile.TarError("{} is an absolute path".format(member.name))
+            member_path = os.path.join(staging_dir, member.name)
+            check(member_path, member)
+            if member.issym():
+                check(os.path.join(os.path.dirname(member_path), member.linkname), member)
+            elif member.islnk():
+                check(os.path.join(staging_dir, member.linkname), member)
+            yield member
+
+    def write(self, data):
+        if self._failed:
+            return
+        try:
+            self._writer.write(data)
+        except (BrokenPipeError, ValueError):
+            self._failed = True
+
+    def discard(self):
+        """The stream restarted: the content we extracted is unusable"""
+        self._failed = True
+        self._close_writer()
+
+    def _close_writer(self):
+        try:
+            self._writer.close()
+        except BrokenPipeError:
+            self._failed = True
+
+    def commit(self, dest):
+        """Wait for extraction to finish and move its content to dest. Return False if it failed"""
+        self._close_writer()
+        self._thread.join()
+        if self._failed:
+            self.abort()
+            return False
+        os.makedirs(dest, exist_ok=True)
+        for filename in os.listdir(self.staging_dir):
+            shutil.move(os.path.join(self.staging_dir, filename), os.path.join(dest, filename))
+        os.rmdir(self.staging_dir)
+        return True
+
+    def abort(self):
+        """Stop extracting and remove what we extracted"""
+        self._failed = True
+        self._close_writer()
+        self._thread.join()
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
@@ -26,20 +26,29 @@ import logging
 from progressbar import ProgressBar
 import os
 import shutil
+import tarfile
+from threading import Lock
+import urllib.parse
 import umake.frameworks
-from umake.decompressor import Decompressor
+from umake.decompressor import Decompressor, StreamingDecompressor
 from umake.interactions import InputText, YesNo, LicenseAgreement, DisplayMessage, UnknownProgress
+from umake.network import get_network_setting
+from umake.network.bundle import Bundle
 from umake.network.download_center import DownloadCenter, DownloadItem
 from umake.network.requirements_handler import RequirementsHandler
+from umake.network.session_pool import SessionPool
 from umake.ui import UI
-from umake.tools import MainLoop, strip_tags, launcher_exists, get_icon_path, get_launcher_path, \
+from umake.tools import CoalescedCall, MainLoop, strip_tags, launcher_exists, get_icon_path, get_launcher_path, \
     Checksum, remove_framework_envs_from_user
+from umake.settings import DEFAULT_PIPELINED_EXTRACTION, DEFAULT_SPECULATIVE_DOWNLOAD
 
 logger = logging.getLogger(__name__)
 
 
 class BaseInstaller(umake.frameworks.BaseFramework):
 
+    TARBALL_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
     def __new__(cls, *args, **kwargs):
         "This class is not meant to be instantiated, so __new__ returns None."
         if cls == BaseInstaller:
@@ -56,8 +65,10 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self.required_files_path = kwargs.get("required_files_path", [])
         self.desktop_filename = kwargs.get("desktop_filename", None)
         self.icon_filename = kwargs.get("icon_filename", None)
+        # other urls whose hosts we'll contact, to connect to them in advance
+        self.warm_up_urls = kwargs.get("warm_up_urls", [])
         for extra_arg in ["download_page", "checksum_type", "dir_to_decompress_in_tarball",
-                          "desktop_filename", "icon_filename", "required_files_path"]:
+                          "desktop_filename", "icon_filename", "required_files_path", "warm_up_urls"]:
             with suppress(KeyError):
                 kwargs.pop(extra_arg)
         super().__init__(*args, **kwargs)
@@ -66,6 +77,14 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self._paths_to_clean = set()
         self._arg_install_path = None
         self.download_requests = []
+        self._page_scraper = None
+        self._streamed_extraction = None
+        self._speculative_download = None
+        self._speculative_lock = Lock()
+        self._speculative_adopted = False
+        self._speculative_declined = False
+        self._speculative_result = None
+        self._speculative_report = None
 
     @property
     def is_installed(self):
@@ -86,6 +105,17 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self.auto_accept_license = auto_accept_license
         super().setup()
 
+        if Bundle().exporting:
+            # nothing is installed, we only download what installing needs to add it to the bundle
+            self.download_provider_page()
+            return
+
+        if get_network_setting("speculative_download", DEFAULT_SPECULATIVE_DOWNLOAD) and not Bundle().importing:
+            # fetch the requirements archives while the next questions are answered
+            RequirementsHandler().prefetch_bucket(self.packages_requirements)
+        # connect to the hosts we'll download from while the next questions are answered
+        SessionPool().warm_up([self.download_page] + self.warm_up_urls)
+
         # first step, check if installed
         if self.is_installed:
             UI.display(YesNo("{} is already installed on your system, do you want to reinstall "
@@ -153,7 +183,14 @@ class BaseInstaller(umake.frameworks.BaseFramework):
 
     def download_provider_page(self):
         logger.debug("Download application provider page")
-        DownloadCenter([DownloadItem(self.download_page)], self.get_metadata_and_check_license, download=False)
+        scrapers = {}
+        self._page_scraper = None
+        # frameworks parsing the page on their own need all of it
+        if type(self).get_metadata_and_check_license is BaseInstaller.get_metadata_and_check_license:
+            self._page_scraper = _ProviderPageScraper(self)
+            scrapers[self.download_page] = self._page_scraper
+        DownloadCenter([DownloadItem(self.download_page)], self.get_metadata_and_check_license, download=False,
+                       scrapers=scrapers)
 
     def parse_license(self, line, license_txt, in_license):
         """Parse license per line, eventually write to license_txt if it's in the license part.
@@ -179,30 +216,15 @@ class BaseInstaller(umake.frameworks.BaseFramework):
             logger.error("An error occurred while downloading {}: {}".format(self.download_page, error_msg))
             UI.return_main_screen(status_code=1)
 
-        url, checksum = (None, None)
-        with StringIO() as license_txt:
-            in_license = False
-            in_download = False
+        scraper = self._page_scraper
+        if scraper is None or not scraper.closed:
+            # the page wasn't parsed while downloading
+            scraper = _ProviderPageScraper(self)
             for line in result[self.download_page].buffer:
-                line_content = line.decode()
-
-                if self.expect_license and not self.auto_accept_license:
-                    in_license = self.parse_license(line_content, license_txt, in_license)
-
-                # always take the first valid (url, checksum):
-                download = None
-                if url is None or (self.checksum_type and not checksum):
-                    (download, in_download) = self.parse_download_link(line_content, in_download)
-                if download is not None:
-                    (newurl, new_checksum) = download
-                    url = newurl if newurl is not None else url
-                    checksum = new_checksum if new_checksum is not None else checksum
-                    if url is not None:
-                        if self.checksum_type and checksum:
-                            logger.debug("Found download link for {}, checksum: {}".format(url, checksum))
-                        elif not self.checksum_type:
-                            logger.debug("Found download link for {}".format(url))
-
+                scraper.parse_line(line)
+        self._page_scraper = None
+        url, checksum = scraper.url, scraper.checksum
+        with scraper.license_txt as license_txt:
             if url is None or (self.checksum_type and checksum is None):
                 logger.error("Download page changed its syntax or is not parsable")
                 UI.return_main_screen(status_code=1)
@@ -210,15 +232,78 @@ class BaseInstaller(umake.frameworks.BaseFramework):
 
             if license_txt.getvalue() != "":
                 logger.debug("Check license agreement.")
-                UI.display(LicenseAgreement(strip_tags(license_txt.getvalue()).strip(),
-                                            self.start_download_and_install,
-                                            UI.return_main_screen))
+                self.display_license(strip_tags(license_txt.getvalue()).strip())
             elif self.expect_license and not self.auto_accept_license:
                 logger.error("We were expecting to find a license on the download page, we didn't.")
                 UI.return_main_screen(status_code=1)
             else:
                 self.start_download_and_install()
 
+    def display_license(self, license_txt):
+        """Ask to accept license_txt before downloading and installing.
+
+        If speculative_download is set in the network configuration, the download starts while the license is
+        displayed, and is cancelled and removed from the cache if it's declined."""
+        if get_network_setting("speculative_download", DEFAULT_SPECULATIVE_DOWNLOAD):
+            logger.debug("Start downloading while the license is displayed")
+            self._speculative_declined = False
+            self._speculative_download = DownloadCenter(urls=self.download_requests,
+                                                        on_done=self._speculative_download_done,
+                                                        report=self._speculative_download_progress)
+        else:
+            SessionPool().warm_up([item.url for item in self.download_requests])
+        UI.display(LicenseAgreement(license_txt, self.start_download_and_install, self.decline_license))
+
+    def _speculative_download_progress(self, downloads):
+        with self._speculative_lock:
+            if not self._speculative_adopted:
+                self._speculative_report = downloads
+                return
+        self.get_progress_download(downloads)
+
+    def _speculative_download_done(self, result):
+        with self._speculative_lock:
+            if not self._speculative_adopted:
+                self._speculative_result = result
+                if self._speculative_declined:
+                    # the license was declined meanwhile, and we waited for the download to stop
+                    self._discard_speculative_download(result)
+                    self._return_main_screen_after_decline()
+                return
+        self.download_done(result)
+
+    @MainLoop.in_mainloop_thread
+    def _return_main_screen_after_decline(self):
+        UI.return_main_screen()
+
+    def _discard_speculative_download(self, result):
+        """Close the files of the declined speculative download, and remove them from the cache"""
+        self._discard_download_result(result)
+        self._speculative_download.forget()
+
+    @staticmethod
+    def _discard_download_result(result):
+        for url in result:
+            if result[url].fd:
+                result[url].fd.close()
+
+    def decline_license(self):
+        """Cancel any speculative download and go back to the main screen.
+
+        A download still running only removes its files once it stopped: we go back to the main screen when it's
+        done, so that we don't exit before."""
+        with self._speculative_lock:
+            download = self._speculative_download
+            self._speculative_declined = True
+            result = self._speculative_result
+        if download:
+            logger.debug("License declined, discard the download")
+            download.cancel()
+            if not result:
+                return
+            self._discard_speculative_download(result)
+        UI.return_main_screen()
+
     def start_download_and_install(self):
         self.last_progress_download = None
         self.last_progress_requirement = None
@@ -229,14 +314,62 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self._download_done_callback_called = False
         UI.display(DisplayMessage("Downloading and installing requirements"))
         self.pbar = ProgressBar().start()
-        self.pkg_to_install = RequirementsHandler().install_bucket(self.packages_requirements,
-                                                                   self.get_progress_requirement,
-                                                                   self.requirement_done)
-        DownloadCenter(urls=self.download_requests, on_done=self.download_done, report=self.get_progress_download)
+        self._progress_updates = CoalescedCall(self._update_progress, merge=self._merge_progress)
+        bundle = Bundle()
+        if bundle.exporting:
+            self.pkg_to_install = False
+            RequirementsHandler().download_bucket(self.packages_requirements, bundle.debs_dir, self.requirement_done)
+        else:
+            if bundle.importing:
+                RequirementsHandler().add_archives(bundle.debs_for(self.category.prog_name, self.prog_name))
+            self.pkg_to_install = RequirementsHandler().install_bucket(self.packages_requirements,
+                                                                       self.get_progress_requirement,
+                                                                       self.requirement_done)
+        self._streamed_extraction = None
+        if self._speculative_download:
+            # the download started while the license was displayed, take it over
+            with self._speculative_lock:
+                self._speculative_adopted = True
+                result, progress = self._speculative_result, self._speculative_report
+            if result:
+                self.download_done(result)
+            elif progress:
+                self.get_progress_download(progress)
+            return
+        consumers = {}
+        if self._can_extract_while_downloading():
+            self._streamed_extraction = StreamingDecompressor(self.install_path)
+            consumers[self.download_requests[0].url] = self._streamed_extraction
+        DownloadCenter(urls=self.download_requests, on_done=self.download_done, report=self.get_progress_download,
+                       consumers=consumers)
+
+    def _can_extract_while_downloading(self):
+        """Return if we can extract our download while it's downloading
+
+        This is only for a single tarball, installed with our default decompress_and_install."""
+        if not get_network_setting("pipelined_extraction", DEFAULT_PIPELINED_EXTRACTION):
+            return False
+        if Bundle().exporting or Bundle().importing:
+            return False
+        if len(self.download_requests) != 1 or \
+                type(self).decompress_and_install is not BaseInstaller.decompress_and_install:
+            return False
+        path = urllib.parse.urlparse(self.download_requests[0].url).path
+        return path.endswith(self.TARBALL_EXTENSIONS)
 
-    @MainLoop.in_mainloop_thread
     def get_progress(self, progress_download, progress_requirement):
-        """Global progress info. Don't use named parameters as idle_add doesn't like it"""
+        """Global progress info, delivered to the main thread at most DEFAULT_PROGRESS_RATE times per second.
+
+        Don't use named parameters as idle_add doesn't like it"""
+        self._progress_updates(progress_download, progress_requirement)
+
+    @staticmethod
+    def _merge_progress(pending_progress, progress):
+        """Keep the latest progress of both download and requirements between two deliveries"""
+        return tuple(new if new is not None else pending for (pending, new) in zip(pending_progress, progress))
+
+    def _update_progress(self, progress_download, progress_requirement):
+        """Update the progress bar with the latest progress info. Run in the main thread"""
 
         if progress_download is not None:
             self.last_progress_download = progress_download
@@ -330,10 +463,28 @@ class BaseInstaller(umake.frameworks.BaseFramework):
                 error_detected = True
             fd = self.result_download[url].fd
         if error_detected:
+            if self._streamed_extraction:
+                self._streamed_extraction.abort()
             UI.return_main_screen(status_code=1)
 
+        if Bundle().exporting:
+            self.export_to_bundle()
+            return
         self.decompress_and_install(fd)
 
+    def export_to_bundle(self):
+        """Append what we downloaded to the bundle, instead of installing it"""
+        bundle = Bundle()
+        try:
+            bundle.write(self.category.prog_name, self.prog_name)
+        except (OSError, tarfile.TarError) as e:
+            logger.error("Couldn't add {} to {}: {}".format(self.name, bundle.path, e))
+            UI.return_main_screen(status_code=1)
+        finally:
+            self._discard_download_result(self.result_download)
+        UI.delayed_display(DisplayMessage("{} added to {}".format(self.name, bundle.path)))
+        UI.return_main_screen()
+
     def decompress_and_install(self, fd):
         UI.display(DisplayMessage("Installing {}".format(self.name)))
         # empty destination directory if reinstall
@@ -341,8 +492,9 @@ class BaseInstaller(umake.frameworks.BaseFramework):
             with suppress(FileNotFoundError):
                 shutil.rmtree(dir_to_remove)
 
+        streamed = {fd: self._streamed_extraction} if self._streamed_extraction else None
         Decompressor({fd: Decompressor.DecompressOrder(dir=self.dir_to_decompress_in_tarball, dest=self.install_path)},
-                     self.decompress_and_install_done)
+                     self.decompress_and_install_done, streamed=streamed)
         UI.display(UnknownProgress(self.iterate_until_install_done))
 
     def post_install(self):
@@ -372,3 +524,68 @@ class BaseInstaller(umake.frameworks.BaseFramework):
     def iterate_until_install_done(self):
         while not self._install_done:
             yield
+
+
+class _ProviderPageScraper:
+    """Parse the provider page of an installer line by line, while it's downloaded.
+
+    It's done as soon as we have the first valid (url, checksum) and the whole license, if we need one."""
+
+    def __init__(self, installer):
+        self.installer = installer
+        self.url = None
+        self.checksum = None
+        self.license_txt = StringIO()
+        self.closed = False
+        self._in_license = False
+        self._license_parsed = False
+        self._in_download = False
+        self._pending = b""
+
+    @property
+    def _expect_license(self):
+        return self.installer.expect_license and not self.installer.auto_accept_license
+
+    @property
+    def done(self):
+        if self.url is None or (self.installer.checksum_type and not self.checksum):
+            return False
+        return not self._expect_license or self._license_parsed
+
+    def write(self, data):
+        """Parse every complete line of data"""
+        lines = (self._pending + bytes(data)).split(b"\n")
+        self._pending = lines.pop()
+        for line in lines:
+            self.parse_line(line + b"\n")
+            if self.done:
+                break
+
+    def close(self):
+        """Parse the last line, which may not end with a new line"""
+        if self._pending and not self.done:
+            self.parse_line(self._pending)
+        self._pending = b""
+        self.closed = True
+
+    def parse_line(self, line):
+        line_content = line.decode()
+
+        if self._expect_license and not self._license_parsed:
+            was_in_license = self._in_license
+            self._in_license = self.installer.parse_license(line_content, self.license_txt, self._in_license)
+            self._license_parsed = was_in_license and not self._in_license
+
+        # always take the first valid (url, checksum):
+        download = None
+        if self.url is None or (self.installer.checksum_type and not self.checksum):
+            (download, self._in_download) = self.installer.parse_download_link(line_content, self._in_download)
+        if download is not None:
+            (newurl, new_checksum) = download
+            self.url = newurl if newurl is not None else self.url
+            self.checksum = new_checksum if new_checksum is not None else self.checksum
+            if self.url is not None:
+                if self.installer.checksum_type and self.checksum:
+                    logger.debug("Found download link for {}, checksum: {}".format(self.url, self.checksum))
+                elif not self.installer.checksum_type:
+                    logger.debug("Found download link for {}".format(self.url))
@@ -56,6 +56,7 @@ class DartLang(umake.frameworks.baseinstaller.BaseInstaller):
         super().__init__(name="Dart SDK", description=_("Dart SDK (default)"), is_category_default=True,
                          category=category, only_on_archs=_supported_archs,
                          download_page="https://api.dartlang.org",
+                         warm_up_urls=["https://storage.googleapis.com"],
                          dir_to_decompress_in_tarball="dart-sdk",
                          required_files_path=[os.path.join("bin", "dart")])
 
@@ -76,6 +76,7 @@ class Eclipse(umake.frameworks.baseinstaller.BaseInstaller):
                          description=_("Pure Eclipse Luna (4.4)"),
                          category=category, only_on_archs=['i386', 'amd64'],
                          download_page=None,
+                         warm_up_urls=["https://www.eclipse.org"],
                          dir_to_decompress_in_tarball='eclipse',
                          desktop_filename='eclipse.desktop',
                          required_files_path=["eclipse"],
@@ -29,7 +29,7 @@ import os
 import platform
 import re
 import umake.frameworks.baseinstaller
-from umake.interactions import Choice, LicenseAgreement, TextWithChoices
+from umake.interactions import Choice, TextWithChoices
 from umake.network.download_center import DownloadCenter, DownloadItem
 from umake.ui import UI
 from umake.tools import create_launcher, get_application_desktop_file, Checksum, MainLoop, strip_tags
@@ -211,9 +211,7 @@ class VisualStudioCode(umake.frameworks.baseinstaller.BaseInstaller):
 
             if license_txt.getvalue() != "":
                 logger.debug("Check license agreement.")
-                UI.display(LicenseAgreement(strip_tags(license_txt.getvalue()).strip(),
-                                            self.start_download_and_install,
-                                            UI.return_main_screen))
+                self.display_license(strip_tags(license_txt.getvalue()).strip())
             else:
                 logger.error("We were expecting to find a license, we didn't.")
                 UI.return_main_screen(status_code=1)
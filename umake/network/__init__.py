@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Network related modules"""
+
+import logging
+import re
+import urllib.parse
+from umake.tools import ConfigHandler
+
+logger = logging.getLogger(__name__)
+
+
+def get_network_setting(name, default=None):
+    """Return name from the network section of the configuration, or default if it isn't set"""
+    config = ConfigHandler().config
+    try:
+        return config["network"][name]
+    except (TypeError, KeyError):
+        return default
+
+
+def get_network_number(name, default, convert=int):
+    """Return name from the network section of the configuration as a number, converted by convert.
+
+    Return default, with a warning, if it isn't set or isn't a valid number."""
+    value = get_network_setting(name, default)
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        logger.warning("Invalid {} network setting: {}, using {}".format(name, value, default))
+        return convert(default)
+
+
+def parse_range(range_header, size):
+    """Return the (start, end) range of a size bytes content requested by a Range header value.
+
+    Return None if the whole content is requested (or the range isn't a simple one we support). start can be past end
+    if the range can't be satisfied."""
+    match = re.match(r'bytes=(\d+)-(\d*)$', (range_header or "").strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    return int(start), min(int(end) if end else size - 1, size - 1)
+
+
+def cache_server_url(server, download_item):
+    """Return the url to get download_item through the umake cache server at the server url"""
+    query = [("url", download_item.url)]
+    checksum = download_item.checksum
+    if checksum and checksum.checksum_type and checksum.checksum_value:
+        query.append(("checksum", "{}:{}".format(checksum.checksum_type.name, checksum.checksum_value)))
+    if download_item.ignore_encoding:
+        query.append(("ignore_encoding", "1"))
+    query.extend([("mirror", mirror) for mirror in download_item.mirrors or []])
+    return "{}/artifact?{}".format(server.rstrip("/"), urllib.parse.urlencode(query))
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module keeping downloaded artifacts across runs, addressed by their content"""
+
+from collections import namedtuple
+from contextlib import suppress
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+from umake.network import get_network_number
+from umake.network.partial_download import DownloadedFile, PartialDownload
+from umake.settings import DEFAULT_CACHE_MAX_SIZE
+from umake.tools import get_cache_path
+import yaml
+import yaml.parser
+import yaml.scanner
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry(namedtuple('CacheEntry', ['key', 'url', 'size', 'last_used', 'path'])):
+    """An artifact in the cache. last_used is a timestamp"""
+    pass
+
+
+class ArtifactCache:
+    """Persistent cache of downloaded artifacts.
+
+    Artifacts are keyed by their checksum, or by their url and ETag if there is none. The cache is capped to
+    cache_max_size MiB (from the network configuration section), evicting least recently used artifacts first.
+    Partial downloads count in that size, and are removed once not continued for PARTIAL_DOWNLOAD_MAX_AGE, like
+    the ones of versions no longer available."""
+
+    PARTIAL_DOWNLOAD_MAX_AGE = 7 * 24 * 60 * 60  # in seconds
+
+    def __init__(self):
+        self.path = get_cache_path("artifacts")
+        self.max_size = get_network_number("cache_max_size", DEFAULT_CACHE_MAX_SIZE) * 1024 * 1024
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    @staticmethod
+    def key_for(download_item, etag=None):
+        """Return the cache key for download_item, or None if we can't identify its content.
+
+        Without checksum, we need the ETag the server sent for it."""
+        checksum = download_item.checksum
+        if checksum and checksum.checksum_type and checksum.checksum_value:
+            return "{}-{}".format(checksum.checksum_type.name, checksum.checksum_value.lower())
+        if etag:
+            key = "{}\n{}".format(download_item.url, etag)
+            return "url-{}".format(hashlib.sha256(key.encode('utf-8')).hexdigest())
+        return None
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key, suffix=""):
+        """Return a DownloadedFile on a copy of the cached artifact for key, or None if it's not cached
+
+        The copy is a hard link when possible, so that we can give it away to be deleted after use."""
+        if not key or not self.enabled:
+            return None
+        entry_path = self._entry_path(key)
+        if not os.path.isfile(entry_path):
+            return None
+        download_dir = get_cache_path("downloads")
+        os.makedirs(download_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix=key + "-", suffix=suffix, dir=download_dir)
+        os.close(fd)
+        try:
+            os.remove(path)
+            os.link(entry_path, path)
+        except FileNotFoundError:
+            # evicted in between
+            return None
+        except OSError:
+            shutil.copyfile(entry_path, path)
+        # mark as recently used
+        with suppress(OSError):
+            os.utime(entry_path)
+        logger.debug("Cache hit for {}".format(key))
+        return DownloadedFile(path)
+
+    def add(self, key, path, url):
+        """Store the file at path in the cache for key, then evict old artifacts if we are over the size limit"""
+        if not key or not self.enabled:
+            return
+        size = os.path.getsize(path)
+        if size > self.max_size:
+            logger.debug("{} is bigger than the cache size limit, not caching it".format(url))
+            return
+        os.makedirs(self.path, exist_ok=True)
+        entry_path = self._entry_path(key)
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=key + "-", suffix=".new", dir=self.path)
+            os.close(fd)
+            os.remove(tmp_path)
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copyfile(path, tmp_path)
+            with open(entry_path + ".yaml.new", 'w') as f:
+                yaml.dump({"url": url}, f, default_flow_style=False)
+            os.replace(entry_path + ".yaml.new", entry_path + ".yaml")
+            os.replace(tmp_path, entry_path)
+            os.utime(entry_path)
+        except OSError as e:
+            logger.warning("Couldn't add {} to the cache: {}".format(url, e))
+            return
+        logger.debug("Added {} to cache as {}".format(url, key))
+        self.prune()
+
+    def entries(self):
+        """Return every artifact in the cache, most recently used first"""
+        entries = []
+        with suppress(FileNotFoundError):
+            for key in os.listdir(self.path):
+                entry_path = self._entry_path(key)
+                if key.endswith((".yaml", ".new")) or not os.path.isfile(entry_path):
+                    continue
+                url = None
+                with suppress(OSError, TypeError, KeyError, yaml.scanner.ScannerError, yaml.parser.ParserError):
+                    with open(entry_path + ".yaml") as f:
+                        url = yaml.safe_load(f)["url"]
+                try:
+                    stat = os.stat(entry_path)
+                except FileNotFoundError:
+                    continue
+                entries.append(CacheEntry(key=key, url=url, size=stat.st_size, last_used=stat.st_mtime,
+                                          path=entry_path))
+        return sorted(entries, key=lambda entry: entry.last_used, reverse=True)
+
+    def remove(self, entry):
+        """Remove that entry from the cache"""
+        logger.debug("Remove {} from cache".format(entry.key))
+        for path in (entry.path, entry.path + ".yaml"):
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
+    def discard(self, key):
+        """Remove the artifact for key from the cache, if it's there"""
+        if key:
+            self.remove(CacheEntry(key=key, url=None, size=None, last_used=None, path=self._entry_path(key)))
+
+    @staticmethod
+    def partial_downloads():
+        """Return the partial downloads kept in the cache directory, as entries without url"""
+        return [CacheEntry(key=os.path.basename(path), url=None, size=size, last_used=last_modified, path=path)
+                for (path, size, last_modified) in PartialDownload.on_disk()]
+
+    def prune(self, max_size=None):
+        """Evict least recently used artifacts and partial downloads until they fit in max_size bytes (default to
+        the cache limit, if the cache is enabled)
+
+        Partial downloads older than PARTIAL_DOWNLOAD_MAX_AGE are removed anyway. The ones being downloaded are kept.
+        Return the list of removed entries."""
+        if max_size is None and self.enabled:
+            max_size = self.max_size
+        removed = []
+        total_size = 0
+        partial_downloads = self.partial_downloads()
+        expired = time.time() - self.PARTIAL_DOWNLOAD_MAX_AGE
+        for entry in sorted(self.entries() + partial_downloads, key=lambda entry: entry.last_used, reverse=True):
+            total_size += entry.size
+            is_partial = entry in partial_downloads
+            if (max_size is not None and total_size > max_size) or (is_partial and entry.last_used < expired):
+                if not is_partial:
+                    self.remove(entry)
+                elif not PartialDownload.remove_unused(entry.path):
+                    continue
+                removed.append(entry)
+        return removed
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module multiplexing http downloads on a single asyncio event loop"""
+
+import asyncio
+from concurrent import futures
+import http.client
+from io import BytesIO
+import logging
+import os
+import ssl
+from threading import Thread
+import urllib.parse
+import zlib
+
+import requests.certs
+import requests.cookies
+import requests.exceptions
+import requests.structures
+import requests.utils
+from umake.network import get_network_number
+from umake.settings import DEFAULT_ASYNC_MAX_CONNECTIONS, DEFAULT_CONNECTION_POOL_SIZE, \
+    DEFAULT_MAX_CONNECTIONS_PER_HOST
+from umake.tools import Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDownloadEngine(object, metaclass=Singleton):
+    """Run download coroutines on a process wide asyncio event loop, in a single background thread.
+
+    Coroutines get http and https responses with get(), and read their content by chunks. They hold a slot() while
+    they transfer: at most max_connections at once (async_max_connections in the network configuration section),
+    and max_connections_per_host against the same host. Others wait for a slot, in order.
+    Connections are kept alive and reused between requests to the same host. Responses are only read as fast as
+    their content is consumed, the kernel buffers and then the server are slowed down otherwise.
+    Results are delivered as concurrent futures, like DownloadScheduler ones. Their callbacks run in a separate
+    thread, so that slow ones don't hold the transfers back, and are bridged to the MainLoop the same way."""
+
+    READ_SIZE = 1024 * 64
+    # responses with larger headers are refused, StreamReader buffers twice that before pausing the transfer
+    STREAM_LIMIT = 1024 * 256
+    MAX_REDIRECTS = 30
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+    def __init__(self):
+        self.max_connections = get_network_number("async_max_connections", DEFAULT_ASYNC_MAX_CONNECTIONS)
+        self.max_connections_per_host = get_network_number("max_connections_per_host", DEFAULT_MAX_CONNECTIONS_PER_HOST)
+        self.pool_size = get_network_number("pool_size", DEFAULT_CONNECTION_POOL_SIZE)
+        # CA bundle path: ssl context verifying certificates with it
+        self._ssl_contexts = {}
+        # only used in the event loop thread
+        self._slots = None
+        self._host_slots = {}
+        # (scheme, host, port): [(reader, writer)] of idle kept alive connections
+        self._idle_connections = {}
+        # owner: set of its running tasks
+        self._tasks = {}
+        self._callbacks_executor = futures.ThreadPoolExecutor(max_workers=1)
+        self._loop = asyncio.new_event_loop()
+        Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        """Event loop thread main loop"""
+        asyncio.set_event_loop(self._loop)
+        self._slots = asyncio.Semaphore(self.max_connections)
+        self._loop.run_forever()
+
+    def submit(self, owner, coroutine_function, *args):
+        """Run coroutine_function(*args) on the event loop. Return a concurrent Future on its result
+
+        The task can be cancelled with the other ones submitted by owner, with cancel(owner)."""
+        future = futures.Future()
+
+        def start():
+            if not future.set_running_or_notify_cancel():
+                return
+            task = self._loop.create_task(coroutine_function(*args))
+            self._tasks.setdefault(owner, set()).add(task)
+            task.add_done_callback(lambda task: self._task_done(owner, task, future))
+        self._loop.call_soon_threadsafe(start)
+        return future
+
+    def _task_done(self, owner, task, future):
+        tasks = self._tasks.get(owner, set())
+        tasks.discard(task)
+        if not tasks:
+            self._tasks.pop(owner, None)
+        if task.cancelled():
+            self._callbacks_executor.submit(future.set_exception, asyncio.CancelledError())
+        elif task.exception() is not None:
+            self._callbacks_executor.submit(future.set_exception, task.exception())
+        else:
+            self._callbacks_executor.submit(future.set_result, task.result())
+
+    def cancel(self, owner):
+        """Cancel the running tasks submitted by owner. They get an asyncio.CancelledError where they are waiting"""
+        def cancel_tasks():
+            for task in self._tasks.get(owner, set()):
+                # after their first step, which is already scheduled, so that they always see the cancellation
+                self._loop.call_soon(task.cancel)
+        self._loop.call_soon_threadsafe(cancel_tasks)
+
+    def slot(self, url):
+        """Return an asynchronous context manager holding a connection slot to url host"""
+        host = urllib.parse.urlparse(url).netloc.lower()
+        if host not in self._host_slots:
+            self._host_slots[host] = asyncio.Semaphore(self.max_connections_per_host)
+        return _Slot(self._host_slots[host], self._slots)
+
+    async def get(self, url, headers=None, cookies=None, timeout=None):
+        """Request url, following redirections. Return its _AsyncResponse, once its headers are received.
+
+        headers and cookies are dictionaries (or a cookie jar) sent with the request. timeout is a (connect, read)
+        tuple of seconds. The response cookies are those set by it and by the redirections leading to it.
+        Errors are raised as the requests exceptions requests would raise, so that they are retried the same way."""
+        request_cookies = requests.cookies.merge_cookies(requests.cookies.RequestsCookieJar(), cookies)
+        received_cookies = requests.cookies.RequestsCookieJar()
+        for redirect in range(self.MAX_REDIRECTS + 1):
+            request = requests.Request("GET", url).prepare()
+            response = await self._request(url, headers, requests.cookies.get_cookie_header(request_cookies, request),
+                                           timeout or (None, None))
+            response_cookies = requests.cookies.RequestsCookieJar()
+            response_cookies.extract_cookies(requests.cookies.MockResponse(response.message),
+                                             requests.cookies.MockRequest(request))
+            request_cookies.update(response_cookies)
+            received_cookies.update(response_cookies)
+            location = response.headers.get("location")
+            if response.status_code not in self.REDIRECT_CODES or not location:
+                response.cookies = received_cookies
+                return response
+            await response.discard()
+            url = requests.utils.requote_uri(urllib.parse.urljoin(url, location))
+            logger.debug("Redirected to {}".format(url))
+        raise requests.exceptions.TooManyRedirects("Exceeded {} redirects".format(self.MAX_REDIRECTS))
+
+    def _ssl_context(self):
+        """Return the ssl context verifying certificates with the CA bundle requests would use
+
+        Like requests sessions, REQUESTS_CA_BUNDLE or CURL_CA_BUNDLE from the environment take precedence."""
+        ca_bundle = os.environ.get("REQUESTS_CA_BUNDLE") or os.environ.get("CURL_CA_BUNDLE") or requests.certs.where()
+        context = self._ssl_contexts.get(ca_bundle)
+        if context is None:
+            if os.path.isdir(ca_bundle):
+                context = ssl.create_default_context(capath=ca_bundle)
+            else:
+                context = ssl.create_default_context(cafile=ca_bundle)
+            self._ssl_contexts[ca_bundle] = context
+        return context
+
+    async def _request(self, url, headers, cookie_header, timeout):
+        """Send a GET request for url, on a kept alive connection if we have one. Return its _AsyncResponse"""
+        parsed_url = urllib.parse.urlparse(url)
+        scheme = parsed_url.scheme.lower()
+        if scheme not in ("http", "https"):
+            raise requests.exceptions.InvalidSchema("No connection adapters were found for {}".format(url))
+        port = parsed_url.port or (443 if scheme == "https" else 80)
+        key = (scheme, parsed_url.hostname, port)
+
+        request_headers = requests.utils.default_headers()
+        # we only decode those
+        request_headers["Accept-Encoding"] = "gzip, deflate"
+        request_headers["Host"] = parsed_url.netloc.rpartition("@")[2]
+        request_headers.update(headers or {})
+        if cookie_header:
+            request_headers["Cookie"] = cookie_header
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path += "?" + parsed_url.query
+        request = "GET {} HTTP/1.1\r\n{}\r\n\r\n".format(
+            path, "\r\n".join(["{}: {}".format(name, value) for name, value in request_headers.items()]))
+
+        connection = self._idle_connection(key)
+        if connection:
+            try:
+                return await self._send(key, connection, url, request.encode('latin-1'), timeout)
+            except requests.exceptions.ConnectionError as e:
+                # the server may have closed it while it was idle
+                logger.debug("Kept alive connection to {} failed ({}), opening a new one".format(url, e))
+        connection = await self._connect(key, timeout[0])
+        return await self._send(key, connection, url, request.encode('latin-1'), timeout)
+
+    def _idle_connection(self, key):
+        """Return a kept alive connection to key, or None if there is none"""
+        connections = self._idle_connections.get(key, [])
+        while connections:
+            reader, writer = connections.pop()
+            if not reader.at_eof() and not writer.transport.is_closing():
+                return reader, writer
+            writer.close()
+        return None
+
+    def _release(self, key, connection):
+        """Keep connection alive for the next request to key, if the pool isn't full"""
+        connections = self._idle_connections.setdefault(key, [])
+        if len(connections) < self.pool_size:
+            connections.append(connection)
+        else:
+            connection[1].close()
+
+    async def _connect(self, key, timeout):
+        """Open a new connection to key"""
+        scheme, host, port = key
+        tls_options = {"ssl": self._ssl_context(), "server_hostname": host} if scheme == "https" else {}
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(host, port, limit=self.STREAM_LIMIT,
+                                                                  **tls_options), timeout)
+        except asyncio.TimeoutError:
+            raise requests.exceptions.ConnectTimeout("Connection to {}:{} timed out".format(host, port))
+        except ssl.SSLError as e:
+            raise requests.exceptions.SSLError(e)
+        except OSError as e:
+            raise requests.exceptions.ConnectionError("Couldn't connect to {}:{}: {}".format(host, port, e))
+
+    async def _send(self, key, connection, url, request, timeout):
+        """Send request on connection and return its _AsyncResponse, once its headers are received"""
+        reader, writer = connection
+        try:
+            writer.write(request)
+            await _with_timeout(writer.drain(), timeout[1])
+            while True:
+                head = await _with_timeout(reader.readuntil(b"\r\n\r\n"), timeout[1])
+                status_line, _, raw_headers = head.partition(b"\r\n")
+                version, status_code, reason = (status_line.decode('latin-1').split(" ", 2) + [""])[:3]
+                # skip informational responses, like 100 Continue
+                if not 100 <= int(status_code) < 200:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, OSError,
+                requests.exceptions.ConnectionError) as e:
+            writer.close()
+            raise requests.exceptions.ConnectionError("Invalid or no response from {}: {}".format(url, e))
+        except BaseException:
+            writer.close()
+            raise
+        message = http.client.parse_headers(BytesIO(raw_headers))
+        return _AsyncResponse(self, key, connection, url, version, int(status_code), reason.strip(), message,
+                              timeout[1])
+
+
+class _Slot:
+    """Connection slot to a host, which has to be taken before the global one so that waiting doesn't hold it"""
+
+    def __init__(self, host_slots, slots):
+        self._semaphores = (host_slots, slots)
+
+    async def __aenter__(self):
+        await self._semaphores[0].acquire()
+        try:
+            await self._semaphores[1].acquire()
+        except BaseException:
+            self._semaphores[0].release()
+            raise
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        self._semaphores[1].release()
+        self._semaphores[0].release()
+
+
+async def _with_timeout(awaitable, timeout):
+    """Await awaitable, raising requests ReadTimeout if it takes more than timeout seconds (None for no timeout)"""
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise requests.exceptions.ReadTimeout("Read timed out after {}s".format(timeout))
+
+
+class _AsyncResponse:
+    """Response of the AsyncDownloadEngine, with requests like status_code, reason, headers, url and cookies.
+
+    Its content is read by chunks with read(). close() puts the connection back in the engine pool if the whole
+    content was read and the server keeps it alive."""
+
+    def __init__(self, engine, key, connection, url, version, status_code, reason, message, timeout):
+        self._engine = engine
+        self._key = key
+        self._reader, self._writer = connection
+        self._timeout = timeout
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.message = message
+        self.headers = requests.structures.CaseInsensitiveDict(message.items())
+        self.cookies = requests.cookies.RequestsCookieJar()
+
+        connection_header = self.headers.get("connection", "").lower()
+        self._keep_alive = version == "HTTP/1.1" and "close" not in connection_header
+        self._chunked = "chunked" in self.headers.get("transfer-encoding", "").lower()
+        self._remaining = None
+        self._chunk_remaining = 0
+        self._done = False
+        if status_code in (204, 304):
+            self._done = True
+        elif not self._chunked:
+            try:
+                self._remaining = int(self.headers["content-length"])
+            except (KeyError, ValueError):
+                # read until the server closes the connection
+                self._keep_alive = False
+        self._decoder = None
+        self._decoder_type = None
+
+    def raise_for_status(self):
+        """Raise a requests HTTPError for error status codes"""
+        if 400 <= self.status_code < 600:
+            response = requests.Response()
+            response.status_code = self.status_code
+            response.reason = self.reason
+            response.url = self.url
+            response.raise_for_status()
+
+    async def _read_raw(self, size):
+        """Return up to size bytes of the content as sent by the server, b"" at its end"""
+        try:
+            if self._done:
+                return b""
+            if self._chunked:
+                if not self._chunk_remaining:
+                    line = await _with_timeout(self._reader.readline(), self._timeout)
+                    self._chunk_remaining = int(line.split(b";")[0], 16)
+                    if not self._chunk_remaining:
+                        # skip trailers
+                        while line not in (b"\r\n", b"\n", b""):
+                            line = await _with_timeout(self._reader.readline(), self._timeout)
+                        self._done = True
+                        return b""
+                data = await _with_timeout(self._reader.read(min(size, self._chunk_remaining)), self._timeout)
+                if not data:
+                    raise requests.exceptions.ChunkedEncodingError("Connection broken in a chunk")
+                self._chunk_remaining -= len(data)
+                if not self._chunk_remaining:
+                    await _with_timeout(self._reader.readline(), self._timeout)
+                return data
+            if self._remaining is None:
+                data = await _with_timeout(self._reader.read(size), self._timeout)
+                self._done = not data
+                return data
+            if not self._remaining:
+                self._done = True
+                return b""
+            data = await _with_timeout(self._reader.read(min(size, self._remaining)), self._timeout)
+            if not data:
+                raise requests.exceptions.ChunkedEncodingError(
+                    "Connection broken: IncompleteRead, {} bytes more expected".format(self._remaining))
+            self._remaining -= len(data)
+            return data
+        except ValueError as e:
+            raise requests.exceptions.ChunkedEncodingError("Invalid chunk: {}".format(e))
+        except OSError as e:
+            raise requests.exceptions.ConnectionError(e)
+
+    def _decode(self, data, flush=False):
+        """Return data, decoded following the content encoding"""
+        encoding = self.headers.get("content-encoding", "identity").lower()
+        if encoding not in ("gzip", "x-gzip", "deflate"):
+            return data
+        try:
+            if self._decoder is None:
+                # deflate is sometimes sent without its zlib header
+                if encoding == "deflate" and data and data[0] & 0x0f != zlib.DEFLATED:
+                    self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                else:
+                    self._decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            return self._decoder.decompress(data) + (self._decoder.flush() if flush else b"")
+        except zlib.error as e:
+            raise requests.exceptions.ContentDecodingError("Couldn't decode the {} content: {}".format(encoding, e))
+
+    async def read(self, size, decode_content=True):
+        """Return the next chunk of up to size bytes as sent by the server, or decoded. b"" at the end of the content"""
+        while True:
+            data = await self._read_raw(size)
+            if not decode_content:
+                return data
+            decoded = self._decode(data, flush=not data)
+            if decoded or not data:
+                return decoded
+
+    async def discard(self, max_size=1024 * 64):
+        """Skip the content, if small enough to keep the connection alive, and close the response"""
+        size = 0
+        while size < max_size and not self._done:
+            size += len(await self._read_raw(self._engine.READ_SIZE))
+        self.close()
+
+    def close(self):
+        """Release or close the connection"""
+        if self._writer is None:
+            return
+        if self._done and self._keep_alive:
+            self._engine._release(self._key, (self._reader, self._writer))
+        else:
+            self._writer.close()
+        self._writer = None
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Module limiting the bandwidth used by downloads"""
+
+import logging
+import os
+import re
+from threading import Lock
+import time
+from umake.network import get_network_setting
+from umake.settings import DEFAULT_LIMIT_RATE, DEFAULT_LIMIT_RATE_PER_DOWNLOAD, UMAKE_LIMIT_RATE_ENVIRON_VARIABLE
+from umake.tools import Singleton
+
+logger = logging.getLogger(__name__)
+
+
+def parse_rate(rate):
+    """Return the number of bytes per second of a rate like 500K, 2M or 1048576. 0 means unlimited
+
+    Raise ValueError if rate isn't valid."""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kKmMgG]?)\s*$', str(rate))
+    if not match:
+        raise ValueError("Invalid rate: {}".format(rate))
+    value, unit = match.groups()
+    return int(float(value) * 1024 ** " kmg".index(unit.lower() or " "))
+
+
+class TokenBucket:
+    """Token bucket letting rate bytes per second through, with bursts up to one second of traffic.
+
+    It's shared between threads: each consumer takes its tokens and waits for any debt it made."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._last_refill = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self, size):
+        """Take the tokens for size bytes. Return how many seconds the caller has to wait before letting them through"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            self._tokens -= size
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def consume(self, size):
+        """Wait until we can let size bytes through. Return how many seconds we waited"""
+        wait = self.reserve(size)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class BandwidthLimiter(object, metaclass=Singleton):
+    """Process wide bandwidth limits.
+
+    The global rate comes from --limit-rate, then the UMAKE_LIMIT_RATE environment variable, then limit_rate in the
+    network configuration section. limit_rate_per_download (from the configuration) caps each download on its own.
+    Rates are in bytes per second, with an optional K, M or G suffix. 0 means unlimited."""
+
+    def __init__(self):
+        self._global_bucket = None
+        self.per_download_rate = self._rate_setting(get_network_setting("limit_rate_per_download",
+                                                                        DEFAULT_LIMIT_RATE_PER_DOWNLOAD))
+        self.set_rate(self._rate_setting(os.environ.get(UMAKE_LIMIT_RATE_ENVIRON_VARIABLE) or
+                                         get_network_setting("limit_rate", DEFAULT_LIMIT_RATE)))
+
+    @staticmethod
+    def _rate_setting(rate):
+        try:
+            return parse_rate(rate)
+        except ValueError as e:
+            logger.warning("{}, ignoring this bandwidth limit".format(e))
+            return 0
+
+    @property
+    def rate(self):
+        return self._global_bucket.rate if self._global_bucket else 0
+
+    def set_rate(self, rate):
+        """Limit every download of the process to rate bytes per second. 0 means unlimited"""
+        self._global_bucket = TokenBucket(rate) if rate else None
+        if rate:
+            logger.debug("Limit downloads to {} bytes/s".format(rate))
+
+    def throttle(self):
+        """Return a new Throttle for one download"""
+        buckets = []
+        if self._global_bucket:
+            buckets.append(self._global_bucket)
+        if self.per_download_rate:
+            buckets.append(TokenBucket(self.per_download_rate))
+        return Throttle(buckets)
+
+
+class Throttle:
+    """Slow down one download to the bandwidth limits applying to it"""
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+
+    @property
+    def rate(self):
+        """The lowest rate we are limited to, in bytes per second. 0 means unlimited"""
+        return min([bucket.rate for bucket in self._buckets], default=0)
+
+    def consume(self, size):
+        """Wait until size more bytes can be received. Return how many seconds we waited"""
+        return sum([bucket.consume(size) for bucket in self._buckets])
+
+    def reserve(self, size):
+        """Take the tokens for size more bytes, without waiting. Return how many seconds to wait before receiving them
+
+        For event loops, which can't block in consume()."""
+        return sum([bucket.reserve(size) for bucket in self._buckets])
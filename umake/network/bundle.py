@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module exporting what frameworks download to offline install bundles, and installing from them"""
+
+import atexit
+from contextlib import suppress
+import hashlib
+from io import BytesIO
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+from threading import Lock
+from umake.network.partial_download import copy_file_range, DownloadedFile
+from umake.tools import Singleton
+import yaml
+import yaml.parser
+import yaml.scanner
+
+logger = logging.getLogger(__name__)
+
+
+class Bundle(object, metaclass=Singleton):
+    """Offline install bundle: an uncompressed tar archive of what frameworks download to be installed.
+
+    When exporting, the pages and artifacts the DownloadCenter gets, and the package archives the requirements need,
+    are appended to the bundle with a manifest per framework, instead of installing it.
+    When importing, the DownloadCenter serves every url from the bundle without any network access, artifacts being
+    copied out of it in the kernel, and package archives are put in the apt archive cache."""
+
+    MANIFESTS_DIR = "manifests"
+    DOWNLOADS_DIR = "downloads"
+    DEBS_DIR = "debs"
+
+    def __init__(self):
+        self.path = None
+        self.exporting = False
+        self.importing = False
+        self._lock = Lock()
+        self._work_dir = None
+        # url: {"path": member name, "final_url": url after redirections}
+        self._downloads = {}
+        # (category, framework): manifest
+        self._manifests = {}
+        self._members = {}
+        self._fd = None
+
+    def _create_work_dir(self):
+        if self._work_dir:
+            return
+        self._work_dir = tempfile.mkdtemp(prefix="umake-bundle-")
+        atexit.register(shutil.rmtree, self._work_dir, True)
+
+    def export_to(self, path):
+        """Record what is downloaded, to append it to the bundle at path"""
+        self.path = path
+        self.exporting = True
+        self._create_work_dir()
+        with self._lock:
+            self._downloads = {}
+
+    def import_from(self, path):
+        """Serve downloads from the bundle at path. Raise if it can't be read"""
+        self.path = path
+        self.importing = True
+        self._create_work_dir()
+        with tarfile.open(path, 'r:') as tar:
+            # later members replace previous ones of the same name, appended by a new export
+            self._members = {member.name: member for member in tar.getmembers()}
+            self._manifests = self._read_manifests(tar)
+        for manifest in self._manifests.values():
+            self._downloads.update(manifest["downloads"])
+        self._fd = os.open(path, os.O_RDONLY)
+
+    @classmethod
+    def frameworks_in(cls, path):
+        """Return the list of (category, framework) prog names exported to the bundle at path"""
+        with tarfile.open(path, 'r:') as tar:
+            return list(cls._read_manifests(tar))
+
+    @classmethod
+    def _read_manifests(cls, tar):
+        """Return a dict of (category, framework): manifest of every framework in tar"""
+        manifests = {}
+        for member in tar.getmembers():
+            if not member.isfile() or os.path.dirname(member.name) != cls.MANIFESTS_DIR:
+                continue
+            try:
+                manifest = yaml.safe_load(tar.extractfile(member))
+                manifests[(manifest["category"], manifest["framework"])] = manifest
+            except (TypeError, KeyError, yaml.scanner.ScannerError, yaml.parser.ParserError) as e:
+                raise tarfile.TarError("Invalid manifest {}: {}".format(member.name, e))
+        return manifests
+
+    @property
+    def debs_dir(self):
+        """Directory where to download the package archives to export"""
+        return os.path.join(self._work_dir, self.DEBS_DIR)
+
+    def record(self, url, dest, final_url):
+        """Keep what was downloaded from url, to export it. dest is the downloaded file or in memory buffer"""
+        name = "{}/{}".format(self.DOWNLOADS_DIR, hashlib.sha256(url.encode('utf-8')).hexdigest())
+        path = os.path.join(self._work_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with suppress(FileNotFoundError):
+            os.remove(path + ".new")
+        if isinstance(dest, DownloadedFile):
+            try:
+                os.link(dest.name, path + ".new")
+            except OSError:
+                shutil.copyfile(dest.name, path + ".new")
+        else:
+            copy = dest.duplicate()
+            copy.seek(0)
+            with open(path + ".new", 'wb') as f:
+                shutil.copyfileobj(copy, f)
+            copy.close()
+        os.replace(path + ".new", path)
+        with self._lock:
+            self._downloads[url] = {"path": name, "final_url": final_url}
+        logger.debug("Recorded {} for the bundle".format(url))
+
+    def write(self, category, framework):
+        """Append what was recorded to the bundle, with the manifest of framework in category.
+
+        What was recorded is then forgotten: the next framework exported only gets what it downloads."""
+        with self._lock:
+            downloads = dict(self._downloads)
+        debs = []
+        if os.path.isdir(self.debs_dir):
+            debs = ["{}/{}".format(self.DEBS_DIR, filename) for filename in sorted(os.listdir(self.debs_dir))]
+        manifest = yaml.dump({"category": category, "framework": framework, "downloads": downloads, "debs": debs},
+                             default_flow_style=False).encode('utf-8')
+        logger.info("Add {} {} to the bundle {}".format(category, framework, self.path))
+        with tarfile.open(self.path, 'a') as tar:
+            for name in [download["path"] for download in downloads.values()] + debs:
+                tar.add(os.path.join(self._work_dir, name), arcname=name)
+            info = tarfile.TarInfo("{}/{}-{}.yaml".format(self.MANIFESTS_DIR, category, framework))
+            info.size = len(manifest)
+            tar.addfile(info, BytesIO(manifest))
+        with self._lock:
+            for url in downloads:
+                self._downloads.pop(url, None)
+        for name in [download["path"] for download in downloads.values()] + debs:
+            with suppress(FileNotFoundError):
+                os.remove(os.path.join(self._work_dir, name))
+
+    def get(self, url):
+        """Return a tuple (path, final_url) of the content of url in the bundle. Raise if it isn't in it"""
+        with self._lock:
+            download = self._downloads.get(url)
+            if download is None:
+                raise BaseException("{} isn't in the bundle {}".format(url, self.path))
+            return self._extract(download["path"]), download["final_url"]
+
+    def debs_for(self, category, framework):
+        """Return the paths of the package archives exported for framework in category"""
+        manifest = self._manifests.get((category, framework))
+        if manifest is None:
+            return []
+        with self._lock:
+            return [self._extract(name) for name in manifest["debs"]]
+
+    def _extract(self, name):
+        """Return the path of the name member, copied out of the bundle if it isn't yet"""
+        path = os.path.join(self._work_dir, name)
+        if os.path.exists(path):
+            return path
+        member = self._members.get(name)
+        if member is None or not member.isfile():
+            raise BaseException("{} is missing in the bundle {}".format(name, self.path))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".new", 'wb') as f:
+            copied = 0
+            while copied < member.size:
+                size = copy_file_range(self._fd, f.fileno(), member.offset_data + copied, copied,
+                                       member.size - copied)
+                if not size:
+                    raise BaseException("The bundle {} is truncated".format(self.path))
+                copied += size
+        os.replace(path + ".new", path)
+        return path
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module serving the artifact cache to other machines, downloading on their behalf what it doesn't have yet"""
+
+from contextlib import suppress
+from http.cookies import CookieError, SimpleCookie
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import ipaddress
+import logging
+import os
+import requests
+import socket
+from socketserver import ThreadingMixIn
+import tempfile
+from threading import Condition, Lock, Thread
+import urllib.parse
+from umake.network import parse_range
+from umake.network.artifact_cache import ArtifactCache
+from umake.network.download_center import DownloadCenter, DownloadItem
+from umake.network.request_coalescer import RequestCoalescer
+from umake.network.session_pool import SessionPool
+from umake.settings import DEFAULT_CACHE_SERVER_ADDRESS, DEFAULT_CACHE_SERVER_PORT
+from umake.tools import Checksum, ChecksumType, get_cache_path
+
+logger = logging.getLogger(__name__)
+
+
+class FetchFailed(BaseException):
+    """Exception raised to clients of an artifact whose download failed, or restarted after they got some content"""
+
+
+class _Fetch:
+    """An artifact downloaded once for every client asking for it at the same time.
+
+    Without checksum, the content is teed in order to a temporary file while it downloads, clients stream it from
+    there as soon as it arrives. Artifacts with a checksum are only sent once checked, as other clients mustn't get
+    content which may be corrupted. Once the download is done, clients read (the rest of) the downloaded file."""
+
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, download_item, on_done):
+        self.download_item = download_item
+        self._on_done = on_done
+        self._condition = Condition()
+        download_dir = get_cache_path("downloads")
+        os.makedirs(download_dir, exist_ok=True)
+        self._tee = tempfile.TemporaryFile(dir=download_dir)
+        self._size = 0
+        self._restarts = 0
+        self._readers = 0
+        self._result = None
+
+    def start(self):
+        """Start downloading the artifact"""
+        checksum = self.download_item.checksum
+        consumers = {} if checksum and checksum.checksum_value else {self.download_item.url: self}
+        DownloadCenter([self.download_item], self._done, consumers=consumers, use_cache_server=False)
+
+    def write(self, data):
+        """Tee data, the next content of the download"""
+        self._tee.write(data)
+        self._tee.flush()
+        with self._condition:
+            self._size += len(data)
+            self._condition.notify_all()
+
+    def discard(self):
+        """The download restarts from scratch: forget what we teed"""
+        with self._condition:
+            self._tee.seek(0)
+            self._tee.truncate()
+            self._size = 0
+            self._restarts += 1
+            self._condition.notify_all()
+
+    def _done(self, result):
+        self._on_done(self)
+        with self._condition:
+            self._result = result[self.download_item.url]
+            self._condition.notify_all()
+            self._close_if_unused()
+
+    def wait(self, timeout):
+        """Wait at most timeout seconds for the first content, or the end of the download. Return if it's there"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._size or self._result is not None, timeout)
+
+    def attach(self):
+        """Register a new client, which will read the content with chunks()"""
+        with self._condition:
+            self._readers += 1
+
+    def detach(self):
+        """Unregister a client, once it's done with the content"""
+        with self._condition:
+            self._readers -= 1
+            self._close_if_unused()
+
+    def _close_if_unused(self):
+        if self._result is None or self._readers:
+            return
+        self._tee.close()
+        if self._result.fd:
+            self._result.fd.close()
+
+    def chunks(self):
+        """Yield the content in chunks, as soon as they are downloaded.
+
+        Raise FetchFailed if the download failed, or restarted after we yielded something."""
+        offset = 0
+        with self._condition:
+            restarts = self._restarts
+        while True:
+            with self._condition:
+                while self._result is None and offset >= self._size and self._restarts == restarts:
+                    self._condition.wait()
+                if self._restarts != restarts:
+                    if offset:
+                        raise FetchFailed("Download of {} restarted".format(self.download_item.url))
+                    restarts = self._restarts
+                    continue
+                if self._result is not None:
+                    break
+                size = min(self._size - offset, self.BLOCK_SIZE)
+            data = os.pread(self._tee.fileno(), size, offset)
+            offset += len(data)
+            yield data
+
+        if self._result.error:
+            raise FetchFailed(self._result.error)
+        # the downloaded file has the same content than what we teed
+        fd = self._result.fd.fileno()
+        while True:
+            data = os.pread(fd, self.BLOCK_SIZE, offset)
+            if not data:
+                return
+            offset += len(data)
+            yield data
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class CacheServer:
+    """HTTP server sharing the artifact cache of this machine with the other ones on the network.
+
+    Clients, configured with this server url as cache_server in their network section, get artifacts at
+    /artifact?url=<url>[&checksum=<type>:<value>][&ignore_encoding=1][&mirror=<url>…], with their headers and cookies.
+    Cached artifacts are served from the ArtifactCache, with ranges support. Others are downloaded by a
+    DownloadCenter, once whatever the number of clients asking for them at the same time, and streamed to all of
+    them while they download, or once checked if they have a checksum. Only http, https and ftp urls (and mirrors)
+    are downloaded, and, unless allow_local_urls is set, not from hosts only reachable from this machine (loopback
+    and link-local addresses), even through a redirection, so that clients can't get to the services it keeps for
+    itself."""
+
+    SCHEMES = ("http", "https", "ftp")
+
+    def __init__(self, port=DEFAULT_CACHE_SERVER_PORT, address=DEFAULT_CACHE_SERVER_ADDRESS, allow_local_urls=False):
+        self.allow_local_urls = allow_local_urls
+        self._lock = Lock()
+        # key: _Fetch of the artifacts being downloaded
+        self._fetches = {}
+        self.httpd = _ThreadingHTTPServer((address, port), _CacheRequestHandler)
+        self.httpd.cache_server = self
+        self.port = self.httpd.server_address[1]
+
+    def start(self):
+        """Serve requests in a background thread"""
+        logger.info("Serving the artifact cache on port {}".format(self.port))
+        SessionPool().redirect_filters.append(self._filter_redirect)
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """Stop serving requests"""
+        logger.info("Stop serving the artifact cache on port {}".format(self.port))
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        with suppress(ValueError):
+            SessionPool().redirect_filters.remove(self._filter_redirect)
+
+    def _filter_redirect(self, url):
+        """Refuse to follow a redirection to url if it's a local one"""
+        if not self.allow_local_urls and self.is_local_url(url):
+            raise requests.exceptions.InvalidURL("Redirection to local url {} refused".format(url))
+
+    @staticmethod
+    def is_local_url(url):
+        """Return if url host has a loopback or link-local address"""
+        host = urllib.parse.urlparse(url).hostname
+        if not host:
+            return False
+        try:
+            addresses = [address_info[4][0] for address_info in socket.getaddrinfo(host, None)]
+        except (OSError, UnicodeError):
+            # the download will fail the same way
+            return False
+        for address in addresses:
+            # drop IPv6 scope id
+            address = ipaddress.ip_address(address.split("%")[0])
+            address = getattr(address, "ipv4_mapped", None) or address
+            if address.is_loopback or address.is_link_local or address.is_unspecified:
+                return True
+        return False
+
+    def fetch(self, download_item):
+        """Return the _Fetch of download_item, attached for the caller, joining the download in flight if any"""
+        key = RequestCoalescer.key_for(download_item, True)
+        with self._lock:
+            fetch = self._fetches.get(key)
+            new_fetch = fetch is None
+            if new_fetch:
+                logger.info("{} isn't cached, downloading it".format(download_item.url))
+                fetch = _Fetch(download_item, lambda fetch: self._fetch_done(key, fetch))
+                self._fetches[key] = fetch
+            else:
+                logger.debug("Join in flight download of {}".format(download_item.url))
+            fetch.attach()
+        # outside of the lock, as the download can be done right away
+        if new_fetch:
+            fetch.start()
+        return fetch
+
+    def _fetch_done(self, key, fetch):
+        with self._lock:
+            if self._fetches.get(key) is fetch:
+                del self._fetches[key]
+
+
+class _CacheRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # seconds between two interim responses, while clients wait for content which isn't there yet
+    KEEP_ALIVE_INTERVAL = 5
+    # client headers which are about its connection to us, and so, not sent upstream
+    NOT_FORWARDED_HEADERS = ("accept", "accept-encoding", "connection", "content-length", "cookie", "host",
+                             "if-range", "keep-alive", "proxy-connection", "range", "te", "trailer",
+                             "transfer-encoding", "upgrade", "user-agent")
+
+    def do_GET(self):
+        parsed_url = urllib.parse.urlparse(self.path)
+        if parsed_url.path != "/artifact":
+            self.send_error(404)
+            return
+        try:
+            download_item = self._download_item(urllib.parse.parse_qs(parsed_url.query))
+        except ValueError as e:
+            self.send_error(400, explain=str(e))
+            return
+
+        key = ArtifactCache.key_for(download_item)
+        cached = ArtifactCache().get(key)
+        if cached:
+            logger.debug("Serve {} from cache".format(download_item.url))
+            with cached:
+                self._send_file(cached, key)
+            return
+        fetch = self.server.cache_server.fetch(download_item)
+        try:
+            self._send_fetch(fetch)
+        finally:
+            fetch.detach()
+
+    def _download_item(self, query):
+        """Return the DownloadItem requested by that parsed query"""
+        url = query.get("url", [None])[0]
+        if not url:
+            raise ValueError("No url requested")
+        mirrors = query.get("mirror")
+        for requested_url in [url] + (mirrors or []):
+            if urllib.parse.urlparse(requested_url).scheme.lower() not in CacheServer.SCHEMES:
+                raise ValueError("Unsupported url {}".format(requested_url))
+            if not self.server.cache_server.allow_local_urls and CacheServer.is_local_url(requested_url):
+                raise ValueError("Local url {} isn't served".format(requested_url))
+        checksum = None
+        if "checksum" in query:
+            checksum_type, _, checksum_value = query["checksum"][0].partition(":")
+            try:
+                checksum = Checksum(ChecksumType[checksum_type], checksum_value)
+            except KeyError:
+                raise ValueError("Unsupported checksum type: {}".format(checksum_type))
+        cookies = {}
+        with suppress(CookieError):
+            cookies = {name: morsel.value for name, morsel in SimpleCookie(self.headers.get("Cookie", "")).items()}
+        headers = {name: value for name, value in self.headers.items()
+                   if name.lower() not in self.NOT_FORWARDED_HEADERS}
+        return DownloadItem(url, checksum, headers=headers or None,
+                            ignore_encoding=query.get("ignore_encoding") == ["1"], cookies=cookies or None,
+                            mirrors=mirrors)
+
+    def _send_file(self, f, key):
+        """Send f content, or the range of it which was requested. It's copied in the kernel to the socket"""
+        size = os.fstat(f.fileno()).st_size
+        requested_range = parse_range(self.headers.get("Range"), size)
+        if requested_range:
+            start, end = requested_range
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        else:
+            start, end = 0, size - 1
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", '"{}"'.format(key))
+        self.end_headers()
+        self.wfile.flush()
+        try:
+            if end >= start:
+                self.connection.sendfile(f, start, end - start + 1)
+        except OSError as e:
+            logger.debug("Client of {} went away: {}".format(self.path, e))
+            self.close_connection = True
+
+    def _send_fetch(self, fetch):
+        """Stream fetch content, chunked while we don't know its size
+
+        Until we have some content to send, which is only once checked for artifacts with a checksum, we send
+        "100 Continue" interim responses, so that the client doesn't time out meanwhile.
+        The last chunk is only sent if the whole content is, so that clients detect an interrupted transfer."""
+        try:
+            while not fetch.wait(self.KEEP_ALIVE_INTERVAL):
+                self.send_response_only(100)
+                self.end_headers()
+        except OSError as e:
+            logger.debug("Client of {} went away: {}".format(fetch.download_item.url, e))
+            self.close_connection = True
+            return
+        chunks = fetch.chunks()
+        try:
+            data = next(chunks, b"")
+        except FetchFailed as e:
+            logger.warning("Couldn't download {}: {}".format(fetch.download_item.url, e))
+            self.send_error(502, explain=str(e))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            while data:
+                self.wfile.write("{:x}\r\n".format(len(data)).encode("ascii"))
+                self.wfile.write(data)
+                self.wfile.write(b"\r\n")
+                data = next(chunks, b"")
+            self.wfile.write(b"0\r\n\r\n")
+        except FetchFailed as e:
+            logger.warning("Couldn't download {}: {}".format(fetch.download_item.url, e))
+            self.close_connection = True
+        except OSError as e:
+            logger.debug("Client of {} went away: {}".format(fetch.download_item.url, e))
+            self.close_connection = True
+
+    def log_message(self, fmt, *args):
+        """Log requests in the logging system rather than on stderr"""
+        logger.debug("{} - {}".format(self.address_string(), fmt % args))
@@ -19,54 +19,107 @@
 
 """Module delivering a DownloadCenter to download in parallel multiple requests"""
 
+import asyncio
 from collections import namedtuple
 from concurrent import futures
 from contextlib import closing
+from functools import partial
 import hashlib
-from io import BytesIO
 import logging
 import os
-import tempfile
+from threading import Event, Lock
+import time
+import urllib.parse
 
-import requests
+import requests.cookies
 import requests.exceptions
-from umake.network.ftp_adapter import FTPAdapter
+import requests.utils
+import urllib3.exceptions
+from umake.network import cache_server_url, get_network_number, get_network_setting
+from umake.network.artifact_cache import ArtifactCache
+from umake.network.async_engine import AsyncDownloadEngine
+from umake.network.bandwidth import BandwidthLimiter
+from umake.network.bundle import Bundle
+from umake.network.download_scheduler import DownloadScheduler
+from umake.network.mirrors import MirrorSelector
+from umake.network.page_cache import PageCache
+from umake.network.partial_download import DownloadedFile, PartialDownload
+from umake.network.request_coalescer import RequestCoalescer
+from umake.network.retry import RetryPolicy
+from umake.network.session_pool import SessionPool
+from umake.network.spooled_buffer import SpooledBuffer
+from umake.settings import DEFAULT_DOWNLOAD_ENGINE, DEFAULT_DOWNLOAD_SEGMENTS
 from umake.tools import ChecksumType
 
 logger = logging.getLogger(__name__)
 
 
-class DownloadItem(namedtuple('DownloadItem', ['url', 'checksum', 'headers', 'ignore_encoding', 'cookies'])):
+class DownloadItem(namedtuple('DownloadItem', ['url', 'checksum', 'headers', 'ignore_encoding', 'cookies',
+                                               'mirrors'])):
     """An individual item to be downloaded and checked.
 
     Checksum should be an instance of tools.Checksum, if provided.
     Headers should be a dictionary of HTTP headers, if provided.
-    Cookies should be a cookie dictionary, if provided."""
-    def __new__(cls, url, checksum=None, headers=None, ignore_encoding=False, cookies=None):
-        return super().__new__(cls, url, checksum, headers, ignore_encoding, cookies)
+    Cookies should be a cookie dictionary, if provided.
+    Mirrors should be a list of other urls delivering the same content, if provided. They are only used for items
+    with a checksum."""
+    def __new__(cls, url, checksum=None, headers=None, ignore_encoding=False, cookies=None, mirrors=None):
+        return super().__new__(cls, url, checksum, headers, ignore_encoding, cookies, mirrors)
+
+
+class DownloadCancelled(BaseException):
+    """Exception raised in downloads cancelled by DownloadCenter.cancel()"""
 
 
 class DownloadCenter:
     """Read or download requested urls in separate threads."""
 
     BLOCK_SIZE = 1024 * 8  # from urlretrieve code
+    # chunks grow up to MAX_BLOCK_SIZE while each read takes less than TARGET_READ_TIME seconds
+    MAX_BLOCK_SIZE = 1024 * 1024 * 4
+    TARGET_READ_TIME = 0.1
+    # throttled downloads read chunks down to that size
+    MIN_THROTTLED_BLOCK_SIZE = 1024
+    # files smaller than this are never split in ranges, and a range is never smaller than SEGMENT_MIN_SIZE
+    SEGMENTED_DOWNLOAD_MIN_SIZE = 1024 * 1024 * 16
+    SEGMENT_MIN_SIZE = 1024 * 1024 * 4
+    # local files are copied in the kernel by chunks of that size, between two progress reports
+    COPY_BLOCK_SIZE = 1024 * 1024 * 8
     DownloadResult = namedtuple("DownloadResult", ["buffer", "error", "fd", "final_url", "cookies"])
 
-    def __init__(self, urls, on_done, download=True, report=lambda x: None):
+    def __init__(self, urls, on_done, download=True, report=lambda x: None, priority=None, consumers=None,
+                 scrapers=None, use_cache_server=True):
         """Generate a threaded download machine.
 
         urls is a list of DownloadItems to download or read from.
         on_done is the callback that will be called once all those urls are downloaded.
         report, if not None, will be called once any download is in progress, reporting
         a dict of current download with current/size parameters
+        Concurrent identical requests share the same transfer, and in memory ones are memoized for the whole process.
+        priority is the DownloadScheduler priority of those downloads. In memory ones (pages, checksums…) default
+        to be scheduled before downloads to files.
+        consumers is an optional dict of url: object with write(data) and discard() methods, getting the content of
+        that url download to file in order while it's downloaded. discard() is called if the download has to restart
+        from scratch. A consumer doesn't get anything for downloads served from the cache or a bundle.
+        scrapers is an optional dict of url: object with write(data), close() and a done property, parsing the content
+        of that url download in memory while it's downloaded. The data chunks are only valid during the write() call.
+        As soon as done is True, the transfer stops and buffer only has the content received so far. close() is called
+        at the end of the content. Scrapers are ignored for downloads with a checksum.
+        Downloads to file go first through the umake cache server at the cache_server url of the network
+        configuration, if any, unless use_cache_server is False. They fall back to the internet if it fails.
+        When exporting an offline Bundle, what is downloaded is recorded in it. When importing one, everything is
+        served from it, without any network access.
+        With engine set to asyncio in the network configuration, in memory http and https downloads are multiplexed
+        on the AsyncDownloadEngine event loop rather than each taking a DownloadScheduler thread.
 
         The callback will get a dictionary parameter like:
         {
             "url":
-                DownloadResult(buffer=page content as bytes if download is set to False. close() will clean it from
-                                      memory,
+                DownloadResult(buffer=page content as a file object if download is set to False, with a BytesIO
+                                      like getvalue(). It spills to disk above memory_buffer_max_size MiB.
+                                      close() will clean it from memory,
                                error=string detailing the error which occurred (path and content would be empty),
-                               fd=temporary file descriptor. close() will delete it from disk,
+                               fd=file descriptor on the downloaded file. close() will delete it from disk,
                                final_url=the final url, which may be different from the start if there were redirects,
                                cookies=a dictionary of cookies after the request
                 )
@@ -76,97 +129,700 @@ class DownloadCenter:
         self._done_callback = on_done
         self._wired_report = report
         self._download_to_file = download
+        self._consumers = consumers or {}
+        self._scrapers = scrapers or {}
+        self._cancelled = Event()
+        self._cache_server = get_network_setting("cache_server") if use_cache_server else None
+        self._engine = get_network_setting("engine", DEFAULT_DOWNLOAD_ENGINE)
 
         self._urls = urls
         self._downloaded_content = {}
 
         self._download_progress = {}
-
-        executor = futures.ThreadPoolExecutor(max_workers=3)
+        # one Throttle per download, shared by all its transfers
+        self._throttles = {}
+        self._throttles_lock = Lock()
+        # keys of the artifacts we added to the cache
+        self._cached_keys = []
+        self.segments = get_network_number("segments", DEFAULT_DOWNLOAD_SEGMENTS)
+        self._retry = RetryPolicy()
+
+        if priority is None:
+            priority = DownloadScheduler.PRIORITY_BULK if download else DownloadScheduler.PRIORITY_METADATA
+        self._priority = priority
+        scheduler = DownloadScheduler()
+        coalescer = RequestCoalescer()
         for url_request in self._urls:
-            # grab the md5sum if any
-            # switch between inline memory and temp file
+            # switch between inline memory and a resumable file, created when fetching
             if download:
-                # Named because shutils and tarfile library needs a .name property
-                # http://bugs.python.org/issue21044
-                # also, ensure we keep the same suffix
-                path, ext = os.path.splitext(url_request.url)
-                dest = tempfile.NamedTemporaryFile(suffix=ext)
-                logger.info("Start downloading {} to a temp file".format(url_request))
+                dest = None
+                logger.info("Start downloading {} to a file".format(url_request))
             else:
-                dest = BytesIO()
+                dest = SpooledBuffer()
                 logger.info("Start downloading {} in memory".format(url_request))
-            future = executor.submit(self._fetch, url_request, dest)
+            if self._use_async_engine(url_request, download):
+                start = partial(AsyncDownloadEngine().submit, self, self._fetch_async, url_request, dest)
+            else:
+                start = partial(scheduler.submit, url_request.url, priority, self._fetch, url_request, dest)
+            if url_request.url in self._consumers or url_request.url in self._scrapers:
+                # the consumer or scraper needs its own transfer
+                future = start()
+            else:
+                # start is called right away if there is no identical request in flight
+                key = coalescer.key_for(url_request, download, self._cache_server if download else None)
+                future = coalescer.submit(key, start)
             future.tag_url = url_request.url
             future.tag_download = download
             future.tag_dest = dest
             future.add_done_callback(self._one_done)
 
-    def _fetch(self, download_item, dest):
-        """Get an url content and close the connexion.
+    def _use_async_engine(self, download_item, download):
+        """Return if download_item is fetched on the AsyncDownloadEngine rather than in a DownloadScheduler thread
 
-        This will write the content to dest and check for md5sum.
-        Return a tuple of (dest, final_url, cookies)
-        """
+        Only in memory http and https downloads, not going through a proxy, are. Downloads to file (with their
+        mirrors, ranges and cache) and offline bundles are always handled in threads."""
+        if download or self._engine != "asyncio":
+            return False
+        bundle = Bundle()
+        if bundle.importing or bundle.exporting:
+            return False
         url = download_item.url
-        checksum = download_item.checksum
-        headers = download_item.headers or {}
-        cookies = download_item.cookies
+        if urllib.parse.urlparse(url).scheme.lower() not in ("http", "https"):
+            return False
+        return requests.utils.select_proxy(url, requests.utils.get_environ_proxies(url)) is None
 
-        def _report(block_no, block_size, total_size):
-            current_size = int(block_no * block_size)
+    def _reporter(self, url):
+        """Return the function reporting the progress of url download"""
+        def _report(current_size, total_size):
             if total_size != -1:
                 current_size = min(current_size, total_size)
             self._download_progress[url] = {"current": current_size, "size": total_size}
-            logger.debug("Deliver download update: {} of {}".format(self._download_progress, total_size))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Deliver download update: {} of {}".format(self._download_progress, total_size))
             self._wired_report(self._download_progress)
+        return _report
 
-        # Requests support redirection out of the box.
-        # Create a session so we can mount our own FTP adapter.
-        session = requests.Session()
-        session.mount('ftp://', FTPAdapter())
-        try:
-            with closing(session.get(url, stream=True, headers=headers, cookies=cookies)) as r:
-                r.raise_for_status()
-                content_size = int(r.headers.get('content-length', -1))
+    def _fetch(self, download_item, dest):
+        """Get an url content and close the connexion.
 
-                # read in chunk and send report updates
-                block_num = 0
-                _report(block_num, self.BLOCK_SIZE, content_size)
-                for data in r.raw.stream(amt=self.BLOCK_SIZE, decode_content=not download_item.ignore_encoding):
-                    dest.write(data)
-                    block_num += 1
-                    _report(block_num, self.BLOCK_SIZE, content_size)
-                final_url = r.url
-                cookies = session.cookies
+        This will write the content to dest (or to a resumable file if dest is None) and check for md5sum.
+        Return a tuple of (dest, final_url, cookies)
+        """
+        url = download_item.url
+        _report = self._reporter(url)
+
+        try:
+            if self._cancelled.is_set():
+                raise DownloadCancelled("Download of {} cancelled".format(url))
+            bundle = Bundle()
+            if bundle.importing:
+                return self._fetch_from_bundle(download_item, dest, _report)
+            if dest is None:
+                result = self._fetch_to_file(download_item, _report)
+            else:
+                result = self._fetch_in_memory(download_item, dest, _report)
+            if bundle.exporting:
+                dest, final_url, cookies = result
+                try:
+                    bundle.record(url, dest, final_url)
+                except BaseException:
+                    dest.close()
+                    raise
+            return result
         except requests.exceptions.InvalidSchema as exc:
             # Wrap this for a nicer error message.
             raise BaseException("Protocol not supported.") from exc
 
+    @staticmethod
+    def _check_checksum(download_item, actual_checksum):
+        """Raise if actual_checksum isn't the one expected for download_item"""
+        logger.debug("Expected: {}, actual: {}.".format(download_item.checksum.checksum_value,
+                                                        actual_checksum))
+        if download_item.checksum.checksum_value != actual_checksum:
+            msg = ("The checksum of {} doesn't match. Corrupted download? "
+                   "Aborting.").format(download_item.url)
+            raise BaseException(msg)
+
+    def _fetch_from_bundle(self, download_item, dest, report):
+        """Get download_item content from the offline bundle, in dest (or in the bundled file itself if dest is None)
+
+        Return a tuple of (dest, final_url, cookies)"""
+        url = download_item.url
+        path, final_url = Bundle().get(url)
+        size = os.path.getsize(path)
+        checksum = download_item.checksum
+        if dest is None:
+            logger.info("{} found in bundle".format(url))
+            dest = DownloadedFile(path, delete=False)
+            if checksum and checksum.checksum_value:
+                self._check_checksum(download_item,
+                                     self._checksum_for_fd(self._checksum_algorithm(checksum.checksum_type), dest))
+            report(size, size)
+            return dest, final_url, requests.cookies.RequestsCookieJar()
+
+        scraper = self._scrapers.get(url) if not (checksum and checksum.checksum_value) else None
+        with open(path, 'rb') as f:
+            while not (scraper and scraper.done):
+                data = f.read(self.MAX_BLOCK_SIZE)
+                if not data:
+                    break
+                dest.write(data)
+                if scraper:
+                    scraper.write(data)
+        if scraper:
+            scraper.close()
+        report(size, size)
+        if checksum and checksum.checksum_value:
+            dest.seek(0)
+            self._check_checksum(download_item,
+                                 self._checksum_for_fd(self._checksum_algorithm(checksum.checksum_type), dest))
+        return dest, final_url, requests.cookies.RequestsCookieJar()
+
+    def _fetch_in_memory(self, download_item, dest, report):
+        """Get download_item content in dest, revalidating the page we previously got if any.
+
+        Return a tuple of (dest, final_url, cookies)"""
+        url = download_item.url
+        checksum = download_item.checksum
+        scraper = self._scrapers.get(url) if not (checksum and checksum.checksum_value) else None
+        # Requests support redirection out of the box.
+        # The pooled session keeps connections alive (and has our own FTP adapter mounted). It doesn't store any
+        # cookie, so we gather them for this request only.
+        session = SessionPool().get(url)
+        attempt = 0
+        while True:
+            try:
+                final_url, cookies = self._get_in_memory(session, download_item, dest, report, scraper)
+                break
+            except BaseException as e:
+                attempt += 1
+                # a scraper can't forget what it parsed
+                if not self._retry.is_retryable(e) or attempt > self._retry.retries or (scraper and dest.tell()):
+                    raise
+                dest.seek(0)
+                dest.truncate()
+                self._retry.wait_before_retry(url, attempt, e)
+        if scraper:
+            scraper.close()
+
+        if checksum and checksum.checksum_value:
+            dest.seek(0)
+            self._check_checksum(download_item,
+                                 self._checksum_for_fd(self._checksum_algorithm(checksum.checksum_type), dest))
+        return dest, final_url, cookies
+
+    def _get_in_memory(self, session, download_item, dest, report, scraper):
+        """Do one attempt at getting download_item content in dest.
+
+        Return a tuple of (final_url, cookies)"""
+        url = download_item.url
+        page_cache = PageCache()
+        cached_page = page_cache.get(download_item)
+        request_headers = dict(download_item.headers or {})
+        if cached_page:
+            request_headers.update(cached_page.validation_headers)
+        with closing(session.get(url, stream=True, headers=request_headers, cookies=download_item.cookies,
+                                 timeout=self._retry.timeout)) as r:
+            r.raise_for_status()
+            final_url = r.url
+            cookies = self._get_cookies(r)
+            if cached_page and r.status_code == 304:
+                self._write_cached_page(url, cached_page, dest, report, scraper)
+            else:
+                content_size = int(r.headers.get('content-length', -1))
+                report(0, content_size)
+                # we get the whole page once to cache it, so that next runs only revalidate it
+                read_all = page_cache.can_store(r.headers)
+                self._stream_to(r, dest, download_item, report, content_size, scraper, read_all)
+                if scraper and scraper.done and not read_all:
+                    # a truncated page can't be cached
+                    logger.debug("{} scraped after {} bytes, stop downloading it".format(url, dest.tell()))
+                elif dest.in_memory:
+                    page_cache.store(download_item, r.headers, dest.getvalue())
+        return final_url, cookies
+
+    @staticmethod
+    def _write_cached_page(url, cached_page, dest, report, scraper):
+        """Use the cached content of url, which wasn't modified on the server"""
+        logger.debug("{} not modified, using cached content".format(url))
+        dest.write(cached_page.content)
+        if scraper:
+            scraper.write(cached_page.content)
+        report(len(cached_page.content), len(cached_page.content))
+
+    async def _fetch_async(self, download_item, dest):
+        """Get an url content in dest, on the AsyncDownloadEngine event loop, once we have a connection slot.
+
+        Return a tuple of (dest, final_url, cookies)"""
+        url = download_item.url
+        try:
+            async with AsyncDownloadEngine().slot(url):
+                if self._cancelled.is_set():
+                    raise DownloadCancelled("Download of {} cancelled".format(url))
+                return await self._fetch_in_memory_async(download_item, dest, self._reporter(url))
+        except asyncio.CancelledError:
+            raise DownloadCancelled("Download of {} cancelled".format(url))
+
+    async def _fetch_in_memory_async(self, download_item, dest, report):
+        """Get download_item content in dest like _fetch_in_memory does, without blocking the event loop.
+
+        Return a tuple of (dest, final_url, cookies)"""
+        url = download_item.url
+        checksum = download_item.checksum
+        scraper = self._scrapers.get(url) if not (checksum and checksum.checksum_value) else None
+        attempt = 0
+        while True:
+            try:
+                final_url, cookies = await self._get_in_memory_async(download_item, dest, report, scraper)
+                break
+            except BaseException as e:
+                attempt += 1
+                # a scraper can't forget what it parsed
+                if not self._retry.is_retryable(e) or attempt > self._retry.retries or (scraper and dest.tell()):
+                    raise
+                dest.seek(0)
+                dest.truncate()
+                await asyncio.sleep(self._retry.before_retry(url, attempt, e))
+        if scraper:
+            scraper.close()
+
         if checksum and checksum.checksum_value:
-            checksum_type = checksum.checksum_type
-            checksum_value = checksum.checksum_value
-            logger.debug("Checking checksum ({}).".format(checksum_type.name))
             dest.seek(0)
+            self._check_checksum(download_item,
+                                 self._checksum_for_fd(self._checksum_algorithm(checksum.checksum_type), dest))
+        return dest, final_url, cookies
+
+    async def _get_in_memory_async(self, download_item, dest, report, scraper):
+        """Do one attempt at getting download_item content in dest, on the event loop.
 
-            if checksum_type is ChecksumType.sha1:
-                actual_checksum = self.sha1_for_fd(dest)
-            elif checksum_type is ChecksumType.md5:
-                actual_checksum = self.md5_for_fd(dest)
-            elif checksum_type is ChecksumType.sha256:
-                actual_checksum = self.sha256_for_fd(dest)
+        Return a tuple of (final_url, cookies)"""
+        url = download_item.url
+        page_cache = PageCache()
+        cached_page = page_cache.get(download_item)
+        request_headers = dict(download_item.headers or {})
+        if cached_page:
+            request_headers.update(cached_page.validation_headers)
+        r = await AsyncDownloadEngine().get(url, headers=request_headers, cookies=download_item.cookies,
+                                            timeout=self._retry.timeout)
+        try:
+            r.raise_for_status()
+            if cached_page and r.status_code == 304:
+                self._write_cached_page(url, cached_page, dest, report, scraper)
             else:
-                msg = "Unsupported checksum type: {}.".format(checksum_type)
-                raise BaseException(msg)
-
-            logger.debug("Expected: {}, actual: {}.".format(checksum_value,
-                                                            actual_checksum))
-            if checksum_value != actual_checksum:
-                msg = ("The checksum of {} doesn't match. Corrupted download? "
-                       "Aborting.").format(url)
-                raise BaseException(msg)
+                content_size = int(r.headers.get('content-length', -1))
+                report(0, content_size)
+                # we get the whole page once to cache it, so that next runs only revalidate it
+                read_all = page_cache.can_store(r.headers)
+                await self._stream_to_async(r, dest, download_item, report, content_size, scraper, read_all)
+                if scraper and scraper.done and not read_all:
+                    # a truncated page can't be cached
+                    logger.debug("{} scraped after {} bytes, stop downloading it".format(url, dest.tell()))
+                elif dest.in_memory:
+                    page_cache.store(download_item, r.headers, dest.getvalue())
+        finally:
+            r.close()
+        return r.url, r.cookies
+
+    async def _stream_to_async(self, r, dest, download_item, report, content_size, scraper=None, read_all=False):
+        """Read r content in chunk into dest and send report updates, on the event loop
+
+        Bandwidth limits and stalls are handled like in _read_chunks, waiting without blocking the other transfers.
+        Stop as soon as scraper, if any, is done with the content, unless read_all is set."""
+        stall_detector = self._retry.stall_detector()
+        throttle = self._throttle_for(download_item)
+        current_size = 0
+        while True:
+            data = await r.read(AsyncDownloadEngine.READ_SIZE, decode_content=not download_item.ignore_encoding)
+            if not data:
+                return
+            self._check_cancelled(r)
+            throttled = throttle.reserve(len(data))
+            if throttled:
+                await asyncio.sleep(throttled)
+            stall_detector.update(len(data), throttled)
+            dest.write(data)
+            current_size += len(data)
+            report(current_size, content_size)
+            if scraper:
+                scraper.write(data)
+                if scraper.done:
+                    if not read_all:
+                        return
+                    scraper = None
+
+    def _fetch_to_file(self, download_item, report):
+        """Get download_item content in a file, from the cache or from its fastest working mirror.
+
+        Return a tuple of (file, final_url, cookies)"""
+        url = download_item.url
+        # Named because shutils and tarfile library needs a .name property
+        # http://bugs.python.org/issue21044
+        # also, ensure we keep the same suffix
+        path, ext = os.path.splitext(url)
+        cache = ArtifactCache()
+        cached = cache.get(cache.key_for(download_item), suffix=ext)
+        if cached:
+            logger.info("{} found in cache".format(url))
+            return self._cached_result(cached, url, report)
+
+        def check_cancelled():
+            if self._cancelled.is_set():
+                raise DownloadCancelled("Download of {} cancelled".format(url))
+
+        # forget partial downloads abandoned long ago
+        cache.prune()
+        if self._cache_server:
+            result = self._fetch_from_cache_server(download_item, cache, ext, report, check_cancelled)
+            if result:
+                return result
+
+        # the same content from any mirror, so resumable whatever mirror we downloaded it from
+        part = PartialDownload(url, download_item.checksum, suffix=ext)
+        try:
+            if part.lock(on_wait=report, check_cancelled=check_cancelled):
+                # another process (or thread) was downloading it, and may have cached it
+                cached = cache.get(cache.key_for(download_item), suffix=ext)
+                if cached:
+                    logger.info("{} downloaded by another process".format(url))
+                    return self._cached_result(cached, url, report)
+            return self._fetch_partial_from_mirrors(download_item, part, cache, ext, report)
+        except DownloadCancelled:
+            # the other download we were waiting for isn't ours to forget
+            if part.locked:
+                part.remove()
+            raise
+        finally:
+            part.unlock()
+
+    def _fetch_from_cache_server(self, download_item, cache, ext, report, check_cancelled):
+        """Get download_item content in a file through the umake cache server. Return None if it failed.
+
+        Its partial download is the one of the cache server url: a cache server sharing our cache directory
+        downloads the artifact in the partial download of its url, which we thus mustn't hold meanwhile.
+        Return a tuple of (file, final_url, cookies)"""
+        url = download_item.url
+        server_item = download_item._replace(url=cache_server_url(self._cache_server, download_item))
+        part = PartialDownload(server_item.url, download_item.checksum, suffix=ext)
+        try:
+            part.lock(on_wait=report, check_cancelled=check_cancelled)
+            self._start_checksum(download_item, part)
+            return self._fetch_mirror_to_file(server_item, part, cache, ext, report, None)
+        except BaseException as e:
+            if part.locked:
+                # what it sent was forwarded to consumers, which start over on the next download
+                part.remove()
+            if isinstance(e, DownloadCancelled):
+                raise
+            logger.info("Downloading {} through the cache server failed ({}), downloading it directly".format(url, e))
+            return None
+        finally:
+            part.unlock()
+
+    @staticmethod
+    def _cached_result(cached, url, report):
+        """Report and return a tuple of (file, final_url, cookies) for a download served from the cache"""
+        size = os.path.getsize(cached.name)
+        report(size, size)
+        return cached, url, requests.cookies.RequestsCookieJar()
+
+    def _fetch_partial_from_mirrors(self, download_item, part, cache, ext, report):
+        """Get download_item content in the partial download part from its fastest working mirror
+
+        Return a tuple of (file, final_url, cookies)"""
+        url = download_item.url
+        self._start_checksum(download_item, part)
+        mirrors = MirrorSelector()
+        urls = mirrors.sorted_urls(download_item)
+        for index, mirror_url in enumerate(urls):
+            try:
+                return self._fetch_mirror_to_file(download_item._replace(url=mirror_url), part, cache, ext,
+                                                  report, mirrors if len(urls) > 1 else None)
+            except BaseException as e:
+                if index == len(urls) - 1 or isinstance(e, DownloadCancelled):
+                    raise
+                logger.info("Downloading {} from {} failed ({}), trying next mirror".format(url, mirror_url, e))
+                mirrors.record_failure(mirror_url)
+
+    def _start_checksum(self, download_item, part):
+        """Compute the checksum of download_item, if it has one, while it's written in part, forwarding the content
+        to its consumer if any"""
+        url = download_item.url
+        checksum = download_item.checksum
+        algorithm = self._checksum_algorithm(checksum.checksum_type) if checksum and checksum.checksum_value else None
+        sinks = [self._consumers[url]] if url in self._consumers else []
+        if algorithm or sinks:
+            part.start_checksum(algorithm, sinks)
+
+    def _fetch_mirror_to_file(self, download_item, part, cache, suffix, report, mirrors):
+        """Get download_item content in the partial download part and check it.
+
+        Record throughput statistics in mirrors if set.
+        Return a tuple of (file, final_url, cookies)"""
+        checksum = download_item.checksum
+        initial_size = part.written
+        start_time = time.monotonic()
+        session = SessionPool().get(download_item.url)
+        final_url, cookies, cached = self._fetch_to_partial(session, download_item, part, cache, suffix, report,
+                                                            mirrors)
+        if cached:
+            return cached, final_url, cookies
+
+        if part.checksum:
+            # computed (and forwarded to consumers) while downloading
+            actual_checksum = part.checksum.hexdigest()
+            if checksum and checksum.checksum_value:
+                try:
+                    self._check_checksum(download_item, actual_checksum)
+                except BaseException:
+                    # don't resume a corrupted download
+                    part.remove()
+                    raise
+        if mirrors:
+            mirrors.record(download_item.url, size=part.written - initial_size,
+                           duration=time.monotonic() - start_time)
+
+        dest = part.complete()
+        key = cache.key_for(download_item, part.validators.get("etag"))
+        cache.add(key, dest.name, part.url)
+        self._cached_keys.append(key)
         return dest, final_url, cookies
 
+    @staticmethod
+    def _get_cookies(r):
+        """Return the cookies set by r and the responses which redirected to it"""
+        cookies = requests.cookies.RequestsCookieJar()
+        for response in r.history + [r]:
+            cookies.update(response.cookies)
+        return cookies
+
+    def _fetch_to_partial(self, session, download_item, part, cache, suffix, report, mirrors=None):
+        """Download (or continue downloading) download_item in the partial download part.
+
+        We start from scratch if the content changed on the server since the previous attempt. Failed or stalled
+        transfers are retried following our RetryPolicy, resuming from what was already written when possible.
+        If the server ETag matches an artifact in cache, we use it instead of downloading the content.
+        Record the time to get the response headers as latency in mirrors if set.
+        Return a tuple of (final_url, cookies, cached file or None)"""
+        url = download_item.url
+        headers = download_item.headers or {}
+        attempt = 0
+        while True:
+            try:
+                with closing(session.get(url, stream=True, headers=headers, cookies=download_item.cookies,
+                                         timeout=self._retry.timeout)) as r:
+                    r.raise_for_status()
+                    if mirrors:
+                        mirrors.record(url, latency=r.elapsed.total_seconds())
+                    content_size = int(r.headers.get('content-length', -1))
+                    final_url = r.url
+                    cookies = self._get_cookies(r)
+
+                    cached = cache.get(cache.key_for(download_item, r.headers.get("etag")), suffix=suffix)
+                    if cached:
+                        logger.info("{} found in cache".format(url))
+                        report(content_size, content_size)
+                        return final_url, cookies, cached
+
+                    has_checksum = download_item.checksum is not None and download_item.checksum.checksum_value
+                    if part.can_resume(r.headers, has_checksum):
+                        logger.info("Resume download of {} from {} bytes".format(url, part.written))
+                    else:
+                        num_segments = self._num_segments(r, download_item, content_size)
+                        if num_segments > 1:
+                            segment_size = content_size // num_segments
+                            ranges = [(i * segment_size, (i + 1) * segment_size - 1) for i in range(num_segments)]
+                            ranges[-1] = (ranges[-1][0], content_size - 1)
+                        else:
+                            ranges = [(0, content_size - 1 if content_size != -1 else None)]
+                        part.reset(r.headers, ranges, resumable=self._supports_ranges(r, download_item))
+                    report(part.written, content_size)
+
+                    if len(part.segments) == 1 and part.written == 0:
+                        # stream directly that first response
+                        with part.open_segment(0) as f:
+                            self._stream_to(r, f, download_item, report, content_size)
+                        return final_url, cookies, None
+
+                # send back as well the cookies we got on the first request
+                range_cookies = requests.cookies.merge_cookies(requests.cookies.RequestsCookieJar(),
+                                                               download_item.cookies)
+                range_cookies.update(cookies)
+                try:
+                    self._fetch_ranges(SessionPool().get(final_url), final_url, headers, range_cookies, part,
+                                       content_size, report, self._throttle_for(download_item))
+                except self._RangeNotHonored as e:
+                    logger.info("{}, restart with a single stream download".format(e))
+                    part.reset(r.headers, [(0, content_size - 1 if content_size != -1 else None)],
+                               resumable=False)
+                    with closing(session.get(final_url, stream=True, headers=headers, cookies=range_cookies,
+                                             timeout=self._retry.timeout)) as r:
+                        r.raise_for_status()
+                        with part.open_segment(0) as f:
+                            self._stream_to(r, f, download_item, report, content_size)
+                return final_url, cookies, None
+            except BaseException as e:
+                attempt += 1
+                if not self._retry.is_retryable(e) or attempt > self._retry.retries:
+                    raise
+                if part.resumable:
+                    logger.info("Download of {} interrupted at {} bytes, will resume it".format(url, part.written))
+                self._retry.wait_before_retry(url, attempt, e)
+
+    def _throttle_for(self, download_item):
+        """Return the Throttle of download_item, shared by all the transfers of that download"""
+        with self._throttles_lock:
+            if download_item.url not in self._throttles:
+                self._throttles[download_item.url] = BandwidthLimiter().throttle()
+            return self._throttles[download_item.url]
+
+    def _read_chunks(self, r, decode_content, throttle):
+        """Yield r content in chunks, growing them on fast connections and shrinking them on slow ones.
+
+        Chunks are memoryviews on a reused buffer: they are only valid until the next one is read. Chunks of
+        throttled downloads are at most what their limit lets through in TARGET_READ_TIME, not to alternate long
+        sleeps and bursts.
+        Raise DownloadStalled if the transfer is too slow for too long."""
+        stall_detector = self._retry.stall_detector()
+        r.raw.decode_content = decode_content
+        max_block_size = self.MAX_BLOCK_SIZE
+        if throttle.rate:
+            max_block_size = min(max_block_size, max(int(throttle.rate * self.TARGET_READ_TIME),
+                                                     self.MIN_THROTTLED_BLOCK_SIZE))
+        min_block_size = min(self.BLOCK_SIZE, max_block_size)
+        buffer = memoryview(bytearray(max_block_size))
+        block_size = min_block_size
+        while True:
+            start_time = time.monotonic()
+            try:
+                read_size = r.raw.readinto(buffer[:block_size])
+            except urllib3.exceptions.ReadTimeoutError as e:
+                raise requests.exceptions.ConnectionError(e)
+            except urllib3.exceptions.ProtocolError as e:
+                raise requests.exceptions.ChunkedEncodingError(e)
+            if not read_size:
+                return
+            self._check_cancelled(r)
+            read_time = time.monotonic() - start_time
+            stall_detector.update(read_size, throttle.consume(read_size))
+            yield buffer[:read_size]
+            if read_size == block_size and read_time < self.TARGET_READ_TIME / 2:
+                block_size = min(block_size * 2, max_block_size)
+            elif read_time > self.TARGET_READ_TIME * 2:
+                block_size = max(block_size // 2, min_block_size)
+
+    def _write_chunks(self, r, dest, decode_content, throttle):
+        """Write r content into dest, yielding the size of each chunk written.
+
+        Local files are copied in the kernel into dest, when it's a file."""
+        if hasattr(r.raw, "copy_into") and hasattr(dest, "copy_from"):
+            while True:
+                size = r.raw.copy_into(dest, self.COPY_BLOCK_SIZE)
+                if not size:
+                    return
+                self._check_cancelled(r)
+                yield size
+        for data in self._read_chunks(r, decode_content, throttle):
+            dest.write(data)
+            yield len(data)
+
+    def _check_cancelled(self, r):
+        """Raise DownloadCancelled if we were cancelled while getting r"""
+        if self._cancelled.is_set():
+            raise DownloadCancelled("Download of {} cancelled".format(r.url))
+
+    def _stream_to(self, r, dest, download_item, report, content_size, scraper=None, read_all=False):
+        """Read r content in chunk into dest and send report updates
+
+        Stop as soon as scraper, if any, is done with the content, unless read_all is set."""
+        current_size = 0
+        throttle = self._throttle_for(download_item)
+        if scraper is None:
+            for size in self._write_chunks(r, dest, decode_content=not download_item.ignore_encoding,
+                                           throttle=throttle):
+                current_size += size
+                report(current_size, content_size)
+            return
+        for data in self._read_chunks(r, decode_content=not download_item.ignore_encoding, throttle=throttle):
+            dest.write(data)
+            current_size += len(data)
+            report(current_size, content_size)
+            if scraper:
+                scraper.write(data)
+                if scraper.done:
+                    if not read_all:
+                        break
+                    scraper = None
+
+    @staticmethod
+    def _supports_ranges(r, download_item):
+        """Return if we can request ranges of that response content
+
+        The server has to advertise ranges support, and we shouldn't have to decode the content."""
+        if r.headers.get('accept-ranges', '').lower() != 'bytes':
+            return False
+        if r.headers.get('content-encoding', 'identity').lower() != 'identity' and not download_item.ignore_encoding:
+            return False
+        return True
+
+    def _num_segments(self, r, download_item, content_size):
+        """Return in how many ranges we should download that response content
+
+        We only split big files, for which we can request ranges."""
+        if self.segments < 2 or content_size < self.SEGMENTED_DOWNLOAD_MIN_SIZE:
+            return 1
+        if not self._supports_ranges(r, download_item):
+            return 1
+        return min(self.segments, DownloadScheduler().max_connections_per_host,
+                   content_size // self.SEGMENT_MIN_SIZE)
+
+    class _RangeNotHonored(BaseException):
+        """Exception raised when the server doesn't answer a range request with the expected content range"""
+
+    def _fetch_ranges(self, session, url, headers, cookies, part, content_size, report, throttle):
+        """Download concurrently every remaining ranges of part, each of them writing in place
+
+        The ranges share throttle, the bandwidth limits of the whole download."""
+        remaining = part.remaining
+        if not remaining:
+            return
+        logger.debug("Download {} in {} ranges".format(url, len(remaining)))
+        progress_lock = Lock()
+        abort = Event()
+
+        def fetch_range(index, start, end):
+            range_headers = dict(headers)
+            range_headers["Range"] = "bytes={}-{}".format(start, end if end is not None else "")
+            with closing(session.get(url, stream=True, headers=range_headers, cookies=cookies,
+                                     timeout=self._retry.timeout)) as r:
+                r.raise_for_status()
+                if r.status_code != 206 or \
+                        not r.headers.get('content-range', '').startswith("bytes {}-".format(start)):
+                    raise self._RangeNotHonored("{} didn't honor range {}-{}".format(url, start, end))
+                with part.open_segment(index) as f:
+                    for size in self._write_chunks(r, f, decode_content=False, throttle=throttle):
+                        if abort.is_set():
+                            return
+                        with progress_lock:
+                            current_size = part.written
+                        report(current_size, content_size)
+            if end is not None and part.segments[index][0] + part.segments[index][2] != end + 1:
+                raise BaseException("Range {}-{} of {} is incomplete".format(start, end, url))
+
+        # ranges are scheduled like any other download, to stay within the connection limits
+        scheduler = DownloadScheduler()
+        with scheduler.waiting_for_subtasks():
+            range_futures = [scheduler.submit(url, self._priority, fetch_range, index, start, end)
+                             for index, (start, end) in remaining]
+            try:
+                for future in futures.as_completed(range_futures):
+                    if future.exception():
+                        raise future.exception()
+            finally:
+                abort.set()
+                for future in range_futures:
+                    future.cancel()
+                futures.wait(range_futures)
+
     def _one_done(self, future):
         """Callback that will be called once the download finishes.
 
@@ -174,11 +830,15 @@ class DownloadCenter:
         """
 
         if future.exception():
-            logger.error("{} couldn't finish download: {}".format(future.tag_url, future.exception()))
+            if isinstance(future.exception(), DownloadCancelled):
+                logger.debug("{} download cancelled".format(future.tag_url))
+            else:
+                logger.error("{} couldn't finish download: {}".format(future.tag_url, future.exception()))
             result = self.DownloadResult(buffer=None, error=str(future.exception()), fd=None, final_url=None,
                                          cookies=None)
-            # cleaned unusable temp file as something bad happened
-            future.tag_dest.close()
+            # cleaned unusable in memory content as something bad happened. Files are kept to resume them.
+            if future.tag_dest:
+                future.tag_dest.close()
         else:
             logger.info("{} download finished".format(future.tag_url))
             fd, final_url, cookies = future.result()
@@ -191,6 +851,25 @@ class DownloadCenter:
         if len(self._urls) == len(self._downloaded_content):
             self._done()
 
+    def cancel(self):
+        """Stop every pending download and discard what they downloaded.
+
+        on_done is still called, with an error for each download which was cancelled."""
+        logger.debug("Cancel downloads of {}".format(self._urls))
+        self._cancelled.set()
+        if self._engine == "asyncio":
+            # interrupt the transfers waiting on the event loop right away
+            AsyncDownloadEngine().cancel(self)
+
+    def forget(self):
+        """Remove from the artifact cache what we downloaded, for downloads which won't be used
+
+        Call it once on_done was called: downloads which were cancelled midway already removed their partial file."""
+        cache = ArtifactCache()
+        for key in self._cached_keys:
+            cache.discard(key)
+        self._cached_keys = []
+
     def _done(self):
         """Callback that will be called once all download finishes.
 
@@ -199,6 +878,18 @@ class DownloadCenter:
         logger.info("All pending downloads for {} done".format(self._urls))
         self._done_callback(self._downloaded_content)
 
+    @staticmethod
+    def _checksum_algorithm(checksum_type):
+        """Return the hashlib algorithm for that checksum type"""
+        algorithms = {ChecksumType.md5: hashlib.md5,
+                      ChecksumType.sha1: hashlib.sha1,
+                      ChecksumType.sha256: hashlib.sha256}
+        try:
+            logger.debug("Checking checksum ({}).".format(checksum_type.name))
+            return algorithms[checksum_type]
+        except KeyError:
+            raise BaseException("Unsupported checksum type: {}.".format(checksum_type))
+
     @classmethod
     def _checksum_for_fd(cls, algorithm, f, block_size=2 ** 20):
         checksum = algorithm()
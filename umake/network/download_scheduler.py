@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module scheduling every download of the process with global and per host limits"""
+
+import atexit
+from collections import Counter
+from concurrent import futures
+from contextlib import contextmanager
+from itertools import count
+import logging
+from threading import Condition, Thread, local
+import urllib.parse
+from umake.network import get_network_number
+from umake.settings import DEFAULT_MAX_CONNECTIONS, DEFAULT_MAX_CONNECTIONS_PER_HOST
+from umake.tools import Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadScheduler(object, metaclass=Singleton):
+    """Run download tasks on a process wide pool of worker threads.
+
+    At most max_connections tasks run at once, and at most max_connections_per_host against the same host (both
+    from the network configuration section). Pending tasks are started by priority (lower first), then in submission
+    order. Workers are started on demand and exit after being idle for IDLE_TIMEOUT seconds."""
+
+    PRIORITY_METADATA = 0
+    PRIORITY_BULK = 10
+    IDLE_TIMEOUT = 5
+
+    def __init__(self):
+        self.max_connections = get_network_number("max_connections", DEFAULT_MAX_CONNECTIONS)
+        self.max_connections_per_host = get_network_number("max_connections_per_host", DEFAULT_MAX_CONNECTIONS_PER_HOST)
+        self._condition = Condition()
+        # list of (priority, submission order, host, future, function, args)
+        self._pending = []
+        self._order = count()
+        self._running_per_host = Counter()
+        self._workers = 0
+        # started workers count as idle until they look for a task
+        self._idle_workers = 0
+        self._shutdown = False
+        # host of the task each worker thread is running
+        self._current = local()
+        atexit.register(self.shutdown)
+
+    @staticmethod
+    def host_for(url):
+        """Return the host limits apply to for that url"""
+        return urllib.parse.urlparse(url).netloc.lower()
+
+    def submit(self, url, priority, function, *args):
+        """Schedule function(*args), downloading from url, with that priority. Return a Future on its result"""
+        future = futures.Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Can't schedule new downloads after shutdown")
+            self._pending.append((priority, next(self._order), self.host_for(url), future, function, args))
+            if len(self._pending) > self._idle_workers and self._workers < self.max_connections:
+                self._workers += 1
+                self._idle_workers += 1
+                Thread(target=self._work, daemon=True).start()
+            self._condition.notify_all()
+        return future
+
+    @contextmanager
+    def waiting_for_subtasks(self):
+        """Let other tasks take the connection slot of the task running in the calling worker thread
+
+        To use while that task waits for the tasks it submitted, so that they can run even with it at the limits."""
+        host = self._current.host
+        with self._condition:
+            self._running_per_host[host] -= 1
+            self._workers -= 1
+            self._condition.notify_all()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running_per_host[host] += 1
+                self._workers += 1
+
+    def _next_task(self):
+        """Remove and return the first task by priority whose host isn't at its limit. None if there is none.
+
+        Has to be called with the condition held."""
+        eligible_tasks = [task for task in self._pending
+                          if self._running_per_host[task[2]] < self.max_connections_per_host]
+        if not eligible_tasks:
+            return None
+        task = min(eligible_tasks, key=lambda task: task[:2])
+        self._pending.remove(task)
+        return task
+
+    def _work(self):
+        """Worker thread main loop"""
+        with self._condition:
+            self._idle_workers -= 1
+        while True:
+            with self._condition:
+                task = self._next_task()
+                while task is None:
+                    if self._shutdown:
+                        self._workers -= 1
+                        return
+                    self._idle_workers += 1
+                    notified = self._condition.wait(self.IDLE_TIMEOUT)
+                    self._idle_workers -= 1
+                    task = self._next_task()
+                    if task is None and not notified:
+                        self._workers -= 1
+                        return
+                (priority, order, host, future, function, args) = task
+                self._running_per_host[host] += 1
+            self._current.host = host
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = function(*args)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+
+            with self._condition:
+                self._running_per_host[host] -= 1
+                # other workers may be waiting for that host
+                self._condition.notify_all()
+
+    def shutdown(self):
+        """Cancel pending tasks and let workers exit once running ones are done"""
+        with self._condition:
+            self._shutdown = True
+            for task in self._pending:
+                task[3].cancel()
+            self._pending = []
+            self._condition.notify_all()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Module giving requests support for file:// urls, like archives mirrored on a local or network share"""
+
+import email.utils
+import logging
+import os
+import urllib.parse
+import urllib.request
+from requests import Response
+from requests.adapters import BaseAdapter
+import requests.exceptions
+from umake.network import parse_range
+
+logger = logging.getLogger(__name__)
+
+
+class FileAdapter(BaseAdapter):
+    """A file adapter for requests. Supports GETs of the whole file or of a byte range.
+
+    Responses advertise their size, modification time and ranges support like an HTTP server would, so that local
+    files are downloaded, resumed, segmented and checked like remote ones. Their raw stream can copy the content in the
+    kernel straight into the destination file."""
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        parsed_url = urllib.parse.urlparse(request.url)
+        if parsed_url.netloc not in ("", "localhost"):
+            raise requests.exceptions.InvalidURL("Only local files are supported: {}".format(request.url))
+        path = urllib.request.url2pathname(parsed_url.path)
+
+        resp = Response()
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        try:
+            f = open(path, 'rb')
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            resp.status_code = 404
+        except PermissionError:
+            resp.status_code = 403
+        except OSError as exc:
+            raise requests.exceptions.ConnectionError(exc) from exc
+        if resp.status_code:
+            resp.raw = _LocalFileTransfer(None, 0, 0)
+            return resp
+
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        start, end = 0, size - 1
+        content_range = parse_range(request.headers.get("Range"), size)
+        if content_range:
+            start, end = content_range
+            if start > end:
+                f.close()
+                resp.status_code = 416
+                resp.raw = _LocalFileTransfer(None, 0, 0)
+                return resp
+        resp.raw = _LocalFileTransfer(f, start, end - start + 1)
+        resp.status_code = 200
+        resp.headers['accept-ranges'] = 'bytes'
+        resp.headers['content-length'] = str(end - start + 1)
+        resp.headers['last-modified'] = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        if content_range:
+            resp.status_code = 206
+            resp.headers['content-range'] = "bytes {}-{}/{}".format(start, end, size)
+        return resp
+
+    def close(self):
+        """Nothing to release: each response closes its own file"""
+        pass
+
+
+class _LocalFileTransfer:
+    """Raw stream of a local file range"""
+
+    def __init__(self, f, offset, size):
+        self.decode_content = False
+        self._file = f
+        self._offset = offset
+        self._remaining = size
+        self.closed = f is None
+
+    def _advance(self, size):
+        if self._remaining and not size:
+            message = "{} ended {} bytes early".format(self._file.name, self._remaining)
+            raise requests.exceptions.ConnectionError(message)
+        self._offset += size
+        self._remaining -= size
+        if not self._remaining:
+            self.close()
+        return size
+
+    def readinto(self, b):
+        """Read up to len(b) bytes of the file into b. Return the number of bytes read, 0 once it's done"""
+        if self.closed or not self._remaining:
+            return 0
+        with memoryview(b) as view:
+            return self._advance(os.preadv(self._file.fileno(), [view[:self._remaining]], self._offset))
+
+    def read(self, amt=None, decode_content=None):
+        """Return up to amt bytes of the file, or everything left if amt is None"""
+        if self.closed or not self._remaining:
+            return b""
+        data = os.pread(self._file.fileno(), self._remaining if amt is None else min(amt, self._remaining),
+                        self._offset)
+        self._advance(len(data))
+        return data
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        """A generator, yielding chunks of amt bytes of the file (the last one can be smaller)"""
+        while True:
+            data = self.read(amt)
+            if not data:
+                return
+            yield data
+
+    def copy_into(self, dest, amt):
+        """Copy up to amt bytes of the file into dest (with a copy_from(fd, offset, count) method) in the kernel.
+
+        Return the copied size, 0 once it's done."""
+        if self.closed or not self._remaining:
+            return 0
+        return self._advance(dest.copy_from(self._file.fileno(), self._offset, min(amt, self._remaining)))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._file.close()
+
+    release_conn = close
@@ -17,92 +17,242 @@
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
-from collections import namedtuple
+"""Module giving requests support for ftp:// urls"""
+
+import calendar
+from contextlib import suppress
+import email.utils
+import ftplib
 from ftplib import FTP, error_perm
-from queue import Queue
-from threading import Thread
+from io import BytesIO
+import logging
+from threading import Lock
+import time
 import urllib.parse
 from requests import Response
 from requests.adapters import BaseAdapter
 import requests.exceptions
+from umake.network import parse_range
+
+logger = logging.getLogger(__name__)
 
 
 class FTPAdapter(BaseAdapter):
-    """An FTP adapter for requests. Supports streaming GETs and not much else."""
+    """An FTP adapter for requests. Supports streaming GETs, of the whole file or of a byte range, and not much else.
+
+    Logged in control connections are kept per host and reused by next requests. Ranges are requested with REST, so
+    that FTP downloads can be resumed and segmented like HTTP ones."""
+
+    MAX_IDLE_CONNECTIONS = 4  # per host
+
+    def __init__(self):
+        super().__init__()
+        self._idle_connections = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def get_connection(hostname, timeout=None, port=0):
+        conn = FTP(timeout=timeout)
+        conn.connect(hostname, port)
+        conn.login(user='anonymous')
+        return conn
 
     @staticmethod
-    def get_connection(hostname, timeout=None):
-        return FTP(host=hostname, timeout=timeout, user='anonymous')
+    def _close_connection(conn):
+        """Close conn, whatever state it's in"""
+        with suppress(*ftplib.all_errors):
+            conn.close()
+
+    def _acquire(self, netloc, timeout):
+        """Return a logged in connection to netloc, reusing an idle one if it's still alive"""
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        while True:
+            with self._lock:
+                idle_connections = self._idle_connections.get(netloc)
+                conn = idle_connections.pop() if idle_connections else None
+            if conn is None:
+                parsed_netloc = urllib.parse.urlparse("//" + netloc)
+                conn = self.get_connection(parsed_netloc.hostname, connect_timeout, parsed_netloc.port or 0)
+                break
+            try:
+                conn.voidcmd("NOOP")
+                break
+            except ftplib.all_errors:
+                logger.debug("Idle connection to {} was closed".format(netloc))
+                self._close_connection(conn)
+        # data connections are opened with conn.timeout
+        conn.timeout = read_timeout
+        conn.sock.settimeout(read_timeout)
+        return conn
+
+    def _release(self, netloc, conn):
+        """Keep conn for next requests to netloc, if we don't have enough idle ones already"""
+        with self._lock:
+            idle_connections = self._idle_connections.setdefault(netloc, [])
+            if len(idle_connections) < self.MAX_IDLE_CONNECTIONS:
+                idle_connections.append(conn)
+                return
+        self._close_connection(conn)
+
+    @staticmethod
+    def _last_modified(conn, file_path):
+        """Return the modification time of file_path as a Last-Modified header value, or None if unknown"""
+        try:
+            modification_time = conn.sendcmd("MDTM " + file_path).split()[1]
+            return email.utils.formatdate(calendar.timegm(time.strptime(modification_time[:14], "%Y%m%d%H%M%S")),
+                                          usegmt=True)
+        except (error_perm, IndexError, ValueError):
+            return None
 
     def send(self, request, stream=False, timeout=None, **kwargs):
 
         parsed_url = urllib.parse.urlparse(request.url)
+        hostname = parsed_url.netloc
         file_path = parsed_url.path
 
         # Strip the leading slash, if present.
         if file_path.startswith('/'):
             file_path = file_path[1:]
 
+        if not stream:
+            # Not relevant for Ubuntu Make.
+            raise NotImplementedError
+
         try:
-            self.conn = self.get_connection(parsed_url.netloc, timeout)
-        except ConnectionRefusedError as exc:
+            conn = self._acquire(hostname, timeout)
+        except ftplib.all_errors as exc:
             # Wrap this in a requests exception.
             # in requests 2.2.1, ConnectionError does not take keyword args
-            raise requests.exceptions.ConnectionError() from exc
+            raise requests.exceptions.ConnectionError(exc) from exc
 
         resp = Response()
         resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        resp.raw = BytesIO()
 
         try:
-            size = self.conn.size(file_path)
-        except error_perm:
-            resp.status_code = 404
-            return resp
-
-        if stream:
-            # We have to do this in a background thread, since ftplib's and requests' approaches are the opposite:
-            # ftplib is callback based, and requests needs to expose an iterable. (Push vs pull)
-
-            # When the queue size is reached, puts will block. This provides some backpressure.
-            queue = Queue(maxsize=100)
-            done_sentinel = object()
-
-            def handle_transfer():
-                # Download all the chunks into a queue, then place a sentinel object into it to signal completion.
-                self.conn.retrbinary('RETR ' + file_path, queue.put)
-                queue.put(done_sentinel)
-
-            Thread(target=handle_transfer).start()
-
-            def stream(amt=8192, decode_content=False):
-                """A generator, yielding chunks from the queue."""
-                # We maintain a buffer so the consumer gets exactly the number of bytes requested.
-                buffer = bytearray()
-                while True:
-                    data = queue.get()
-
-                    if data is not done_sentinel:
-                        buffer.extend(data)
-                        if len(buffer) >= amt:
-                            result = buffer[:amt]
-                            buffer = buffer[amt:]
-
-                            yield result
-                    else:
-                        if buffer:
-                            yield buffer
-                        return
-
-            Raw = namedtuple('raw', 'stream')
-
-            raw = Raw(stream)
-
-            resp.status_code = 200
-            resp.raw = raw
-            resp.headers['content-length'] = size
-            resp.close = lambda: self.conn.close()
-            return resp
-
-        else:
-            # Not relevant for Ubuntu Make.
-            raise NotImplementedError
+            conn.voidcmd("TYPE I")
+            try:
+                size = conn.size(file_path)
+            except error_perm:
+                self._release(hostname, conn)
+                resp.status_code = 404
+                return resp
+            last_modified = self._last_modified(conn, file_path)
+
+            start, end = 0, size - 1
+            content_range = parse_range(request.headers.get("Range"), size)
+            if content_range:
+                start, end = content_range
+                if start > end:
+                    self._release(hostname, conn)
+                    resp.status_code = 416
+                    return resp
+            try:
+                data_sock = conn.transfercmd("RETR " + file_path, rest=start or None)
+            except (error_perm, ftplib.error_reply):
+                if not start:
+                    raise
+                logger.debug("{} doesn't support REST, send the whole file".format(hostname))
+                content_range = None
+                start, end = 0, size - 1
+                data_sock = conn.transfercmd("RETR " + file_path)
+        except error_perm as exc:
+            self._close_connection(conn)
+            raise requests.exceptions.HTTPError(exc) from exc
+        except ftplib.all_errors as exc:
+            self._close_connection(conn)
+            raise requests.exceptions.ConnectionError(exc) from exc
+
+        # the control connection can only be reused once the server is done sending the file
+        resp.raw = _FTPTransfer(request.url, data_sock, end - start + 1,
+                                lambda complete: self._transfer_done(hostname, conn, complete and end == size - 1))
+        resp.status_code = 200
+        resp.headers['accept-ranges'] = 'bytes'
+        resp.headers['content-length'] = str(end - start + 1)
+        if content_range:
+            resp.status_code = 206
+            resp.headers['content-range'] = "bytes {}-{}/{}".format(start, end, size)
+        if last_modified:
+            resp.headers['last-modified'] = last_modified
+        return resp
+
+    def _transfer_done(self, hostname, conn, reusable):
+        """Release conn once its transfer is done, if it went to the end of the file. Close it otherwise"""
+        if reusable:
+            try:
+                conn.voidresp()
+                self._release(hostname, conn)
+                return
+            except ftplib.all_errors as e:
+                logger.debug("Transfer from {} didn't end properly: {}".format(hostname, e))
+        self._close_connection(conn)
+
+    def close(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle_connections, self._idle_connections = self._idle_connections, {}
+        for connections in idle_connections.values():
+            for conn in connections:
+                self._close_connection(conn)
+
+
+class _FTPTransfer:
+    """Raw stream of an FTP transfer, read directly from its data connection, without any intermediate buffer"""
+
+    def __init__(self, url, data_sock, size, on_close):
+        self.decode_content = False
+        self._url = url
+        self._sock = data_sock
+        self._remaining = size
+        self._on_close = on_close
+        self.closed = False
+
+    def readinto(self, b):
+        """Read up to len(b) bytes of the transfer into b. Return the number of bytes read, 0 once it's done"""
+        if self.closed or not self._remaining:
+            return 0
+        with memoryview(b) as view:
+            try:
+                read_size = self._sock.recv_into(view[:self._remaining])
+            except OSError as e:
+                raise requests.exceptions.ConnectionError(e)
+        if not read_size:
+            raise requests.exceptions.ConnectionError("Transfer of {} ended {} bytes early".format(self._url,
+                                                                                                   self._remaining))
+        self._remaining -= read_size
+        if not self._remaining:
+            # release the connection as soon as we are done, like urllib3 does
+            self.close()
+        return read_size
+
+    def read(self, amt=None, decode_content=None):
+        """Return up to amt bytes of the transfer, or everything left if amt is None"""
+        buffer = bytearray(self._remaining if amt is None else min(amt, self._remaining))
+        size = 0
+        with memoryview(buffer) as view:
+            while size < len(buffer):
+                read_size = self.readinto(view[size:])
+                if not read_size:
+                    break
+                size += read_size
+        del buffer[size:]
+        return bytes(buffer)
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        """A generator, yielding chunks of amt bytes of the transfer (the last one can be smaller)"""
+        while True:
+            data = self.read(amt)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._sock.close()
+        self._on_close(not self._remaining)
+
+    release_conn = close
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module choosing the fastest mirror for an artifact, from statistics kept across runs"""
+
+from concurrent import futures
+from contextlib import closing
+import logging
+import os
+from threading import Lock
+import time
+import urllib.parse
+from umake.network import get_network_setting
+from umake.network.session_pool import SessionPool
+from umake.tools import get_cache_path, Singleton
+import yaml
+import yaml.parser
+import yaml.scanner
+
+logger = logging.getLogger(__name__)
+
+
+class MirrorSelector(object, metaclass=Singleton):
+    """Order candidate urls of an artifact from the expected fastest to the slowest.
+
+    Candidates are the artifact url, the mirrors of its DownloadItem, and the ones derived from the "mirrors"
+    network configuration, mapping url prefixes to lists of mirror prefixes. As we can only trust a mirror with a
+    checksum to check its content, artifacts without checksum are always downloaded from their url. Mirrors of the
+    DownloadItem have to be remote ones (MIRROR_SCHEMES), so that they can't point us to local files.
+
+    Latency and throughput of each host are averaged over downloads and kept in the cache directory. Hosts we don't
+    know yet, or didn't measure for STALE_STATS_AGE, are probed concurrently, so that a host penalized by a
+    transient failure gets its chance again."""
+
+    PROBE_TIMEOUT = 3  # seconds
+    FAILURE_LATENCY = 60  # latency, in seconds, recorded for a failing host
+    NEW_MEASURE_WEIGHT = 0.3
+    DEFAULT_THROUGHPUT = 1024 * 1024  # bytes per second, until we measured one
+    REFERENCE_SIZE = 16 * 1024 * 1024  # size weighting latency against throughput to compare hosts
+    MIRROR_SCHEMES = ("http", "https", "ftp")
+    STALE_STATS_AGE = 60 * 60  # seconds after which we probe a host again
+
+    def __init__(self):
+        self.stats_path = get_cache_path("mirrors.yaml")
+        self.mirror_map = get_network_setting("mirrors", {}) or {}
+        self._lock = Lock()
+        self._stats = {}
+        try:
+            with open(self.stats_path) as f:
+                self._stats = dict(yaml.safe_load(f))
+        except (OSError, TypeError, ValueError, yaml.scanner.ScannerError, yaml.parser.ParserError):
+            pass
+
+    @staticmethod
+    def _host(url):
+        return urllib.parse.urlparse(url).netloc.lower()
+
+    def candidates(self, download_item):
+        """Return every url we can download download_item from, its own url first"""
+        url = download_item.url
+        checksum = download_item.checksum
+        if not checksum or not checksum.checksum_value:
+            return [url]
+        urls = [url]
+        for mirror in download_item.mirrors or []:
+            if urllib.parse.urlparse(mirror).scheme in self.MIRROR_SCHEMES:
+                urls.append(mirror)
+            else:
+                logger.warning("Ignoring mirror {} of {}: unsupported scheme".format(mirror, url))
+        for prefix, mirror_prefixes in self.mirror_map.items():
+            if url.startswith(prefix):
+                urls.extend([mirror_prefix + url[len(prefix):] for mirror_prefix in mirror_prefixes])
+        # remove duplicates, keeping order
+        return [url for (index, url) in enumerate(urls) if url not in urls[:index]]
+
+    def _score(self, url):
+        """Return the expected time to download REFERENCE_SIZE bytes from url"""
+        stats = self._stats.get(self._host(url), {})
+        return stats.get("latency", self.FAILURE_LATENCY) + \
+            self.REFERENCE_SIZE / stats.get("throughput", self.DEFAULT_THROUGHPUT)
+
+    def _probe(self, url):
+        """Measure the time to get an answer from url, only asking for its first byte"""
+        start_time = time.monotonic()
+        try:
+            with closing(SessionPool().get(url).get(url, stream=True, headers={"Range": "bytes=0-0"},
+                                                    timeout=self.PROBE_TIMEOUT)) as r:
+                r.raise_for_status()
+        except BaseException as e:
+            logger.debug("Probing {} failed: {}".format(url, e))
+            self.record_failure(url)
+            return
+        self.record(url, latency=time.monotonic() - start_time)
+
+    def sorted_urls(self, download_item):
+        """Return the candidate urls of download_item, from the expected fastest to the slowest"""
+        urls = self.candidates(download_item)
+        if len(urls) < 2:
+            return urls
+        unknown_urls = []
+        for url in urls:
+            if not self._is_fresh(self._host(url)) and self._host(url) not in [self._host(u) for u in unknown_urls]:
+                unknown_urls.append(url)
+        with self._lock:
+            for url in unknown_urls:
+                # the probe replaces an outdated latency instead of being averaged with it
+                self._stats.get(self._host(url), {}).pop("latency", None)
+        if unknown_urls:
+            with futures.ThreadPoolExecutor(max_workers=len(unknown_urls)) as executor:
+                executor.map(self._probe, unknown_urls)
+        # sort is stable: the artifact own url first on equal scores
+        urls = sorted(urls, key=self._score)
+        logger.debug("Candidate urls for {}: {}".format(download_item.url, urls))
+        return urls
+
+    def _is_fresh(self, host):
+        """Return if we measured host less than STALE_STATS_AGE ago"""
+        stats = self._stats.get(host)
+        if not stats or "latency" not in stats:
+            return False
+        return time.time() - stats.get("updated", 0) < self.STALE_STATS_AGE
+
+    def record(self, url, latency=None, size=None, duration=None):
+        """Average a new latency, and/or size downloaded in duration seconds, for the host of url"""
+        host = self._host(url)
+        with self._lock:
+            stats = self._stats.setdefault(host, {})
+            if latency is not None:
+                stats["latency"] = self._average(stats.get("latency"), latency)
+            if size and duration:
+                stats["throughput"] = self._average(stats.get("throughput"), size / duration)
+            stats["updated"] = time.time()
+            self._save()
+
+    def record_failure(self, url):
+        """Penalize the host of url after an error or a stall"""
+        self.record(url, latency=self.FAILURE_LATENCY)
+
+    def _average(self, previous, measure):
+        if previous is None:
+            return measure
+        return previous * (1 - self.NEW_MEASURE_WEIGHT) + measure * self.NEW_MEASURE_WEIGHT
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.stats_path), exist_ok=True)
+            with open(self.stats_path + ".new", 'w') as f:
+                yaml.dump(self._stats, f, default_flow_style=False)
+            os.replace(self.stats_path + ".new", self.stats_path)
+        except OSError as e:
+            logger.debug("Couldn't save mirror statistics: {}".format(e))
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module caching pages downloaded in memory, revalidated against the server on each use"""
+
+from collections import namedtuple
+from contextlib import suppress
+import hashlib
+import logging
+import os
+from umake.tools import get_cache_path
+import yaml
+import yaml.parser
+import yaml.scanner
+
+logger = logging.getLogger(__name__)
+
+
+class CachedPage(namedtuple('CachedPage', ['etag', 'last_modified', 'content'])):
+    """A page content with the validators the server sent for it"""
+
+    @property
+    def validation_headers(self):
+        """Return the headers making a request conditional on that content"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class PageCache:
+    """Cache of provider, license and checksum pages.
+
+    Pages are only stored if the server gave us an ETag or a Last-Modified header, so that we can always revalidate
+    them with a conditional request and reuse the stored content on a 304 answer."""
+
+    def __init__(self):
+        self.path = get_cache_path("pages")
+
+    def _entry_path(self, download_item):
+        """Return the path of the cache entry for that request"""
+        key = [download_item.url, str(download_item.ignore_encoding)]
+        for elem in (download_item.headers, download_item.cookies):
+            with suppress(AttributeError):
+                elem = sorted(elem.items())
+            key.append(str(elem))
+        return os.path.join(self.path, hashlib.sha256("\n".join(key).encode('utf-8')).hexdigest())
+
+    def get(self, download_item):
+        """Return the CachedPage for download_item, or None if there is none"""
+        entry_path = self._entry_path(download_item)
+        try:
+            with open(entry_path + ".yaml") as f:
+                validators = yaml.safe_load(f)
+            with open(entry_path, 'rb') as f:
+                content = f.read()
+            return CachedPage(etag=validators["etag"], last_modified=validators["last-modified"], content=content)
+        except (OSError, TypeError, KeyError, yaml.scanner.ScannerError, yaml.parser.ParserError):
+            return None
+
+    @staticmethod
+    def can_store(headers):
+        """Return if a response with those headers can be stored"""
+        return bool(headers.get("etag") or headers.get("last-modified"))
+
+    def store(self, download_item, headers, content):
+        """Store content for download_item if the response headers have some validators"""
+        if not self.can_store(headers):
+            return
+        validators = {"etag": headers.get("etag"), "last-modified": headers.get("last-modified")}
+        entry_path = self._entry_path(download_item)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(entry_path + ".new", 'wb') as f:
+                f.write(content)
+            with open(entry_path + ".yaml.new", 'w') as f:
+                yaml.dump(validators, f, default_flow_style=False)
+            # content first, so that validators never describe another content
+            with suppress(FileNotFoundError):
+                os.remove(entry_path + ".yaml")
+            os.replace(entry_path + ".new", entry_path)
+            os.replace(entry_path + ".yaml.new", entry_path + ".yaml")
+        except OSError as e:
+            logger.debug("Couldn't cache {}: {}".format(download_item.url, e))
+            return
+        logger.debug("Cached {} content".format(download_item.url))
@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module handling on disk downloads, which can be resumed across runs"""
+
+from contextlib import suppress
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from threading import Lock
+import time
+from umake.tools import get_cache_path
+import yaml
+import yaml.parser
+import yaml.scanner
+
+logger = logging.getLogger(__name__)
+
+
+def copy_file_range(in_fd, out_fd, in_offset, out_offset, count):
+    """Copy up to count bytes from in_fd at in_offset to out_fd at out_offset, without going through user space.
+
+    Use copy_file_range (which can reflink on copy on write filesystems, or copy on the server side for network
+    shares), or sendfile if the kernel can't copy between those files. Fall back to a pread/pwrite copy.
+    Return the copied size, 0 at the end of in_fd."""
+    try:
+        return os.copy_file_range(in_fd, out_fd, count, in_offset, out_offset)
+    except AttributeError:
+        # python < 3.8
+        pass
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+            raise
+    try:
+        os.lseek(out_fd, out_offset, os.SEEK_SET)
+        return os.sendfile(out_fd, in_fd, in_offset, count)
+    except OSError as e:
+        if e.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+    return os.pwrite(out_fd, os.pread(in_fd, count, in_offset), out_offset)
+
+
+class DownloadedFile:
+    """File object on a finished download. Like a NamedTemporaryFile, close() deletes it from disk if delete is set"""
+
+    def __init__(self, path, delete=True):
+        self.name = path
+        self.delete = delete
+        self.file = open(path, 'rb')
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def duplicate(self):
+        """Return a new DownloadedFile on a hard link (or a copy) of that file, deleted on its own close()"""
+        fd, path = tempfile.mkstemp(prefix=os.path.basename(self.name) + "-", dir=os.path.dirname(self.name))
+        os.close(fd)
+        try:
+            os.remove(path)
+            os.link(self.name, path)
+        except OSError:
+            shutil.copyfile(self.name, path)
+        return DownloadedFile(path)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        if self.delete:
+            with suppress(FileNotFoundError):
+                os.remove(self.name)
+
+
+class SequentialChecksum:
+    """Checksum of a file content computed in order while its segments are written, in any order.
+
+    Data written right after what we already hashed is hashed directly. Segments written ahead are caught up by reading
+    them back (from the page cache most of the time) as soon as every previous segment is done.
+    The content is forwarded in the same order to sinks (objects with write(data) and discard()), like a streaming
+    extractor. If the download restarts from scratch, sinks are discarded."""
+
+    BLOCK_SIZE = 2 ** 20
+
+    def __init__(self, algorithm, path, sinks=()):
+        self._algorithm = algorithm
+        self._path = path
+        self._lock = Lock()
+        self.sinks = list(sinks)
+        self.offset = 0
+        self.reset()
+
+    def reset(self):
+        """Restart hashing from the beginning of the file"""
+        if self.offset:
+            for sink in self.sinks:
+                sink.discard()
+            self.sinks = []
+        self._checksum = self._algorithm() if self._algorithm else None
+        self.offset = 0
+
+    def _consume(self, data):
+        if self._checksum:
+            self._checksum.update(data)
+        for sink in self.sinks:
+            sink.write(data)
+        self.offset += len(data)
+
+    def _catch_up(self, end=None):
+        """Hash the file content from current offset to end (or to EOF if None)"""
+        with open(self._path, 'rb') as f:
+            f.seek(self.offset)
+            while end is None or self.offset < end:
+                data = f.read(self.BLOCK_SIZE if end is None else min(self.BLOCK_SIZE, end - self.offset))
+                if not data:
+                    break
+                self._consume(data)
+
+    def update(self, segment_start, offset, data):
+        """Record data, written at offset in the segment starting at segment_start"""
+        with self._lock:
+            if not segment_start <= self.offset <= offset:
+                # previous segments aren't all hashed yet
+                return
+            if self.offset < offset:
+                self._catch_up(offset)
+            self._consume(data)
+
+    def advance(self, segments):
+        """Hash every content already written following what we hashed, in those [start, end, written] segments"""
+        with self._lock:
+            for start, end, written in sorted(segments):
+                if start <= self.offset < start + written:
+                    self._catch_up(start + written)
+
+    def finish(self):
+        """Hash and forward to sinks the remaining content, once every segment is written"""
+        with self._lock:
+            self._catch_up()
+
+    def hexdigest(self):
+        """Return the checksum of the whole file, once every segment is written. None if we only have sinks"""
+        self.finish()
+        return self._checksum.hexdigest() if self._checksum else None
+
+
+class PartialDownload:
+    """Resumable state of a download to a .part file.
+
+    The file is keyed by url and expected checksum, and a sidecar state file records the server validators (ETag,
+    Last-Modified, length) and what was written for each segment, so that we can continue it with range requests on
+    next attempt, even from another umake run.
+    A lock file ensures that only one process (or thread) downloads it at a time. Others wait for it. It's removed
+    by its holder once done, waiters then lock the file which replaces it."""
+
+    SAVE_INTERVAL = 1  # seconds between two state saves while downloading
+    LOCK_POLL_INTERVAL = 0.5  # seconds between two checks of the lock held by another download
+    FILE_SUFFIXES = (".part", ".state", ".state.new", ".lock")
+
+    def __init__(self, url, checksum, suffix=""):
+        key = "{}\n{}:{}".format(url, checksum.checksum_type.value if checksum and checksum.checksum_type else "",
+                                 checksum.checksum_value if checksum else "")
+        download_dir = get_cache_path("downloads")
+        os.makedirs(download_dir, exist_ok=True)
+        self.url = url
+        self.path = os.path.join(download_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + suffix)
+        self.part_path = self.path + ".part"
+        self.state_path = self.path + ".state"
+        self.lock_path = self.path + ".lock"
+        self._lock_file = None
+        self.locked = False
+        self.suffix = suffix
+        self.validators = {}
+        self.resumable = False
+        # list of [start, end, written] for each segment. end is None if the size isn't known
+        self.segments = []
+        self._lock = Lock()
+        self._last_save = 0
+        self.checksum = None
+        self._load()
+
+    def _read_state(self):
+        """Return the (validators, resumable, segments) state saved for the .part file, or None"""
+        if not os.path.isfile(self.part_path):
+            return None
+        try:
+            with open(self.state_path) as f:
+                state = yaml.safe_load(f)
+            return (state["validators"], state["resumable"], [list(segment) for segment in state["segments"]])
+        except (OSError, TypeError, KeyError, yaml.scanner.ScannerError, yaml.parser.ParserError):
+            logger.debug("No valid state for {}, will restart it".format(self.part_path))
+            return None
+
+    def _load(self):
+        """Load previous state if we have one matching the .part file"""
+        self.validators, self.resumable, self.segments = self._read_state() or ({}, False, [])
+
+    def lock(self, on_wait=lambda current_size, total_size: None, check_cancelled=lambda: None):
+        """Take the lock on this download, waiting for any other process or thread downloading it.
+
+        While waiting, on_wait is called with the progress of the other download (total_size is -1 if unknown), and
+        check_cancelled, which can raise to stop waiting.
+        Return True if we had to wait: the content may be available in the artifact cache now. The state is reloaded
+        to continue what the other download left, if anything."""
+        if self._try_lock():
+            # it may have been pruned since we loaded it
+            self._load()
+            return False
+        logger.info("{} is already being downloaded, waiting for it".format(self.url))
+        try:
+            while True:
+                check_cancelled()
+                state = self._read_state()
+                if state:
+                    validators, resumable, segments = state
+                    on_wait(sum([written for (start, end, written) in segments]), validators.get("length", -1))
+                if self._try_lock():
+                    break
+                time.sleep(self.LOCK_POLL_INTERVAL)
+        except BaseException:
+            self.unlock()
+            raise
+        self._load()
+        return True
+
+    def _try_lock(self):
+        """Take the lock if it's free. Return if we have it"""
+        while True:
+            if self._lock_file is None:
+                self._lock_file = open(self.lock_path, 'a')
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                current = os.stat(self.lock_path).st_ino == os.fstat(self._lock_file.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                self.locked = True
+                return True
+            # the previous holder removed it once done: lock the new one
+            self._lock_file.close()
+            self._lock_file = None
+
+    @classmethod
+    def on_disk(cls):
+        """Return a list of (path, size, last_modified) for every partial download in the cache directory
+
+        path is the one of the download without its file suffixes."""
+        download_dir = get_cache_path("downloads")
+        downloads = {}
+        with suppress(FileNotFoundError):
+            for filename in os.listdir(download_dir):
+                suffix = next((suffix for suffix in cls.FILE_SUFFIXES if filename.endswith(suffix)), None)
+                if suffix is None:
+                    continue
+                path = os.path.join(download_dir, filename[:-len(suffix)])
+                try:
+                    stat = os.stat(os.path.join(download_dir, filename))
+                except FileNotFoundError:
+                    continue
+                size, last_modified = downloads.get(path, (0, 0))
+                downloads[path] = (size + stat.st_size, max(last_modified, stat.st_mtime))
+        return [(path, size, last_modified) for (path, (size, last_modified)) in downloads.items()]
+
+    @classmethod
+    def remove_unused(cls, path):
+        """Remove the files of the partial download at path, unless it's being downloaded. Return if we did"""
+        try:
+            lock_file = open(path + ".lock", 'a')
+        except OSError:
+            return False
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            logger.debug("Remove partial download {}".format(path))
+            # the lock file last, while we hold it
+            for suffix in cls.FILE_SUFFIXES:
+                with suppress(FileNotFoundError):
+                    os.remove(path + suffix)
+        return True
+
+    def unlock(self):
+        """Release the lock on this download, removing the lock file if we held it"""
+        if self._lock_file:
+            if self.locked:
+                with suppress(FileNotFoundError):
+                    os.remove(self.lock_path)
+            # closing the file releases the lock
+            self._lock_file.close()
+            self._lock_file = None
+        self.locked = False
+
+    @staticmethod
+    def get_validators(headers):
+        """Return the validators identifying the content from response headers"""
+        return {"etag": headers.get("etag"),
+                "last-modified": headers.get("last-modified"),
+                "length": int(headers.get("content-length", -1))}
+
+    def can_resume(self, headers, has_checksum):
+        """Return if we can continue the previous state with the content described by those headers
+
+        If the server doesn't give any validator, we only trust the size if we have a checksum to check it."""
+        if not self.resumable or not self.written or headers.get('accept-ranges', '').lower() != 'bytes':
+            return False
+        validators = self.get_validators(headers)
+        if validators != self.validators:
+            return False
+        return has_checksum or validators["etag"] or validators["last-modified"]
+
+    def reset(self, headers, ranges, resumable):
+        """Start a new download for content described by headers, in those (start, end) ranges"""
+        logger.debug("Start {} from scratch".format(self.part_path))
+        self.validators = self.get_validators(headers)
+        self.resumable = resumable
+        self.segments = [[start, end, 0] for (start, end) in ranges]
+        if self.checksum:
+            self.checksum.reset()
+        with open(self.part_path, 'wb') as f:
+            if self.validators["length"] != -1:
+                f.truncate(self.validators["length"])
+        self.save(force=True)
+
+    @property
+    def written(self):
+        return sum([written for (start, end, written) in self.segments])
+
+    @property
+    def remaining(self):
+        """Return the indexes of segments which aren't complete, and the range (start, end) left for each of them"""
+        remaining = []
+        for index, (start, end, written) in enumerate(self.segments):
+            if end is None or start + written <= end:
+                remaining.append((index, (start + written, end)))
+        return remaining
+
+    def start_checksum(self, algorithm, sinks=()):
+        """Compute a checksum with that hashlib algorithm (if any) while the content is written, forwarding it to sinks.
+
+        Return it."""
+        self.checksum = SequentialChecksum(algorithm, self.part_path, sinks)
+        return self.checksum
+
+    def open_segment(self, index):
+        """Return an unbuffered file at the current position of that segment. Every write is recorded."""
+        return self._SegmentWriter(self, index)
+
+    def save(self, force=False):
+        """Save the current state, at most every SAVE_INTERVAL seconds unless forced"""
+        with self._lock:
+            now = time.time()
+            if not force and now - self._last_save < self.SAVE_INTERVAL:
+                return
+            self._last_save = now
+            state = {"validators": self.validators, "resumable": self.resumable, "segments": self.segments}
+            with open(self.state_path + ".new", 'w') as f:
+                yaml.dump(state, f, default_flow_style=False)
+            os.replace(self.state_path + ".new", self.state_path)
+
+    def remove(self):
+        """Forget about this download"""
+        for path in (self.part_path, self.state_path):
+            with suppress(FileNotFoundError):
+                os.remove(path)
+        self.validators = {}
+        self.resumable = False
+        self.segments = []
+        if self.checksum:
+            self.checksum.reset()
+
+    def complete(self):
+        """Mark the download as finished and return a DownloadedFile on it"""
+        fd, final_path = tempfile.mkstemp(prefix=os.path.basename(self.path)[:-len(self.suffix) or None] + "-",
+                                          suffix=self.suffix, dir=os.path.dirname(self.path))
+        os.close(fd)
+        os.replace(self.part_path, final_path)
+        with suppress(FileNotFoundError):
+            os.remove(self.state_path)
+        return DownloadedFile(final_path)
+
+    class _SegmentWriter:
+        """Write sequentially in a segment of a partial download, recording progress"""
+
+        def __init__(self, partial, index):
+            self._partial = partial
+            self._segment = partial.segments[index]
+            start, end, written = self._segment
+            self._file = open(partial.part_path, 'r+b', buffering=0)
+            self._file.seek(start + written)
+
+        def write(self, data):
+            start, end, written = self._segment
+            self._file.write(data)
+            if self._partial.checksum:
+                self._partial.checksum.update(start, start + written, data)
+            self._segment[2] += len(data)
+            self._partial.save()
+
+        def copy_from(self, fd, offset, count):
+            """Copy up to count bytes of fd from offset in the segment, in the kernel. Return the copied size"""
+            start, end, written = self._segment
+            copied = copy_file_range(fd, self._file.fileno(), offset, start + written, count)
+            self._file.seek(start + written + copied)
+            self._segment[2] += copied
+            if self._partial.checksum:
+                # hash it back from the page cache
+                self._partial.checksum.advance(self._partial.segments)
+            self._partial.save()
+            return copied
+
+        def close(self):
+            self._file.close()
+            if self._partial.checksum:
+                # hash what this and following segments wrote ahead, if previous segments are done
+                self._partial.checksum.advance(self._partial.segments)
+            self._partial.save(force=True)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.close()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Module sharing one transfer between identical requests of the whole process"""
+
+from concurrent import futures
+import logging
+from threading import Lock
+from umake.network.spooled_buffer import SpooledBuffer
+from umake.tools import Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class RequestCoalescer(object, metaclass=Singleton):
+    """Single-flight identical requests, and memoize in memory responses for the rest of the process.
+
+    A request submitted while an identical one is in flight doesn't start a new transfer: it gets its own future
+    resolved with a copy of the first request result. Copies are independent: buffers held in memory share the same
+    bytes with their own read cursor and downloaded files are hard links deleted on their own close()."""
+
+    def __init__(self):
+        self._lock = Lock()
+        # key: list of futures waiting on the in flight request
+        self._in_flight = {}
+        # key: (buffer, final_url, cookies) of finished in memory requests
+        self._memoized = {}
+
+    @staticmethod
+    def key_for(download_item, download, cache_server=None):
+        """Return the key identifying identical requests for download_item, going through cache_server if set
+
+        A request through a cache server isn't identical to the one this server does: if it runs in the same
+        process, it would wait for itself."""
+        return (download, download_item.url, download_item.checksum,
+                tuple(sorted((download_item.headers or {}).items())), download_item.ignore_encoding,
+                tuple(sorted((download_item.cookies or {}).items())), tuple(download_item.mirrors or ()),
+                cache_server)
+
+    def submit(self, key, start):
+        """Return a future on the request identified by key, calling start() to get it if it needs a transfer.
+
+        start() returns a future whose result is a (dest, final_url, cookies) tuple. dest is either a SpooledBuffer or
+        a DownloadedFile."""
+        with self._lock:
+            memoized = self._memoized.get(key)
+            if memoized:
+                logger.debug("Reuse memoized response for {}".format(key[1]))
+                buffer, final_url, cookies = memoized
+                future = futures.Future()
+                future.set_result((buffer.duplicate(), final_url, cookies.copy()))
+                return future
+            waiters = self._in_flight.get(key)
+            if waiters is not None:
+                logger.debug("Join in flight request for {}".format(key[1]))
+                future = futures.Future()
+                waiters.append(future)
+                return future
+            self._in_flight[key] = []
+        try:
+            future = start()
+        except BaseException:
+            with self._lock:
+                self._in_flight.pop(key)
+            raise
+        # registered before any caller callback, so that copies are done before the first result is consumed
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    def _done(self, key, future):
+        """Memoize and hand over the result of the request identified by key to its waiters"""
+        with self._lock:
+            waiters = self._in_flight.pop(key)
+            exception = future.exception()
+            if exception is None:
+                dest, final_url, cookies = future.result()
+                # buffers which spilled to disk are too big to be kept
+                if isinstance(dest, SpooledBuffer) and dest.in_memory:
+                    self._memoized[key] = (dest.duplicate(), final_url, cookies.copy())
+        for waiter in waiters:
+            if exception is not None:
+                waiter.set_exception(exception)
+                continue
+            try:
+                copy = dest.duplicate()
+            except BaseException as e:
+                waiter.set_exception(e)
+                continue
+            waiter.set_result((copy, final_url, cookies.copy()))
+
+    def clear(self):
+        """Forget memoized responses"""
+        with self._lock:
+            self._memoized = {}
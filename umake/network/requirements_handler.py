@@ -22,12 +22,15 @@
 import apt
 import apt.progress
 import apt.progress.base
+import apt_pkg
 from collections import namedtuple
 from concurrent import futures
 from contextlib import suppress
 import fcntl
 import logging
 import os
+import re
+import shutil
 import subprocess
 import tempfile
 import time
@@ -127,6 +130,168 @@ class RequirementsHandler(object, metaclass=Singleton):
         future.add_done_callback(self._on_done)
         return pkg_to_install
 
+    def prefetch_bucket(self, bucket):
+        """Download in the background the archives of the bucket packages which aren't installed or up to date.
+
+        Nothing is installed: this only fills the apt archive cache, so that a later install_bucket() of the same
+        packages only has to unpack them. Packages of foreign architectures not enabled yet are skipped."""
+        if self.is_bucket_uptodate(bucket):
+            return
+        logger.debug("Prefetch {} archives".format(bucket))
+        future = self.executor.submit(self._really_prefetch_bucket, bucket)
+        future.tag_bucket = bucket
+        future.add_done_callback(self._on_prefetch_done)
+
+    def _really_prefetch_bucket(self, bucket):
+        """Fetch the archives of current bucket, without installing them"""
+        if self.is_bucket_uptodate(bucket):
+            return
+        for pkg_name in bucket:
+            try:
+                self._mark_for_install(pkg_name)
+            except BaseException as e:
+                logger.debug("Don't prefetch {}: {}".format(pkg_name, e))
+        try:
+            # this can take a while: don't run our other threads as root meanwhile
+            self._run_as_root(self.cache.fetch_archives)
+        finally:
+            # the install will mark them again
+            self.cache.clear()
+
+    def _on_prefetch_done(self, future):
+        """Log the prefetch result: if it failed, the install will download what is missing"""
+        if future.exception():
+            logger.info("Couldn't prefetch {}: {}".format(future.tag_bucket, future.exception()))
+        else:
+            logger.debug("{} archives prefetched".format(future.tag_bucket))
+
+    def download_bucket(self, bucket, dest_dir, downloaded_callback):
+        """Download to dest_dir the archives of the bucket packages, and of the dependencies they need on this machine.
+
+        Nothing is installed. Archives are named like in the apt archive cache, so that add_archives() can put them
+        there on another machine to install them without network access.
+        downloaded_callback gets a RequirementsResult once they are downloaded."""
+        logger.info("Download of {} archives pending".format(bucket))
+        future = self.executor.submit(self._really_download_bucket, bucket, dest_dir)
+        future.tag_bucket = {"bucket": bucket, "downloaded_callback": downloaded_callback}
+        future.add_done_callback(self._on_download_done)
+
+    def _really_download_bucket(self, bucket, dest_dir):
+        """Download the archives of current bucket and of the packages installing it would bring"""
+        versions = {}
+        try:
+            for pkg_name in bucket:
+                self._mark_for_install(pkg_name)
+                # the bucket packages themselves, even if they are already installed here
+                candidate = self.cache[self._strip_current_arch(pkg_name)].candidate
+                if candidate is None:
+                    raise BaseException("{} has no installable version".format(pkg_name))
+                versions[self._archive_filename(candidate)] = candidate
+            for pkg in self.cache.get_changes():
+                if pkg.marked_install or pkg.marked_upgrade:
+                    versions[self._archive_filename(pkg.candidate)] = pkg.candidate
+        finally:
+            self.cache.clear()
+        os.makedirs(dest_dir, exist_ok=True)
+        for filename, version in versions.items():
+            logger.debug("Download {} archive".format(filename))
+            os.replace(version.fetch_binary(dest_dir), os.path.join(dest_dir, filename))
+
+    @staticmethod
+    def _archive_filename(version):
+        """Return the file name apt gives to the archive of that package version in its archive cache"""
+        def quote(string, chars):
+            return re.sub("[{}%]".format(chars), lambda match: "%{:02x}".format(ord(match.group())), string)
+        return "{}_{}_{}.deb".format(quote(version.package.shortname, "_:"), quote(version.version, "_:"),
+                                     quote(version.architecture, "_:."))
+
+    def _on_download_done(self, future):
+        """Call future associated bucket downloaded callback"""
+        result = self.RequirementsResult(bucket=future.tag_bucket["bucket"], error=None)
+        if future.exception():
+            logger.error("Couldn't download {}: {}".format(future.tag_bucket["bucket"], future.exception()))
+            result = result._replace(error=str(future.exception()))
+        else:
+            logger.debug("{} archives downloaded".format(future.tag_bucket["bucket"]))
+        future.tag_bucket["downloaded_callback"](result)
+
+    def add_archives(self, paths):
+        """Put those package archives in the apt archive cache, so that installing them doesn't download them.
+
+        This is done before the next install_bucket()."""
+        if not paths:
+            return
+        future = self.executor.submit(self._really_add_archives, paths)
+        future.tag_bucket = paths
+        future.add_done_callback(self._on_add_archives_done)
+
+    def _really_add_archives(self, paths):
+        """Copy the archives at paths in the apt archive cache, as root"""
+        archives_dir = apt_pkg.config.find_dir("Dir::Cache::Archives")
+
+        def copy_archives():
+            for path in paths:
+                shutil.copy(path, archives_dir)
+        self._run_as_root(copy_archives)
+
+    @staticmethod
+    def _run_as_root(function):
+        """Call function as root in a forked process, so that our other threads keep running as the current user.
+
+        seteuid() changes the user of the whole process. Raise a BaseException with the child error if it failed."""
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover (in a fork)
+            status = 0
+            try:
+                os.close(read_fd)
+                os.seteuid(0)
+                os.setegid(0)
+                function()
+            except BaseException as e:
+                os.write(write_fd, str(e).encode("utf-8", "replace"))
+                status = 1
+            finally:
+                os._exit(status)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as f:
+            error = f.read().decode("utf-8", "replace")
+        (pid, status) = os.waitpid(pid, 0)
+        if status != 0:
+            raise BaseException(error or "Process running as root exited with status {}".format(status))
+
+    def _on_add_archives_done(self, future):
+        """Log the result: if it failed, the install will download what is missing"""
+        if future.exception():
+            logger.info("Couldn't add {} to the apt archive cache: {}".format(future.tag_bucket, future.exception()))
+        else:
+            logger.debug("{} added to the apt archive cache".format(future.tag_bucket))
+
+    @staticmethod
+    def _strip_current_arch(pkg_name):
+        """Return pkg_name without its :arch suffix if it's the current arch"""
+        # /!\ danger: if current arch == ':appended_arch', on a non multiarch system, dpkg doesn't understand that
+        if ":" in pkg_name:
+            (pkg_without_arch_name, arch) = pkg_name.split(":", -1)
+            if arch == get_current_arch():
+                return pkg_without_arch_name
+        return pkg_name
+
+    def _mark_for_install(self, pkg_name):
+        """Mark pkg_name for install or upgrade"""
+        pkg_name = self._strip_current_arch(pkg_name)
+        try:
+            pkg = self.cache[pkg_name]
+            if pkg.is_installed and pkg.is_upgradable:
+                logger.debug("Marking {} for upgrade".format(pkg_name))
+                pkg.mark_upgrade()
+            else:
+                logger.debug("Marking {} for install".format(pkg_name))
+                pkg.mark_install(auto_fix=False)
+        except Exception as msg:
+            message = "Can't mark for install {}: {}".format(pkg_name, msg)
+            raise BaseException(message)
+
     def _really_install_bucket(self, current_bucket):
         """Really install current bucket and bind signals"""
         bucket = current_bucket["bucket"]
@@ -159,23 +324,7 @@ class RequirementsHandler(object, metaclass=Singleton):
 
         # mark for install and so on
         for pkg_name in bucket:
-            # /!\ danger: if current arch == ':appended_arch', on a non multiarch system, dpkg doesn't understand that
-            # strip :arch then
-            if ":" in pkg_name:
-                (pkg_without_arch_name, arch) = pkg_name.split(":", -1)
-                if arch == get_current_arch():
-                    pkg_name = pkg_without_arch_name
-            try:
-                pkg = self.cache[pkg_name]
-                if pkg.is_installed and pkg.is_upgradable:
-                    logger.debug("Marking {} for upgrade".format(pkg_name))
-                    pkg.mark_upgrade()
-                else:
-                    logger.debug("Marking {} for install".format(pkg_name))
-                    pkg.mark_install(auto_fix=False)
-            except Exception as msg:
-                message = "Can't mark for install {}: {}".format(pkg_name, msg)
-                raise BaseException(message)
+            self._mark_for_install(pkg_name)
 
         # this can raise on installedArchives() exception if the commit() fails
         try:
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Module handling timeouts, retries and stalls of downloads"""
+
+from collections import Counter
+import logging
+import random
+from threading import Lock
+import time
+import urllib.parse
+
+import requests.exceptions
+from umake.network import get_network_number
+from umake.settings import DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, DEFAULT_RETRIES, DEFAULT_RETRY_BACKOFF, \
+    DEFAULT_RETRY_BACKOFF_MAX, DEFAULT_STALL_SPEED, DEFAULT_STALL_TIME
+from umake.tools import Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadStalled(requests.exceptions.ConnectionError):
+    """Exception raised when a transfer is slower than the stall_speed floor for stall_time seconds"""
+
+
+class RetryPolicy:
+    """Timeouts and retries of downloads, from the network configuration section.
+
+    Failed requests are retried up to retries times, waiting an exponential backoff with full jitter between two
+    attempts. Connection errors, timeouts, stalls and server errors are retried, client errors aren't."""
+
+    def __init__(self):
+        self.timeout = (get_network_number("connect_timeout", DEFAULT_CONNECT_TIMEOUT, float),
+                        get_network_number("read_timeout", DEFAULT_READ_TIMEOUT, float))
+        self.retries = get_network_number("retries", DEFAULT_RETRIES)
+        self.backoff = get_network_number("retry_backoff", DEFAULT_RETRY_BACKOFF, float)
+        self.backoff_max = get_network_number("retry_backoff_max", DEFAULT_RETRY_BACKOFF_MAX, float)
+        self.stall_speed = get_network_number("stall_speed", DEFAULT_STALL_SPEED)
+        self.stall_time = get_network_number("stall_time", DEFAULT_STALL_TIME, float)
+
+    @staticmethod
+    def is_retryable(exception):
+        """Return if the request which raised exception is worth another attempt"""
+        if isinstance(exception, requests.exceptions.HTTPError):
+            status_code = exception.response.status_code if exception.response is not None else 0
+            return status_code >= 500 or status_code == 429
+        return isinstance(exception, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                                      requests.exceptions.ChunkedEncodingError))
+
+    def delay(self, attempt):
+        """Return how many seconds to wait before that attempt (starting at 1)"""
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** (attempt - 1)))
+
+    def before_retry(self, url, attempt, exception):
+        """Record and log the failure of an attempt on url. Return how many seconds to wait before the next one"""
+        retries = RetryStats().record(url)
+        delay = self.delay(attempt)
+        logger.info("Download of {} failed ({}), retrying in {:.1f}s (attempt {} of {}, {} retries on this host)"
+                    .format(url, exception, delay, attempt, self.retries, retries))
+        return delay
+
+    def wait_before_retry(self, url, attempt, exception):
+        """Record and log the failure of an attempt on url, then wait before the next one"""
+        time.sleep(self.before_retry(url, attempt, exception))
+
+    def stall_detector(self):
+        """Return a new StallDetector following this policy"""
+        return StallDetector(self.stall_speed, self.stall_time)
+
+
+class StallDetector:
+    """Detect a transfer whose throughput stays under min_speed bytes per second for window seconds.
+
+    A min_speed of 0 disables it."""
+
+    def __init__(self, min_speed, window):
+        self.min_speed = min_speed
+        self.window = window
+        self._window_start = time.monotonic()
+        self._window_size = 0
+
+    def update(self, size, throttled=0):
+        """Record size more bytes received. Raise DownloadStalled if the transfer is stalled
+
+        throttled is the time we slowed down the transfer on purpose since last update, which doesn't count."""
+        if not self.min_speed:
+            return
+        self._window_start += throttled
+        self._window_size += size
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+        speed = self._window_size / elapsed
+        if speed < self.min_speed:
+            raise DownloadStalled("Transfer stalled at {:.0f} bytes/s for {:.0f}s".format(speed, elapsed))
+        self._window_start = now
+        self._window_size = 0
+
+
+class RetryStats(object, metaclass=Singleton):
+    """Count the retries done against each host in this process"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._retries = Counter()
+
+    def record(self, url):
+        """Record one retry on url host and return how many we did on it"""
+        host = urllib.parse.urlparse(url).netloc.lower()
+        with self._lock:
+            self._retries[host] += 1
+            return self._retries[host]
+
+    def per_host(self):
+        """Return a dict of host: retries count"""
+        with self._lock:
+            return dict(self._retries)
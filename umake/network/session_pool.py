@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module sharing pooled and kept alive requests sessions across the whole process"""
+
+from concurrent import futures
+from http.cookiejar import CookiePolicy
+import logging
+from threading import Lock
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from umake.network import get_network_number, get_network_setting
+from umake.network.bundle import Bundle
+from umake.network.file_adapter import FileAdapter
+from umake.network.ftp_adapter import FTPAdapter
+from umake.settings import DEFAULT_CONNECTION_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_WARM_UP_CONNECTIONS
+from umake.tools import Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class _BlockAllCookies(CookiePolicy):
+    """Cookie policy refusing everything: sessions are shared, cookies are kept per request"""
+    return_ok = set_ok = domain_return_ok = path_return_ok = lambda self, *args, **kwargs: False
+    netscape = True
+    rfc2965 = hide_cookie2 = False
+
+
+class SessionPool(object, metaclass=Singleton):
+    """Hand a kept alive requests Session per scheme and host.
+
+    Connections (and so, TLS sessions) are reused between every requests done against the same host,
+    whatever DownloadCenter instance is asking for it."""
+
+    WARM_UP_WORKERS = 4
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = Lock()
+        self.pool_size = get_network_number("pool_size", DEFAULT_CONNECTION_POOL_SIZE)
+        self.connect_timeout = get_network_number("connect_timeout", DEFAULT_CONNECT_TIMEOUT, float)
+        self.warm_up_enabled = get_network_setting("warm_up_connections", DEFAULT_WARM_UP_CONNECTIONS)
+        self._warm_up_executor = futures.ThreadPoolExecutor(max_workers=self.WARM_UP_WORKERS)
+        # functions called with the target url of every redirection we get, raising to refuse following it
+        self.redirect_filters = []
+
+    @staticmethod
+    def _key(url):
+        """Return the (scheme, host) key for that url"""
+        parsed_url = urllib.parse.urlparse(url)
+        return (parsed_url.scheme.lower(), parsed_url.netloc.lower())
+
+    def _new_session(self, scheme):
+        """Create a new session for urls of that scheme, with our adapters mounted
+
+        Only sessions for file urls can read local files: remote servers can't redirect us to them."""
+        session = requests.Session()
+        session.cookies.set_policy(_BlockAllCookies())
+        if scheme == "file":
+            session.mount('file://', FileAdapter())
+            return session
+        session.hooks["response"].append(self._filter_redirect)
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.mount('ftp://', FTPAdapter())
+        return session
+
+    def _filter_redirect(self, r, *args, **kwargs):
+        """Response hook passing the target of redirections to our redirect filters"""
+        if r.is_redirect:
+            target = urllib.parse.urljoin(r.url, r.headers["location"])
+            for redirect_filter in self.redirect_filters:
+                redirect_filter(target)
+
+    def get(self, url):
+        """Return the shared session for the scheme and host of url"""
+        key = self._key(url)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                logger.debug("Create a new pooled session for {}://{}".format(*key))
+                session = self._new_session(key[0])
+                self._sessions[key] = session
+        return session
+
+    def warm_up(self, urls):
+        """Open in the background a connection (DNS resolution, TCP and TLS handshakes) to the host of each url.
+
+        A HEAD request is sent to each of them through its pooled session, which keeps the connection alive so that
+        the next requests on those hosts don't wait for it. Return the futures of those warm ups.
+        Nothing is done while installing from an offline bundle."""
+        if not self.warm_up_enabled or Bundle().importing:
+            return []
+        urls_per_host = {}
+        for url in urls:
+            if url and self._key(url)[0] in ("http", "https"):
+                urls_per_host.setdefault(self._key(url), url)
+        return [self._warm_up_executor.submit(self._warm_up, url) for url in urls_per_host.values()]
+
+    def _warm_up(self, url):
+        """Send a HEAD request to url, to have a connection to its host in the pool"""
+        logger.debug("Warm up connection to {}".format(url))
+        try:
+            self.get(url).head(url, allow_redirects=False, timeout=self.connect_timeout).close()
+        except Exception as e:
+            # the real request will report it if needed
+            logger.debug("Couldn't warm up connection to {}: {}".format(url, e))
+
+    def close(self):
+        """Close every pooled connection"""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Module holding in memory download buffers, spilling to disk above a size limit"""
+
+from io import BytesIO
+import shutil
+import tempfile
+from umake.network import get_network_number
+from umake.settings import DEFAULT_MEMORY_BUFFER_MAX_SIZE
+
+
+class SpooledBuffer(tempfile.SpooledTemporaryFile):
+    """Buffer of a download=False request, kept in memory up to memory_buffer_max_size MiB (from the network
+    configuration section) and moved to a temporary file above it.
+
+    It keeps the BytesIO API parsers rely on: getvalue(), read() and line iteration."""
+
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = get_network_number("memory_buffer_max_size", DEFAULT_MEMORY_BUFFER_MAX_SIZE) * 1024 * 1024
+        super().__init__(max_size=max_size)
+
+    @property
+    def in_memory(self):
+        return not self._rolled
+
+    def getvalue(self):
+        """Return the whole content, whatever the current position is"""
+        if self.in_memory:
+            return self._file.getvalue()
+        position = self.tell()
+        self.seek(0)
+        content = self.read()
+        self.seek(position)
+        return content
+
+    def duplicate(self):
+        """Return a new buffer with the same content and its own position
+
+        In memory content is shared, not copied."""
+        copy = SpooledBuffer(self._max_size)
+        if self.in_memory:
+            copy._file = BytesIO(self._file.getvalue())
+            return copy
+        copy.rollover()
+        position = self.tell()
+        self.seek(0)
+        shutil.copyfileobj(self, copy)
+        self.seek(position)
+        copy.seek(0)
+        return copy
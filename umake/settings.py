@@ -25,3 +25,31 @@ OLD_CONFIG_FILENAME = "udtc"
 CONFIG_FILENAME = "umake"
 LSB_RELEASE_FILE = "/etc/lsb-release"
 UMAKE_FRAMEWORKS_ENVIRON_VARIABLE = "UMAKE_FRAMEWORKS"
+UMAKE_LIMIT_RATE_ENVIRON_VARIABLE = "UMAKE_LIMIT_RATE"
+
+# network defaults, overridable in the "network" section of the configuration file
+DEFAULT_CONNECTION_POOL_SIZE = 10
+DEFAULT_DOWNLOAD_SEGMENTS = 4
+DEFAULT_CACHE_MAX_SIZE = 4096  # in MiB, 0 disables the artifact cache
+DEFAULT_MAX_CONNECTIONS = 6
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+DEFAULT_DOWNLOAD_ENGINE = "threads"  # or "asyncio" to multiplex in memory downloads on one event loop
+DEFAULT_ASYNC_MAX_CONNECTIONS = 64  # concurrent transfers of the asyncio engine
+DEFAULT_PIPELINED_EXTRACTION = False  # extract tarballs while they download
+DEFAULT_SPECULATIVE_DOWNLOAD = False  # download while the license is displayed
+DEFAULT_WARM_UP_CONNECTIONS = True  # connect to hosts we are going to contact while prompts are displayed
+DEFAULT_MEMORY_BUFFER_MAX_SIZE = 16  # in MiB, in memory downloads spill to disk above it
+DEFAULT_CONNECT_TIMEOUT = 10  # in seconds
+DEFAULT_READ_TIMEOUT = 30  # in seconds
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 1  # in seconds, doubled on each retry with a random jitter
+DEFAULT_RETRY_BACKOFF_MAX = 30  # in seconds
+DEFAULT_STALL_SPEED = 1024  # in bytes per second, 0 disables stall detection
+DEFAULT_STALL_TIME = 30  # in seconds under DEFAULT_STALL_SPEED before aborting a transfer
+DEFAULT_LIMIT_RATE = 0  # in bytes per second (with an optional K, M or G suffix), 0 is unlimited
+DEFAULT_LIMIT_RATE_PER_DOWNLOAD = 0
+DEFAULT_CACHE_SERVER_PORT = 8765  # port of "umake cache serve"
+DEFAULT_CACHE_SERVER_ADDRESS = "localhost"  # address "umake cache serve" listens on
+
+# maximum number of progress updates per second delivered to the UI
+DEFAULT_PROGRESS_RATE = 10
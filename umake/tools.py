@@ -31,9 +31,10 @@ import signal
 import subprocess
 import sys
 from textwrap import dedent
-from time import sleep
+from threading import Lock
+from time import monotonic, sleep
 from umake import settings
-from xdg.BaseDirectory import load_first_config, xdg_config_home, xdg_data_home
+from xdg.BaseDirectory import load_first_config, xdg_cache_home, xdg_config_home, xdg_data_home
 import yaml
 import yaml.scanner
 import yaml.parser
@@ -166,6 +167,47 @@ class MainLoop(object, metaclass=Singleton):
         """Exception raised only to return to MainLoop without finishing the function"""
 
 
+class CoalescedCall(object):
+    """Deliver calls made from any thread to function in the mainloop thread, at most rate times per second.
+
+    Calls made while a delivery is pending are coalesced: function only gets called once, with the latest arguments.
+    If merge is set, merge(pending_args, new_args) returns the arguments to deliver instead."""
+
+    def __init__(self, function, rate=settings.DEFAULT_PROGRESS_RATE, merge=None):
+        self._function = function
+        self._interval = 1 / rate
+        self._merge = merge
+        self._lock = Lock()
+        self._pending_args = None
+        self._last_delivery = 0
+
+    def __call__(self, *args):
+        with self._lock:
+            if self._pending_args is not None:
+                if self._merge:
+                    args = self._merge(self._pending_args, args)
+                self._pending_args = args
+                return
+            self._pending_args = args
+            delay = max(0, self._last_delivery + self._interval - monotonic())
+        GLib.timeout_add(int(delay * 1000), self._deliver)
+
+    def _deliver(self):
+        with self._lock:
+            args = self._pending_args
+            self._pending_args = None
+            self._last_delivery = monotonic()
+        try:
+            self._function(*args)
+        except MainLoop.ReturnMainLoop:
+            pass
+        except BaseException:
+            logger.exception("Unhandled exception")
+            GLib.idle_add(MainLoop().quit, 1, False)
+        # don't recall the callback
+        return False
+
+
 class InputError(BaseException):
     """Exception raised for errors in the input.
 
@@ -231,6 +273,11 @@ def get_user_frameworks_path():
     return os.path.expanduser(os.path.join('~', '.umake', 'frameworks'))
 
 
+def get_cache_path(*paths):
+    """Return a path under umake cache directory"""
+    return os.path.join(xdg_cache_home, "umake", *paths)
+
+
 def get_icon_path(icon_filename):
     """Return local icon path"""
     return os.path.join(xdg_data_home, "icons", icon_filename)
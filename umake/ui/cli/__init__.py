@@ -21,18 +21,31 @@
 
 import argcomplete
 from contextlib import suppress
+from gettext import gettext as _
 import logging
 import os
 from progressbar import ProgressBar, BouncingBar
 import readline
+import subprocess
 import sys
+import tarfile
+import time
+import umake
 from umake.interactions import InputText, TextWithChoices, LicenseAgreement, DisplayMessage, UnknownProgress
 from umake.ui import UI
 from umake.frameworks import BaseCategory
+from umake.network.artifact_cache import ArtifactCache
+from umake.network.bandwidth import BandwidthLimiter
+from umake.network.bundle import Bundle
+from umake.network.cache_server import CacheServer
+from umake.settings import DEFAULT_CACHE_SERVER_ADDRESS, DEFAULT_CACHE_SERVER_PORT
 from umake.tools import InputError, MainLoop
 
 logger = logging.getLogger(__name__)
 
+# global options taking their value as the next argument
+GLOBAL_OPTIONS_WITH_VALUE = ("--limit-rate", "--export-bundle", "--from-bundle")
+
 
 def rlinput(prompt, prefill=''):
     readline.set_startup_hook(lambda: readline.insert_text(prefill))
@@ -95,6 +108,110 @@ def run_command_for_args(args):
     target.run_for(args)
 
 
+def _format_size(size):
+    """Return size in bytes in a human readable form"""
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} GiB".format(size)
+
+
+@MainLoop.in_mainloop_thread
+def run_cache_command(args):
+    """List, prune or serve the downloaded artifact cache"""
+    cache = ArtifactCache()
+    if args.cache_command == "list":
+        entries = cache.entries()
+        for entry in entries:
+            print("{:>10}  {}  {}".format(_format_size(entry.size),
+                                          time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.last_used)),
+                                          entry.url or entry.key))
+        used_size = sum([entry.size for entry in entries + cache.partial_downloads()])
+        print(_("{} artifacts, {} used out of {}").format(len(entries), _format_size(used_size),
+                                                          _format_size(cache.max_size)))
+    elif args.cache_command == "prune":
+        max_size = 0 if args.all else cache.max_size
+        if args.max_size is not None:
+            max_size = args.max_size * 1024 * 1024
+        removed = cache.prune(max_size)
+        freed_size = sum([entry.size for entry in removed])
+        print(_("Removed {} artifacts and partial downloads, freeing {}").format(len(removed),
+                                                                                 _format_size(freed_size)))
+    elif args.cache_command == "serve":
+        server = CacheServer(args.port, args.address)
+        server.start()
+        print(_("Serving the artifact cache on port {}, press Ctrl+C to stop").format(server.port))
+        # serve until interrupted
+        return
+    UI.return_main_screen()
+
+
+def install_cache_parser(parser):
+    """Add the cache command to parser"""
+    cache_parser = parser.add_parser("cache", help=_("Manage the downloaded artifacts cache"))
+    cache_subparsers = cache_parser.add_subparsers(help=_("Cache command"), dest="cache_command")
+    cache_subparsers.add_parser("list", help=_("List cached artifacts, most recently used first"))
+    prune_parser = cache_subparsers.add_parser("prune", help=_("Remove least recently used artifacts and partial "
+                                                               "downloads above the cache size limit, and "
+                                                               "abandoned partial downloads"))
+    prune_parser.add_argument("--max-size", type=int, help=_("Size in MiB to prune the cache to"))
+    prune_parser.add_argument("--all", action="store_true", help=_("Remove every cached artifact and partial "
+                                                                   "download"))
+    serve_parser = cache_subparsers.add_parser("serve", help=_("Share the cache with other machines, downloading "
+                                                               "for them what isn't cached yet"))
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_CACHE_SERVER_PORT,
+                              help=_("Port to listen on (default: {})").format(DEFAULT_CACHE_SERVER_PORT))
+    serve_parser.add_argument("--address", default=DEFAULT_CACHE_SERVER_ADDRESS,
+                              help=_("Address to listen on, 0.0.0.0 to serve other machines (default: {})")
+                              .format(DEFAULT_CACHE_SERVER_ADDRESS))
+
+
+@MainLoop.in_mainloop_thread
+def run_bundle_command(args):
+    """Export frameworks to an offline install bundle, or install every framework of one
+
+    Each framework is handled by its own umake process, as an install does."""
+    if args.bundle_command == "export":
+        commands = [["--export-bundle", args.bundle] + framework.split("/", 1) for framework in args.frameworks]
+    else:
+        try:
+            frameworks = Bundle.frameworks_in(args.bundle)
+        except (OSError, tarfile.TarError) as e:
+            logger.error(_("Can't read the bundle {}: {}").format(args.bundle, e))
+            UI.return_main_screen(status_code=1)
+        commands = [["--from-bundle", args.bundle, category, framework] for (category, framework) in frameworks]
+    verbosity = ["-" + "v" * args.verbose] if args.verbose else []
+    # run this umake, from wherever it was imported, whatever the way it was started
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.dirname(umake.__file__))] +
+                                        ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    for command in commands:
+        try:
+            status_code = subprocess.call([sys.executable, "-m", "umake"] + verbosity + command, env=env)
+        except OSError as e:
+            logger.error(_("Couldn't run umake for {}: {}").format(" ".join(command), e))
+            status_code = 1
+        if status_code:
+            UI.return_main_screen(status_code=status_code)
+    UI.return_main_screen()
+
+
+def install_bundle_parser(parser):
+    """Add the bundle command to parser"""
+    bundle_parser = parser.add_parser("bundle", help=_("Install frameworks without network access"))
+    bundle_subparsers = bundle_parser.add_subparsers(help=_("Bundle command"), dest="bundle_command")
+    export_parser = bundle_subparsers.add_parser("export", help=_("Download what frameworks need to be installed "
+                                                                  "into an offline install bundle"))
+    export_parser.add_argument("frameworks", nargs="+", metavar="framework",
+                               help=_("Framework to export, as category/framework, or category for its default "
+                                      "framework"))
+    export_parser.add_argument("bundle", help=_("Bundle to create, or to add the frameworks to"))
+    import_parser = bundle_subparsers.add_parser("import", help=_("Install every framework of an offline install "
+                                                                  "bundle"))
+    import_parser.add_argument("bundle", help=_("Bundle to install from"))
+
+
 def mangle_args_for_default_framework(args):
     """return the potentially changed args_to_parse for the parser for handling default frameworks
 
@@ -108,8 +225,14 @@ def mangle_args_for_default_framework(args):
     category_name = None
     framework_completed = False
 
+    option_value = False
     for arg in args:
-        if not arg.startswith('-') and not skip_all:
+        if option_value:
+            # value of the previous global option
+            option_value = False
+        elif arg in GLOBAL_OPTIONS_WITH_VALUE and not category_name:
+            option_value = True
+        elif not arg.startswith('-') and not skip_all:
             if not category_name:
                 if arg in BaseCategory.categories.keys():
                     category_name = arg
@@ -153,6 +276,8 @@ def main(parser):
     categories_parser = parser.add_subparsers(help='Developer environment', dest="category")
     for category in BaseCategory.categories.values():
         category.install_category_parser(categories_parser)
+    install_cache_parser(categories_parser)
+    install_bundle_parser(categories_parser)
 
     argcomplete.autocomplete(parser)
     # autocomplete will stop there. Can start more expensive operations now.
@@ -165,5 +290,27 @@ def main(parser):
         parser.print_help()
         sys.exit(0)
 
+    if args.limit_rate is not None:
+        BandwidthLimiter().set_rate(args.limit_rate)
+    if args.export_bundle:
+        Bundle().export_to(os.path.abspath(args.export_bundle))
+    elif args.from_bundle:
+        try:
+            Bundle().import_from(os.path.abspath(args.from_bundle))
+        except (OSError, tarfile.TarError) as e:
+            logger.error(_("Can't read the bundle {}: {}").format(args.from_bundle, e))
+            sys.exit(1)
+
     CliUI()
-    run_command_for_args(args)
+    if args.category == "cache":
+        if not args.cache_command:
+            parser.print_help()
+            sys.exit(0)
+        run_cache_command(args)
+    elif args.category == "bundle":
+        if not args.bundle_command:
+            parser.print_help()
+            sys.exit(0)
+        run_bundle_command(args)
+    else:
+        run_command_for_args(args)